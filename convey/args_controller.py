@@ -173,12 +173,23 @@ class Processing:
     """Set the thread processing number.
 
     Processing threads
-    If set to threads = auto, threads will be used if convey think it is reasonable.
+    If set to threads = auto, threads will be used when a field waits for the network (WHOIS, DNS, nmap, web).
     If True, threads will be always used when processing.
     If number, that number of threads will be created.
     If False, 0, no thread used.
     """
 
+    processes: Annotated[Optional[int], arg(metavar="N")] = None
+    """Compute the fields in N processes, for the CPU-bound fields (code, regular expressions, timestamps, decoding…).
+    The rows are written in the input order. Takes precedence over threads. Needs the fork start method (not on Windows).
+    """
+
+    precompute: Annotated[Blank[int], arg(metavar="THREADS")] = None
+    """Two-phase processing: compute the distinct values of the source columns in THREADS threads first (10 if left blank),
+    then process the rows by looking the results up. Fast when the values repeat a lot, ex: the IPs of an incident feed.
+    The distinct values and their results are kept in memory, not suitable for a huge file of mostly unique values.
+    """
+
     fresh: Annotated[BlankTrue, arg(aliases=["-F"])] = None
     """Do not attempt to load any previous settings / results.
     Do not load convey's global WHOIS cache.
@@ -374,6 +385,14 @@ class FieldComputingOptions:
     single_query_ignored_fields: list[str] = field(default_factory=lambda: ["html"])
     """ These fields shall not be computed when using single value check """
 
+    memo_size: Annotated[int, arg(metavar="VALUES")] = 10_000
+    """Remember the results of the slow conversions (DNS, nmap, timestamp parsing…) for that many distinct values each.
+    The hits and misses are logged at the end of the processing. 0 disables."""
+
+    memo_ttl: Annotated[int, arg(metavar="SECONDS")] = 300
+    """Seconds the remembered results depending on the network (DNS, nmap) are valid,
+    ex: a long-running daemon asks the DNS again. The parsing results do not expire."""
+
     compute_preview: BlankTrue = True
     """When adding new columns, show few first computed values."""
 
@@ -401,6 +420,10 @@ class WhoisModule:
     ttl: Annotated[int, arg(metavar="SECONDS")] = 86400
     """How many seconds will a WHOIS answer cache will be considered fresh."""
 
+    domain_ttl: Annotated[int, arg(metavar="SECONDS")] = 604800
+    """ How many seconds will a WHOIS answer for a registered domain (`whoisdomain`, `registrar_abusemail`)
+    be considered fresh. The hostnames of the same registered domain share the answer. -1 ~ never expire """
+
     delete: BlankTrue = None
     """Delete convey's global WHOIS cache."""
 
@@ -413,8 +436,94 @@ class WhoisModule:
     cache: BlankTrue = True
     """Use whois cache."""
 
+    cache_file: Annotated[Optional[Path], arg(metavar="FILE")] = None
+    """ The global whois cache (an SQLite database shared by the convey processes).
+    Default: `.convey-whois-cache.sqlite` in the config dir """
+
+    cache_limit: Annotated[int, arg(metavar="PREFIXES")] = 0
+    """ Maximal number of prefixes kept in the whois cache.
+    When exceeded, the least used ones are evicted (see `cache_eviction`). 0 ~ unlimited """
+
+    cache_eviction: Literal["lru", "lfu"] = "lru"
+    """ lru ~ evict the least recently used prefixes, lfu ~ the least frequently used """
+
+    cache_stats: BlankTrue = None
+    """Print whois cache statistics (entries, hit rate, size) and exit."""
+
+    archive: bool = True
+    """ Keep the raw WHOIS responses in the whois cache (compressed) so that `reparse` can analyze them again. """
+
+    reparse: BlankTrue = None
+    """ Analyze the archived WHOIS responses of the whois cache again and exit.
+    The cached results are rebuilt by the current parsing rules and `local_country` without querying the registries. """
+
     mirror: Optional[str] = None
 
+    bulk: Annotated[Optional[str], arg(metavar="HOST[:PORT]")] = None
+    """ Answer the `asn`, `country`, `prefix` and `as_org` columns from a bulk whois server
+    speaking the Team Cymru netcat interface, WHOIS is queried only for the rest or when the server does not know the IP.
+    The IPs collected by `prefetch`, `concurrent_batch` or else by the batches of 1000 rows are sent by thousands in a single session.
+    When the server fails, it is not asked for a while (60 s, doubling with every failure in a row).
+    Ex: whois.cymru.com """
+
+    native: bool = False
+    """ Query WHOIS servers directly through the built-in port-43 client
+    instead of launching the system `whois` program for every query. """
+
+    concurrent_batch: Annotated[int, arg(metavar="ROWS")] = 0
+    """ Resolve WHOIS concurrently: collect the distinct IPs of this many rows, resolve them in parallel,
+    then write the rows.
+    0 ~ resolve row by row """
+
+    prefetch: Annotated[int, arg(metavar="IPS")] = 0
+    """ Before processing the rows, collect the distinct IPs of the whole file and resolve them
+    in their numerical order, concurrently by batches of this many IPs.
+    The IPs of a block already found are answered from the cache, the rows are then processed without waiting.
+    0 ~ no prefetch """
+
+    concurrency: dict[str, int] = field(
+        default_factory=lambda: {
+            "ripe": 8,
+            "arin": 8,
+            "lacnic": 1,
+            "apnic": 4,
+            "afrinic": 4,
+            "other": 4,
+        }
+    )
+    """ Maximal number of parallel WHOIS queries per registry when resolving concurrently. """
+
+    rate_limits: dict[str, int] = field(
+        default_factory=lambda: {
+            "ripe": 600,
+            "arin": 300,
+            "lacnic": 8,
+            "apnic": 300,
+            "afrinic": 300,
+            "other": 120,
+        }
+    )
+    """ Maximal number of WHOIS queries per minute sent to a registry so that we do not hit its rate limit.
+    The queries are paced, a burst of one second worth of queries is allowed.
+    (The "other" limit applies to every other server separately.) 0 ~ unlimited """
+
+    offline: Annotated[list[Path], arg(metavar="FILE")] = field(default_factory=list)
+    """ Answer the `country` and `asn` columns locally from these files, WHOIS is queried only for the rest
+    (abusemail, netname...) or when the IP is not found in the files.
+    Accepts the RIR statistics `delegated-*-extended` files (country)
+    and the IP-to-ASN dumps (ASN): the iptoasn.com `ip2asn-*.tsv` ranges or the CAIDA `pfx2as` prefixes, possibly gzipped.
+    The files are imported into an index in the config dir, re-imported when they change.
+    Ex: `--whois.offline delegated-ripencc-extended-latest ip2asn-v4.tsv.gz` """
+
+    offline_index: Annotated[Optional[Path], arg(metavar="FILE")] = None
+    """ Where the `offline` files are imported. Default: `.convey-offline-index` in the config dir """
+
+    mmdb: Annotated[list[Path], arg(metavar="FILE")] = field(default_factory=list)
+    """ Answer the `country`, `asn` and `as_org` columns locally from these MaxMind DB files
+    (ex: GeoLite2-Country.mmdb, GeoLite2-ASN.mmdb), WHOIS is queried only for the rest.
+    Together with `local_country`, the `incident_contact` of an abroad IP is the country CSIRT contact
+    without querying WHOIS. """
+
     local_country: str = ""
     """ whois country code abbreviation (or their list) for local country(countries),
     other countries will be treated as "abroad" if listed in contacts_abroad
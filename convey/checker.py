@@ -15,6 +15,7 @@ from pint import UnitRegistry
 from .convert import reFqdn, reUrl, wrong_url_2_url
 from .decorators import PickInput, PickMethod
 from .infodicts import phone_regex_match
+from .public_suffix import public_suffix
 from .utils import timeout
 
 logger = logging.getLogger(__name__)
@@ -289,6 +290,11 @@ class Checker:
             x = cls.all(x)
             return x if len(x) != 2 else ""
 
+        @staticmethod
+        def suffix(x):
+            """public suffix, ex: co.uk"""
+            return public_suffix(x)
+
     @staticmethod
     def prefix_cidr(val):
         if "/" in val:
@@ -37,7 +37,7 @@ from .mail_sender import MailSenderOtrs, MailSenderSmtp
 from .parser import Parser
 from .types import Types, TypeGroup
 from .wizzard import bottom_plain_style
-from .wrapper import Wrapper
+from .wrapper import Wrapper, whois_cache_stats, whois_reparse
 from . import __version__
 
 
@@ -336,6 +336,12 @@ class Controller:
         if e.env.version:
             print(__version__)
             exit()
+        if e.whois.cache_stats:
+            print(whois_cache_stats())
+            exit()
+        if e.whois.reparse:
+            print(whois_reparse())
+            exit()
         if e.io.csv_processing:
             e.io.single_query = False
         if e.io.single_query or e.io.single_detect:
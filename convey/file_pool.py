@@ -0,0 +1,112 @@
+import io
+from collections import OrderedDict
+from csv import writer as csvwriter
+from pathlib import Path
+from typing import TYPE_CHECKING, TextIO
+
+if TYPE_CHECKING:
+    import _csv
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+class FilePool:
+    """The files the rows are split into (locations), each written through its own buffer.
+
+    The rows of a location are buffered and written to its file when the buffer is full,
+    when too much is buffered in total or when closing.
+    The files written recently are kept open, at most as many as the process may open (RLIMIT_NOFILE);
+    the least recently written one is closed in O(1).
+    """
+
+    buffer_size = 64 * 1024
+    "Characters buffered for a location"
+    buffer_total = 32 * 1024 * 1024
+    "Characters buffered for all the locations"
+    reserve = 64
+    "File descriptors left for the rest: the input file, sockets, the WHOIS cache…"
+
+    def __init__(self, directory: Path, dialect, limit: int = None):
+        self.directory = directory
+        self.dialect = dialect
+        self.limit = limit or self.get_limit()
+        "files open at most"
+        self._open: OrderedDict[str, TextIO] = OrderedDict()
+        "location => file, the least recently written first"
+        self._buffers: dict[str, tuple[io.StringIO, "_csv._writer"]] = {}
+        "location => buffer, its csv writer"
+        self._truncate = set()
+        "locations whose file has to be rewritten at the first write"
+        self._buffered = 0
+
+    @classmethod
+    def get_limit(cls) -> int:
+        if not resource:
+            return 1000
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY:
+            soft = 65536
+        return max(16, soft - cls.reserve)
+
+    def __len__(self):
+        """files open"""
+        return len(self._open)
+
+    def truncate(self, location: str):
+        """The file of the location is rewritten at the first write, else appended to."""
+        self._truncate.add(location)
+
+    def write(self, location: str, text: str):
+        buffer = self._get_buffer(location)[0]
+        start = buffer.tell()
+        buffer.write(text)
+        self._wrote(location, buffer.tell() - start)
+
+    def writerow(self, location: str, fields):
+        buffer, writer = self._get_buffer(location)
+        start = buffer.tell()
+        writer.writerow(fields)
+        self._wrote(location, buffer.tell() - start)
+
+    def _get_buffer(self, location: str):
+        if location not in self._buffers:
+            buffer = io.StringIO()
+            self._buffers[location] = buffer, csvwriter(buffer, dialect=self.dialect)
+        return self._buffers[location]
+
+    def _wrote(self, location: str, size: int):
+        self._buffered += size
+        if self._buffers[location][0].tell() >= self.buffer_size:
+            self._flush(location)
+        if self._buffered >= self.buffer_total:
+            self.flush()
+
+    def _flush(self, location: str):
+        text = self._buffers[location][0].getvalue()
+        if location in self._open:
+            self._open.move_to_end(location)
+            f = self._open[location]
+        else:
+            if len(self._open) >= self.limit:
+                self._open.popitem(last=False)[1].close()
+            f = self._open[location] = open(
+                self.directory / location, "w" if location in self._truncate else "a"
+            )
+            self._truncate.discard(location)
+        f.write(text)
+        self._buffered -= len(text)
+        del self._buffers[location]  # there may be many locations, an idle one does not keep its buffer
+
+    def flush(self):
+        """Write all the buffers."""
+        for location in list(self._buffers):
+            self._flush(location)
+
+    def close(self):
+        self.flush()
+        for f in self._open.values():
+            f.close()
+        self._open.clear()
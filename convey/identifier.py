@@ -13,7 +13,8 @@ from typing import Optional, Tuple, List, TYPE_CHECKING
 
 from .config import Config
 from .decorators import PickBase
-from .types import Types, graph, TypeGroup, Type, get_module_from_path
+from .memo import memoize
+from .types import Types, graph, TypeGroup, Type, get_module_from_path, memoized
 from .field import Field
 
 if TYPE_CHECKING:
@@ -116,6 +117,10 @@ class Identifier:
                 lambda_, "__call__"
             ):  # the field is invisible, see help text for Types; may be False, None or True
                 continue
+            elif (path[i], path[i + 1]) in memoized:
+                lambda_ = memoize(
+                    path[i], path[i + 1], lambda_, memoized[path[i], path[i + 1]]
+                )
             lambdas.append(lambda_)
 
         if target.group == TypeGroup.custom:
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import TYPE_CHECKING, Callable
+
+from .config import Config
+
+if TYPE_CHECKING:
+    from .types import Type
+
+
+class EdgeMemo:
+    """Conversion edge (start type → target type) remembering its results in a bounded LRU cache.
+
+    A column has often only a few distinct values in many rows, the edge computes each of them once.
+    The exceptions are not remembered, the value is computed again the next time.
+    The results of an edge depending on the network (ex: DNS) expire after `ttl` seconds.
+    """
+
+    def __init__(
+        self, start: "Type", target: "Type", method: Callable, size: int, ttl=None
+    ):
+        self.start, self.target, self.method, self.size = start, target, method, size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        "value => (result, monotonic time it expires or None), the least recently used first"
+        self._lock = Lock()
+        self.hits = self.misses = 0
+
+    def __call__(self, value):
+        try:
+            hash(value)
+        except TypeError:  # ex: a list of bytes cannot be a key
+            return self.method(value)
+        with self._lock:
+            if value in self._cache:
+                result, expires = self._cache[value]
+                if expires is None or monotonic() < expires:
+                    self.hits += 1
+                    self._cache.move_to_end(value)
+                    return self._copy(result)
+                del self._cache[value]
+            self.misses += 1
+        result = self.method(value)
+        with self._lock:
+            self._cache[value] = result, self.ttl and monotonic() + self.ttl
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return self._copy(result)
+
+    @staticmethod
+    def _copy(result):
+        """The processor multiplies the lists in place when duplicating the rows."""
+        return result.copy() if isinstance(result, list) else result
+
+    def __str__(self):
+        return f"{self.start} → {self.target}"
+
+
+edges: dict[tuple["Type", "Type"], EdgeMemo] = {}
+"(start type, target type) => its memo, kept among the processing runs while the method is the same"
+
+
+def memoize(start: "Type", target: "Type", method: Callable, network=False) -> Callable:
+    """Return the method remembering its results, unless `--memo-size` is 0.
+    :param network: The results depend on the network, they expire after `--memo-ttl`.
+    """
+    comp = Config.get_env().comp
+    if not (size := comp.memo_size):
+        return method
+    ttl = comp.memo_ttl if network else None
+    memo = edges.get((start, target))
+    if not memo or memo.method is not method or (memo.size, memo.ttl) != (size, ttl):
+        memo = edges[start, target] = EdgeMemo(start, target, method, size, ttl)
+    return memo
+
+
+def take_stats() -> dict[tuple["Type", "Type"], tuple[int, int]]:
+    """(start type, target type) => (hits, misses) since the last call"""
+    stats = {}
+    for key, memo in edges.items():
+        if memo.hits or memo.misses:
+            stats[key] = memo.hits, memo.misses
+            memo.hits = memo.misses = 0
+    return stats
+
+
+def add_stats(stats: dict[tuple["Type", "Type"], tuple[int, int]]):
+    """Count the hits and misses taken in another process (see `--processes`)."""
+    for key, (hits, misses) in stats.items():
+        if memo := edges.get(key):
+            memo.hits += hits
+            memo.misses += misses
+
+
+def report(stats: dict[tuple["Type", "Type"], tuple[int, int]]) -> str:
+    """ex: 'Memoized conversions: url → hostname 990 hits / 10 misses'"""
+    if not stats:
+        return ""
+    return "Memoized conversions: " + ", ".join(
+        f"{start} → {target} {hits} hits / {misses} misses"
+        for (start, target), (hits, misses) in stats.items()
+    )
@@ -0,0 +1,162 @@
+import mmap
+import struct
+from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_pton
+from typing import Optional
+
+METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+DATA_SEPARATOR = 16
+"bytes of zeros between the search tree and the data section"
+
+
+class MmdbReader:
+    """Reader of the MaxMind DB format (`.mmdb`), the format of GeoLite2/GeoIP2 and many other IP databases.
+
+    The file is memory-mapped; a lookup walks the binary search tree bit by bit of the address
+    and decodes just the record found. IPv4 addresses in IPv6 databases are looked up in the `::/96` subtree.
+    See https://maxmind.github.io/MaxMind-DB/
+    """
+
+    def __init__(self, path: Path):
+        """:raises ValueError: The file is not a MaxMind DB."""
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = self._mm.rfind(METADATA_MARKER, max(0, len(self._mm) - 128 * 1024))
+        if start < 0:
+            self._mm.close()
+            raise ValueError(f"{path} is not a MaxMind DB")
+        start += len(METADATA_MARKER)
+        self.metadata, _ = _Decoder(self._mm, start).decode(start)
+        self.node_count = self.metadata["node_count"]
+        self.record_size = self.metadata["record_size"]
+        if self.record_size not in (24, 28, 32):
+            self._mm.close()
+            raise ValueError(f"{path}: unsupported record size {self.record_size}")
+        self.ip_version = self.metadata["ip_version"]
+        self._node_size = self.record_size // 4
+        tree_size = self._node_size * self.node_count
+        self._decoder = _Decoder(self._mm, tree_size + DATA_SEPARATOR)
+        self._ipv4_start = 0
+        if self.ip_version == 6:
+            node = 0
+            for _ in range(96):
+                if node >= self.node_count:
+                    break
+                node = self._read_node(node, 0)
+            self._ipv4_start = node
+
+    def close(self):
+        self._mm.close()
+
+    def get(self, ip: str) -> Optional[dict]:
+        """The record of the IP or None if not found or the IP is invalid."""
+        try:
+            packed = inet_pton(AF_INET, ip)
+            node = self._ipv4_start
+        except OSError:
+            try:
+                packed = inet_pton(AF_INET6, ip)
+            except OSError:
+                return None
+            if self.ip_version == 4:
+                return None
+            node = 0
+        except TypeError:
+            return None
+        value = int.from_bytes(packed, "big")
+        bits = len(packed) * 8
+        for i in range(bits - 1, -1, -1):
+            if node >= self.node_count:
+                break
+            node = self._read_node(node, value >> i & 1)
+        if node <= self.node_count:  # == ~ not found, < ~ the address is too short
+            return None
+        return self._decoder.decode(
+            self._decoder.base + node - self.node_count - DATA_SEPARATOR
+        )[0]
+
+    def _read_node(self, node, bit):
+        offset = node * self._node_size
+        mm = self._mm
+        if self.record_size == 24:
+            offset += bit * 3
+            return int.from_bytes(mm[offset : offset + 3], "big")
+        if self.record_size == 28:
+            middle = mm[offset + 3]
+            if bit:
+                return (middle & 0x0F) << 24 | int.from_bytes(
+                    mm[offset + 4 : offset + 7], "big"
+                )
+            return (middle & 0xF0) << 20 | int.from_bytes(
+                mm[offset : offset + 3], "big"
+            )
+        offset += bit * 4
+        return int.from_bytes(mm[offset : offset + 4], "big")
+
+
+class _Decoder:
+    """Decoder of the MaxMind DB data section."""
+
+    def __init__(self, mm, base: int):
+        """:param base: Offset the pointers are relative to."""
+        self.mm = mm
+        self.base = base
+
+    def decode(self, offset: int):
+        """:return: (value, offset after the value)"""
+        mm = self.mm
+        ctrl = mm[offset]
+        offset += 1
+        type_ = ctrl >> 5
+        if type_ == 1:  # pointer
+            size = ctrl >> 3 & 0x3
+            value = ctrl & 0x7
+            if size == 3:
+                pointer = int.from_bytes(mm[offset : offset + 4], "big")
+            else:
+                pointer = (value << (8 * (size + 1))) | int.from_bytes(
+                    mm[offset : offset + size + 1], "big"
+                )
+                pointer += (0, 2048, 526336)[size]
+            return self.decode(self.base + pointer)[0], offset + size + 1
+        if type_ == 0:  # extended
+            type_ = 7 + mm[offset]
+            offset += 1
+        size = ctrl & 0x1F
+        if size >= 29:
+            n = size - 28
+            size = (29, 285, 65821)[n - 1] + int.from_bytes(
+                mm[offset : offset + n], "big"
+            )
+            offset += n
+
+        if type_ == 2:  # UTF-8 string
+            return mm[offset : offset + size].decode("utf-8"), offset + size
+        if type_ == 7:  # map
+            result = {}
+            for _ in range(size):
+                key, offset = self.decode(offset)
+                result[key], offset = self.decode(offset)
+            return result, offset
+        if type_ == 11:  # array
+            result = []
+            for _ in range(size):
+                value, offset = self.decode(offset)
+                result.append(value)
+            return result, offset
+        if type_ in (5, 6, 9, 10):  # unsigned integers
+            return int.from_bytes(mm[offset : offset + size], "big"), offset + size
+        if type_ == 8:  # int32
+            return (
+                int.from_bytes(mm[offset : offset + size], "big", signed=size == 4),
+                offset + size,
+            )
+        if type_ == 14:  # boolean
+            return bool(size), offset
+        if type_ == 3:  # double
+            return struct.unpack(">d", mm[offset : offset + 8])[0], offset + 8
+        if type_ == 15:  # float
+            return struct.unpack(">f", mm[offset : offset + 4])[0], offset + 4
+        if type_ == 4:  # bytes
+            return bytes(mm[offset : offset + size]), offset + size
+        raise ValueError(f"MaxMind DB: unknown data type {type_} at {offset}")
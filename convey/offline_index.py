@@ -0,0 +1,301 @@
+import gzip
+import logging
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from hashlib import sha1
+from pathlib import Path
+from socket import AF_INET, AF_INET6, inet_pton
+from threading import Lock
+from typing import Iterable, Optional
+
+from netaddr import AddrFormatError, IPAddress
+
+from .config import Config, config_dir
+from .contacts import Contacts
+from .mmdb import MmdbReader
+from .prefix_table import _flatten
+
+logger = logging.getLogger(__name__)
+
+OFFLINE_INDEX = ".convey-offline-index"
+MAGIC = b"CVOI"
+FORMAT = 1
+
+# magic, format, byte order, digest of the source paths,
+# country IPv4 ranges, country IPv6 ranges, ASN IPv4 ranges, ASN IPv6 ranges
+header = struct.Struct(">4sBc20sIIII")
+KINDS = ("country", "asn")
+# start, end, value array typecodes; IPv6 ranges are kept by their /64 network part
+typecodes = {4: ("I", "I"), 6: ("Q", "Q")}
+value_typecode = {"country": "H", "asn": "I"}
+
+
+class OfflineIndex:
+    """Answer the `country` and `asn` of an IP locally, without a WHOIS query.
+
+    Sources:
+        * RIR statistics files `delegated-<registry>-extended-latest`
+            (`registry|cc|type|start|value|date|status|...`) give the country.
+        * IP-to-ASN dumps give the ASN, either the tab separated ranges `first last asn [country description]`
+            (iptoasn.com) or the prefixes `network length asn` (CAIDA pfx2as).
+            The files may be gzipped.
+
+    The sources are imported into a compact range index stored in the config dir (see `whois.offline_index`);
+    it is rebuilt only when a source changes. The index holds sorted disjoint ranges in flat arrays,
+    a lookup is a single binary search. IPv6 ranges are kept by their /64 network part,
+    the granularity the registries allocate at.
+    """
+
+    _instance: Optional["OfflineIndex"] = None
+    _sources: Optional[list] = None
+    _lock = Lock()
+    "the row threads build or load the index once"
+
+    def __init__(self, sources: Iterable[Path], path: Optional[Path] = None):
+        self.sources = [Path(s) for s in sources]
+        self.path = path or Path(config_dir, OFFLINE_INDEX)
+        self.digest = sha1(
+            "\n".join(sorted(str(s.resolve()) for s in self.sources)).encode()
+        ).digest()
+        if self._is_stale():
+            self.build()
+        self._load()
+
+    @classmethod
+    def get(cls) -> Optional["OfflineIndex"]:
+        """The index of the `whois.offline` sources (at `whois.offline_index`) or None if there are none."""
+        whois = Config.get_env().whois
+        if not (sources := whois.offline):
+            return None
+        path = whois.offline_index or Path(config_dir, OFFLINE_INDEX)
+        with cls._lock:
+            if cls._sources is not sources or cls._instance.path != path:
+                cls._instance, cls._sources = cls(sources, path), sources
+            return cls._instance
+
+    def country(self, ip: str) -> Optional[str]:
+        return self._find("country", ip)
+
+    def asn(self, ip: str) -> Optional[str]:
+        return self._find("asn", ip)
+
+    def _find(self, kind, ip):
+        try:
+            version, val = 4, int.from_bytes(inet_pton(AF_INET, ip), "big")
+        except OSError:
+            try:
+                version, val = 6, int.from_bytes(inet_pton(AF_INET6, ip)[:8], "big")
+            except OSError:
+                return None
+        except TypeError:
+            return None
+        starts, ends, values = self.ranges[kind][version]
+        i = bisect_right(starts, val) - 1
+        if i < 0 or ends[i] < val:
+            return None
+        value = values[i]
+        if kind == "asn":
+            return f"as{value}"
+        return chr(value >> 8) + chr(value & 0xFF)
+
+    def _is_stale(self):
+        try:
+            mtime = self.path.stat().st_mtime
+            with open(self.path, "rb") as f:
+                _, fmt, order, digest, *_ = header.unpack(f.read(header.size))
+        except (OSError, struct.error):
+            return True
+        return (
+            fmt != FORMAT
+            or order != sys.byteorder[0].encode()
+            or digest != self.digest
+            or any(s.stat().st_mtime > mtime for s in self.sources)
+        )
+
+    def build(self):
+        """Import the sources into the index file."""
+        intervals = {kind: {4: [], 6: []} for kind in KINDS}
+        values = {kind: [] for kind in KINDS}
+        for source in self.sources:
+            with (gzip.open if source.suffix == ".gz" else open)(
+                source, "rt", encoding="utf-8", errors="replace"
+            ) as f:
+                for kind, first, last, value in parse(f):
+                    intervals[kind][first.version].append(
+                        (int(first), int(last), len(values[kind]))
+                    )
+                    values[kind].append(value)
+
+        arrays = []
+        counts = []
+        for kind in KINDS:
+            for version, (start_code, end_code) in typecodes.items():
+                starts, ends, vals = (
+                    array(start_code),
+                    array(end_code),
+                    array(value_typecode[kind]),
+                )
+                for first, last, index in _flatten(intervals[kind][version]):
+                    if version == 6:
+                        first, last = first >> 64, last >> 64
+                    value = values[kind][index]
+                    if ends and ends[-1] >= first:  # sub /64 IPv6 segments
+                        if last <= ends[-1]:
+                            continue
+                        first = ends[-1] + 1
+                    if vals and vals[-1] == value and ends[-1] + 1 == first:
+                        ends[-1] = last  # join the neighbours
+                    else:
+                        starts.append(first)
+                        ends.append(last)
+                        vals.append(value)
+                arrays.extend((starts, ends, vals))
+                counts.append(len(starts))
+
+        tmp = Path(f"{self.path}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(
+                header.pack(
+                    MAGIC, FORMAT, sys.byteorder[0].encode(), self.digest, *counts
+                )
+            )
+            for a in arrays:
+                a.tofile(f)
+        os.replace(tmp, self.path)
+        logger.info(
+            f"Offline index built from {len(self.sources)} file(s):"
+            f" {counts[0] + counts[1]} country and {counts[2] + counts[3]} ASN ranges"
+        )
+
+    def _load(self):
+        """:raises ValueError: The file is not an offline index."""
+        with open(self.path, "rb") as f:
+            magic, fmt, _, _, *counts = header.unpack(f.read(header.size))
+            if magic != MAGIC or fmt != FORMAT:
+                raise ValueError(f"{self.path} is not an offline index")
+            self.ranges = {}
+            counts = iter(counts)
+            for kind in KINDS:
+                self.ranges[kind] = {}
+                for version, codes in typecodes.items():
+                    count = next(counts)
+                    self.ranges[kind][version] = tuple(
+                        _read(f, code, count) for code in (*codes, value_typecode[kind])
+                    )
+
+
+class Offline:
+    """Fields answered without a network query, from the `whois.offline` index or the `whois.mmdb` databases.
+    Every method returns None when the sources have no answer; the caller then asks WHOIS.
+    """
+
+    _readers: list[MmdbReader] = []
+    _paths: Optional[list] = None
+    _lock = Lock()
+
+    @classmethod
+    def records(cls, ip: str):
+        """Yield the records of the IP in the MMDB databases."""
+        paths = Config.get_env().whois.mmdb
+        with cls._lock:
+            if cls._paths is not paths:
+                cls._readers, cls._paths = [MmdbReader(p) for p in paths or ()], paths
+            readers = cls._readers
+        for reader in readers:
+            if record := reader.get(ip):
+                yield record
+
+    @classmethod
+    def country(cls, ip: str) -> Optional[str]:
+        if (index := OfflineIndex.get()) and (country := index.country(ip)):
+            return country
+        for record in cls.records(ip):
+            # GeoIP2/GeoLite2, ipinfo and similar layouts
+            country = record.get("country", {}).get("iso_code") or record.get(
+                "country_code"
+            )
+            if country:
+                return country.lower()
+
+    @classmethod
+    def asn(cls, ip: str) -> Optional[str]:
+        if (index := OfflineIndex.get()) and (asn := index.asn(ip)):
+            return asn
+        for record in cls.records(ip):
+            if asn := record.get("autonomous_system_number"):
+                return f"as{asn}"
+            if asn := record.get("asn"):
+                return str(asn).lower()
+
+    @classmethod
+    def as_org(cls, ip: str) -> Optional[str]:
+        for record in cls.records(ip):
+            if org := record.get("autonomous_system_organization") or record.get(
+                "as_name"
+            ):
+                return org
+
+    @classmethod
+    def incident_contact(cls, ip: str) -> Optional[str]:
+        """The country CSIRT contact of an abroad IP (see `whois.local_country`).
+        The local IPs and the countries without a CSIRT contact need the abuse e-mail from WHOIS.
+        """
+        local = Config.get_env().whois.local_country
+        if not local or not (country := cls.country(ip)):
+            return None
+        if country not in local and country in Contacts.country2mail:
+            return f"{country}{Config.ABROAD_MARK}{Contacts.country2mail[country]}"
+
+
+def _read(f, typecode, count):
+    a = array(typecode)
+    a.fromfile(f, count)
+    return a
+
+
+def parse(lines: Iterable[str]):
+    """Yield (kind, first IP, last IP, value) of the delegated statistics or IP-to-ASN dump lines.
+    Country value is the lowercase two-letter code packed into an int, ASN value is the AS number.
+    Unallocated and not routed ranges are skipped, as well as the malformed lines.
+    """
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        try:
+            if "|" in line:
+                # registry|cc|type|start|value|date|status[|opaque-id|...]
+                parts = line.split("|")
+                if len(parts) < 7 or parts[2] not in ("ipv4", "ipv6"):
+                    continue  # header, summary or asn line
+                cc = parts[1].lower()
+                if len(cc) != 2 or cc == "zz" or parts[6].strip() == "available":
+                    continue
+                first = IPAddress(parts[3])
+                if parts[2] == "ipv4":
+                    last = IPAddress(int(first) + int(parts[4]) - 1, 4)
+                else:
+                    last = IPAddress(int(first) | (1 << 128 - int(parts[4])) - 1, 6)
+                yield "country", first, last, ord(cc[0]) << 8 | ord(cc[1])
+            else:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                first = IPAddress(parts[0])
+                if parts[1].isdigit():  # network length asn
+                    last = IPAddress(
+                        int(first)
+                        | (1 << (32 if first.version == 4 else 128) - int(parts[1]))
+                        - 1,
+                        first.version,
+                    )
+                else:  # first last asn
+                    last = IPAddress(parts[1])
+                # multi-origin "1_2" or AS set "1,2"
+                asn = int(parts[2].replace(",", "_").split("_")[0])
+                if asn:  # 0 ~ not routed
+                    yield "asn", first, last, asn
+        except (AddrFormatError, ValueError):
+            logger.debug(f"Offline index: skipping malformed line {line!r}")
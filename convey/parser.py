@@ -29,6 +29,7 @@ from .field import Cell, Field
 from .identifier import Identifier
 from .informer import Informer
 from .mail_draft import MailDraft
+from .prefix_index import PrefixIndex
 from .processor import Processor
 from .types import Types, Type, TypeGroup
 from .utils import ErrorOnAccess
@@ -124,7 +125,7 @@ class Parser:
         self.external_stdout = None
         self.is_single_query = False
         "CSV processing vs single_query check usage"
-        self.ranges = {}  # XX should be refactored as part of Whois
+        self.ranges = PrefixIndex()  # XX should be refactored as part of Whois
         self.ip_seen = {}  # XX should be refactored as part of Whois
         self.aggregation: DefaultDict[str, AggregationGroupedRows] = defaultdict(
             lambda: defaultdict(list)
@@ -562,7 +563,7 @@ class Parser:
         if not assure_init:
             if hard:
                 self.whois_stats = defaultdict(int)
-                self.ranges = ranges or {}
+                self.ranges = ranges if ranges is not None else PrefixIndex()
                 self.ip_seen = ip_seen or {}
         Whois.init(
             self.whois_stats,
@@ -1125,7 +1126,7 @@ class Parser:
             for k, v in d.items():
                 setattr(self.settings["dialect"], k, v)
 
-        self.ranges = {}
+        self.ranges = PrefixIndex()
         self.ip_seen = {}
 
     def post_setstate(self, m: Mininterface[Env]):
@@ -0,0 +1,167 @@
+from bisect import bisect_right
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from threading import Lock
+from typing import TYPE_CHECKING
+
+from netaddr import AddrFormatError, IPAddress
+
+if TYPE_CHECKING:
+    from .whois_store import WhoisStore
+
+
+class PrefixIndex(MutableMapping):
+    """Dict-like container of the WHOIS prefixes {IPRange|IPNetwork: AnalysisResult}.
+
+    Besides the standard dict access, it answers which cached prefix contains an IP address.
+    The prefix bounds are kept in a sorted list of integer pairs (separately for IPv4 and IPv6)
+    so that the lookup is a binary search instead of comparing the IP with every prefix.
+    Each prefix links to its enclosing prefix so that a miss does not walk over all the preceding ones.
+
+    If a persistent `store` is given, the index is its write-through session view:
+    the prefixes are looked up in the store and the loaded ones are kept in memory.
+    The store may be still being opened (a Future), then it is waited for at the first access.
+    """
+
+    def __init__(self, data=None, store: "WhoisStore | Future[WhoisStore]" = None):
+        self._store = store
+        self._data = {}
+        "prefix => AnalysisResult"
+        self._keys = {}
+        "(version, first, last) => prefix"
+        self._bounds = {4: [], 6: []}
+        "version => sorted [(first, -last)]; for the same first IP, the broader prefix comes first"
+        self._parents = {}
+        "(version, first, last) => the nearest preceding bound ending at or after it or None; if nested, the enclosing prefix"
+        self._lock = Lock()
+        if data:
+            self.update(data)
+
+    @property
+    def store(self) -> "WhoisStore | None":
+        """global WHOIS cache"""
+        if isinstance(self._store, Future):
+            self._store = self._store.result()
+        return self._store
+
+    def __getitem__(self, prefix):
+        return self._data[prefix]
+
+    def __setitem__(self, prefix, value):
+        self._set(prefix, value)
+        if self.store is not None:
+            self.store.put(value)
+
+    def __delitem__(self, prefix):
+        self._delete(prefix)
+        if self.store is not None:
+            self.store.delete(prefix)
+
+    def _delete(self, prefix):
+        """Delete the prefix from memory only."""
+        with self._lock:
+            del self._data[prefix]
+            version, first, last = key = prefix.key()
+            del self._keys[key]
+            bounds = self._bounds[version]
+            i = bisect_right(bounds, (first, -last)) - 1
+            del bounds[i]
+            del self._parents[key]
+            preceding = (version, bounds[i - 1][0], -bounds[i - 1][1]) if i else None
+            for child in self._inside(version, i, last):  # the children are adopted by the grandparent
+                if self._parents[child] == key:
+                    self._parents[child] = self._reaching(preceding, child[2])
+
+    def archive(self, prefix, target: str, exchanges: list):
+        """Keep the raw WHOIS responses of the prefix in the store, if any (see `WhoisStore.archive`)."""
+        if self.store is not None:
+            self.store.archive(prefix, target, exchanges)
+
+    def merge(self, items, removed=()):
+        """Set the (prefix, value) items and delete the removed prefixes in memory only.
+        Ex: the changes made by a worker process which has written them to the store already.
+        """
+        items = list(items)
+        for prefix in removed:
+            if prefix in self._data:
+                self._delete(prefix)
+        for prefix, value in items:
+            self._set(prefix, value)
+        if (items or removed) and self.store is not None:
+            self.store.written += len(items) + len(removed)
+
+    def _set(self, prefix, value, keep=False):
+        """Set the value in memory only. Return the prefix as the key.
+        :param keep: Do not overwrite the value already present.
+        """
+        with self._lock:
+            if prefix not in self._data:
+                self._keys[key := prefix.key()] = prefix
+                if key not in self._parents:
+                    self._insert(*key)
+            elif keep:
+                return self._keys[prefix.key()]
+            self._data[prefix] = value
+            return prefix
+
+    def _insert(self, version, first, last):
+        bounds = self._bounds[version]
+        i = bisect_right(bounds, (first, -last))
+        bounds.insert(i, (first, -last))
+        key = version, first, last
+        self._parents[key] = self._reaching(
+            (version, bounds[i - 1][0], -bounds[i - 1][1]) if i else None, last
+        )
+        reach = -1
+        for child in self._inside(version, i + 1, last):  # the siblings now inside the new prefix
+            if reach < child[2] <= last:  # no prefix in between reaches the child's end
+                self._parents[child] = key
+            reach = max(reach, child[2])
+
+    def _reaching(self, key, val):
+        """Return the key or its nearest parent ending at or after the IP value, or None."""
+        while key and key[2] < val:
+            key = self._parents[key]
+        return key
+
+    def _inside(self, version, i, last):
+        """Yield the keys of the prefixes from the i-th bound on that start before the `last` IP."""
+        bounds = self._bounds[version]
+        while i < len(bounds) and bounds[i][0] <= last:
+            yield version, bounds[i][0], -bounds[i][1]
+            i += 1
+
+    def __contains__(self, prefix):
+        return prefix in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"PrefixIndex({self._data!r})"
+
+    def find(self, ip):
+        """Return the most specific cached prefix the IP belongs to or None.
+
+        WHOIS prefixes are either disjoint or nested. We take the prefix with the nearest lower first IP.
+        If it does not contain the IP, it is a sibling inside a broader prefix and we continue with its enclosing ones.
+        """
+        try:
+            ip = IPAddress(ip)
+        except (AddrFormatError, ValueError, TypeError):
+            return None
+        if self.store is not None:
+            # the store contains every prefix we have, including the most specific one
+            if (value := self.store.find(ip)) is None:
+                return None
+            return self._set(value[0], value, keep=True)
+        val = int(ip)
+        bounds = self._bounds[ip.version]
+        with self._lock:
+            i = bisect_right(bounds, (val, 1)) - 1  # -last is never positive
+            key = (ip.version, bounds[i][0], -bounds[i][1]) if i >= 0 else None
+            key = self._reaching(key, val)
+            return self._keys[key] if key else None
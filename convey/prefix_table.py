@@ -0,0 +1,189 @@
+import mmap
+import os
+import struct
+from heapq import heappop, heappush
+from pathlib import Path
+from typing import Iterable
+
+from netaddr import IPAddress, IPRange
+
+MAGIC = b"CVPT"
+FORMAT = 1
+
+# magic, format, seq, removed, IPv4 segments, IPv6 segments, entries
+header = struct.Struct(">4sBQQIII")
+# IP address bytes
+width = {4: 4, 6: 16}
+# first, last, entry index
+segment = {v: struct.Struct(f">{w}s{w}sI") for v, w in width.items()}
+# id, version, first, last, timestamp, string pool offsets of the AnalysisResult fields
+entry = struct.Struct(">QB16s16sq6I")
+length = struct.Struct(">I")
+NONE = 0xFFFFFFFF
+"string pool offset of None"
+
+
+class PrefixTable:
+    """Compact read-only snapshot of the WHOIS cache, memory-mapped so that nothing is deserialized when opened.
+
+    File layout:
+        * header
+        * IPv4 segments, IPv6 segments: sorted disjoint IP ranges, each pointing to the most specific prefix entry
+        * entries: the prefixes with the offsets of their strings
+        * string pool: length-prefixed UTF-8 strings, every distinct string stored once
+
+    Nested prefixes are flattened into the disjoint segments when the table is written
+    so that the lookup is a single binary search.
+    """
+
+    def __init__(self, path: Path):
+        """:raises ValueError: The file is not a prefix table."""
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, fmt, self.seq, self.removed, n4, n6, self.entries = (
+                header.unpack_from(self._mm)
+            )
+        except struct.error:
+            magic = fmt = None
+        if magic != MAGIC or fmt != FORMAT:
+            self._mm.close()
+            raise ValueError(f"{path} is not a prefix table")
+        self._segments = {
+            4: (header.size, n4),
+            6: (header.size + n4 * segment[4].size, n6),
+        }
+        "version => (offset, count)"
+        self._entries = self._segments[6][0] + n6 * segment[6].size
+        self._pool = self._entries + self.entries * entry.size
+
+    def close(self):
+        self._mm.close()
+
+    def find(self, ip: IPAddress):
+        """Return (id, AnalysisResult) of the most specific prefix the IP belongs to or None."""
+        seg = segment[ip.version]
+        offset, count = self._segments[ip.version]
+        val = int(ip).to_bytes(width[ip.version], "big")
+        lo, hi = 0, count
+        while lo < hi:  # the last segment starting at or before the IP
+            mid = (lo + hi) // 2
+            if seg.unpack_from(self._mm, offset + mid * seg.size)[0] <= val:
+                lo = mid + 1
+            else:
+                hi = mid
+        if not lo:
+            return None
+        _, last, index = seg.unpack_from(self._mm, offset + (lo - 1) * seg.size)
+        if last < val:
+            return None
+        return self._entry(index)
+
+    def _entry(self, index):
+        id_, version, first, last, timestamp, *offsets = entry.unpack_from(
+            self._mm, self._entries + index * entry.size
+        )
+        prefix = IPRange(
+            IPAddress(int.from_bytes(first, "big"), version),
+            IPAddress(int.from_bytes(last, "big"), version),
+        )
+        return id_, (prefix, *(self._string(o) for o in offsets), timestamp)
+
+    def _string(self, offset):
+        if offset == NONE:
+            return None
+        start = self._pool + offset
+        (size,) = length.unpack_from(self._mm, start)
+        return self._mm[start + length.size : start + length.size + size].decode(
+            "utf-8"
+        )
+
+    @staticmethod
+    def write(path: Path, rows: Iterable, seq: int, removed: int):
+        """Write the table atomically; the processes having the former table mapped keep reading it.
+        :param rows: (id, AnalysisResult)
+        :param seq: The highest id the table contains.
+        :param removed: Number of results removed from the store so far.
+        """
+        entries = []
+        pool = {}
+        pool_size = 0
+        by_version = {4: [], 6: []}
+        for id_, result in rows:
+            prefix = result[0]
+            offsets = []
+            for s in result[1:7]:
+                if s is None:
+                    offsets.append(NONE)
+                    continue
+                if s not in pool:
+                    pool[s] = pool_size
+                    pool_size += length.size + len(s.encode("utf-8"))
+                offsets.append(pool[s])
+            by_version[prefix.version].append((prefix.first, prefix.last, len(entries)))
+            entries.append(
+                entry.pack(
+                    id_,
+                    prefix.version,
+                    prefix.first.to_bytes(16, "big"),
+                    prefix.last.to_bytes(16, "big"),
+                    result[7],
+                    *offsets,
+                )
+            )
+        segments = {v: _flatten(intervals) for v, intervals in by_version.items()}
+
+        tmp = Path(f"{path}.{os.getpid()}.tmp")  # other processes may be writing too
+        with open(tmp, "wb") as f:
+            f.write(
+                header.pack(
+                    MAGIC,
+                    FORMAT,
+                    seq,
+                    removed,
+                    len(segments[4]),
+                    len(segments[6]),
+                    len(entries),
+                )
+            )
+            for version, w in width.items():
+                for first, last, index in segments[version]:
+                    f.write(
+                        segment[version].pack(
+                            first.to_bytes(w, "big"), last.to_bytes(w, "big"), index
+                        )
+                    )
+            f.writelines(entries)
+            for s in pool:  # dict keeps the insertion order = the offsets order
+                b = s.encode("utf-8")
+                f.write(length.pack(len(b)))
+                f.write(b)
+        os.replace(tmp, path)
+
+
+def _flatten(intervals: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+    """Split possibly nested intervals into disjoint segments.
+    :param intervals: (first, last, entry index)
+    :return: sorted (first, last, entry index) where the entry is the most specific interval covering the segment
+        (the smallest one; of the same size, the one starting later)
+    """
+    intervals.sort()
+    points = sorted({p for first, last, _ in intervals for p in (first, last + 1)})
+    segments = []
+    active = []  # heap of ((size bits, -first, last), index)
+    i = 0
+    for point, next_point in zip(points, points[1:]):
+        while i < len(intervals) and intervals[i][0] <= point:
+            first, last, index = intervals[i]
+            heappush(active, (((last - first).bit_length(), -first, last), index))
+            i += 1
+        while active and active[0][0][2] < point:  # ended
+            heappop(active)
+        if not active:
+            continue
+        index = active[0][1]
+        if segments and segments[-1][2] == index and segments[-1][1] + 1 == point:
+            segments[-1] = (segments[-1][0], next_point - 1, index)
+        else:
+            segments.append((point, next_point - 1, index))
+    return segments
@@ -3,23 +3,34 @@ import io
 import logging
 import traceback
 from bdb import BdbQuit
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from csv import reader as csvreader, writer as csvwriter
-from functools import reduce
+from functools import partial, reduce
+from multiprocessing import get_context
 from operator import eq, ne, mul
 from pathlib import Path
-from queue import Queue, Empty
+from pickle import dumps
 from sys import exit
-from threading import Thread, Lock
-from typing import Dict, TYPE_CHECKING, List, Tuple, Union
+from threading import Lock
+from typing import Callable, Dict, TYPE_CHECKING, List, Optional, Tuple, Union
+
+from netaddr import AddrFormatError, IPAddress
 
 from .aggregate import Aggregate
 from .action import Expandable
 from .attachment import Attachment
+from . import memo
 from .config import Config
-from .types import Types
+from .file_pool import FilePool
+from .prefix_index import PrefixIndex
+from .types import Types, bulk_lookups, graph, memoized, methods, whois_lookups
 from .web import Web
-from .whois import Quota, UnknownValue
+from .whois import Quota, UnknownValue, Whois
+from .whois_bulk import BulkWhois
+from .whois_resolver import WhoisResolver
+from .whois_store import WhoisStore
 
 if TYPE_CHECKING:
     import _csv
@@ -30,6 +41,149 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+def _ip_order(ip: str):
+    """Numerical order of the IPs, IPv4 first. Not an IP (ex: a hostname) comes last."""
+    try:
+        address = IPAddress(ip)
+    except (AddrFormatError, ValueError, TypeError):
+        return 7, 0, ip
+    return address.version, int(address), ""
+
+
+class _Journal:
+    """Mapping remembering the keys set or deleted (None) since the last `take`."""
+
+    def __init__(self, *args, **kwargs):
+        self.changes = {}
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changes[key] = None
+
+    def take(self) -> dict:
+        changes, self.changes = self.changes, {}
+        return changes
+
+
+class _JournalDict(_Journal, dict):
+    pass
+
+
+class _JournalIndex(_Journal, PrefixIndex):
+    pass
+
+
+class _Worker:
+    """Computes the added fields of the rows in a worker process (see `--processes`).
+
+    The processes are forked so that they inherit the settings with the field lambdas which cannot be pickled.
+    They are forked at once, before the threads of the row processing start, so that no lock is copied held.
+    Only the rows and their computed fields travel. The findings of a worker (the memo and WHOIS statistics,
+    the changes of the IPs seen and of the prefixes, the IPs queued) are sent along and folded into the parent's
+    by the main thread.
+    """
+
+    batch_size = 100
+    "Rows shipped to a process at once"
+
+    executor: Optional[ProcessPoolExecutor] = None
+    settings: Optional[Settings] = None
+    queued: set = set()
+    "Whois.queued_ips already sent to the parent"
+    received: deque = deque()
+    "The findings of the workers waiting to be folded"
+
+    @classmethod
+    def start(cls, processes: int, settings: Settings, whois: bool) -> ProcessPoolExecutor:
+        """
+        :param whois: A field may ask WHOIS. Then the global WHOIS cache is waited for
+            so that the processes are not forked while it is being opened.
+        """
+        cls.settings = settings
+        cls.received.clear()
+        if whois:
+            Whois.ranges.store
+        cls.executor = ProcessPoolExecutor(
+            processes, get_context("fork"), initializer=cls._init, initargs=(whois,)
+        )
+        cls.executor.submit(int).result()  # fork all the processes now
+        return cls.executor
+
+    @classmethod
+    def _init(cls, whois: bool):
+        """In the worker process"""
+        Whois.stats, Whois.csvstats = defaultdict(int), defaultdict(set)
+        Whois.ip_seen = _JournalDict(Whois.ip_seen)
+        if not whois:  # the store may still be being opened by a thread which has not been forked
+            Whois.ranges = _JournalIndex()
+        elif (store := Whois.ranges.store) is not None:
+            # the SQLite connection must not be used by both processes
+            Whois.ranges = _JournalIndex(store=WhoisStore(store.path))
+        else:
+            Whois.ranges = _JournalIndex(Whois.ranges)
+            Whois.ranges.take()
+        cls.queued = set(Whois.queued_ips)
+
+    @classmethod
+    def compute(cls, rows: list):
+        """In the worker process. Return the row outcomes and the WHOIS findings meanwhile."""
+        outcomes = Processor._compute_rows(rows, cls.settings)
+        for i, (values, e) in enumerate(outcomes):
+            try:
+                dumps(e)
+            except Exception:  # the parent would not get the batch at all
+                outcomes[i] = None, RuntimeWarning(str(e))
+        findings = (
+            memo.take_stats(),
+            Whois.stats,
+            {k: v for k, v in Whois.csvstats.items() if v},
+            Whois.ip_seen.take(),
+            Whois.ranges.take(),
+            Whois.queued_ips - cls.queued,
+        )
+        Whois.stats, Whois.csvstats = defaultdict(int), defaultdict(set)
+        cls.queued = set(Whois.queued_ips)
+        return outcomes, findings
+
+    @classmethod
+    def folding(cls, ordered):
+        """In the parent process. Yield the rows back, folding the findings received meanwhile."""
+        for item in ordered:
+            cls._fold_received()
+            yield item
+        cls._fold_received()
+
+    @classmethod
+    def _fold_received(cls):
+        while cls.received:
+            cls.fold(cls.received.popleft())
+
+    @staticmethod
+    def fold(findings):
+        """In the parent process"""
+        memo_stats, stats, csvstats, ip_seen, ranges, queued_ips = findings
+        memo.add_stats(memo_stats)
+        for k, v in stats.items():
+            Whois.stats[k] += v
+        for k, v in csvstats.items():
+            Whois.csvstats[k].update(v)
+        for ip, prefix in ip_seen.items():
+            if prefix is None:
+                Whois.ip_seen.pop(ip, None)
+            else:
+                Whois.ip_seen[ip] = prefix
+        Whois.ranges.merge(
+            ((prefix, v) for prefix, v in ranges.items() if v is not None),
+            [prefix for prefix, v in ranges.items() if v is None],
+        )
+        Whois.queued_ips.update(queued_ips)
+
+
 def prod(iterable):  # XX as of Python3.8, replace with math.prod
     return reduce(mul, iterable, 1)
 
@@ -38,11 +192,15 @@ class Processor:
     """Opens the CSV file and processes the lines."""
 
     descriptors: Dict[
-        Union[int, str], Tuple[io.StringIO, _csv._writer]
-    ]  # location => file_descriptor, his csv-writer
-    descriptorsStatsOpen: Dict[
-        str, int
-    ]  # {location: count} XX(performance) we may use a SortedDict object
+        int, Tuple[io.StringIO, _csv._writer]
+    ]  # stdout location (1 or 2) => its buffer, his csv-writer
+    files: Optional[FilePool]
+    "the other locations"
+
+    precompute_batch = 1000
+    "Distinct values computed at once when precomputing"
+    bulk_batch = 1000
+    "Rows whose IPs are sent to the bulk whois at once, unless `whois.concurrent_batch` sets the batch"
 
     def __init__(self, parser, rewrite=True):
         """
@@ -54,11 +212,8 @@ class Processor:
             parser.files_created.clear()
 
         self.unique_sets = defaultdict(set)
-        self.descriptors_max = 1000  # XX should be given by the system, ex 1024
-        self.descriptors_count = 0
-        self.descriptorsStatsOpen = {}
-        self.descriptorsStatsAll = defaultdict(int)
         self.descriptors = {}
+        self.files = None
         self._lock = Lock()
 
     def process_file(self, file, rewrite=False, stdin=None):
@@ -112,7 +267,10 @@ class Processor:
         used_types = [f.type for f in self.parser.get_computed_fields()]
         Web.init(Types.text in used_types, Types.html in used_types)
 
+        self.files = FilePool(Path(Config.get_cache_dir()), settings["dialect"])
+
         # start file processing
+        executor = None
         try:
             if stdin:
                 source_stream = stdin
@@ -125,59 +283,70 @@ class Processor:
             if parser.external_stdout:
                 settings["target_file"] = 2
             # with open(file, "r") as sourceF:
-            reader = csvreader(
-                source_stream, skipinitialspace=parser.is_pandoc, dialect=parser.dialect
-            )
-            if parser.has_header:  # skip header
-                reader.__next__()
-                if parser.is_pandoc:  # second line is just first line underlining
-                    reader.__next__()
+            reader = self._get_reader(source_stream)
+            asks_whois = self._asks_whois(settings)  # before the lambdas get precomputed
+            if batch := parser.env.whois.prefetch:
+                with nullcontext(stdin) if stdin else open(file, "r") as stream:
+                    self._prefetch_whois(self._get_reader(stream), settings, batch)
+            if threads := parser.env.process.precompute:
+                with nullcontext(stdin) if stdin else open(file, "r") as stream:
+                    self._precompute(
+                        self._get_reader(stream),
+                        settings,
+                        10 if threads is True else int(threads),
+                    )
+            if batch := parser.env.whois.concurrent_batch:
+                # the IPs for the bulk whois are sent by these batches too
+                reader = self._resolve_whois_in_batches(reader, settings, batch)
+            elif BulkWhois.server() and not parser.env.whois.prefetch:
+                reader = self._resolve_bulk_in_batches(reader, settings, self.bulk_batch)
 
             # prepare thread processing
-            threads = []
             t = self.parser.env.process.threads
             if t == "auto":
-                # XX since threads are experimental, make this disable threads
-                # In the future, enable it when using DNS and disable when using WHOIS (that may lead to duplicite calls)
-                thread_count = 0
+                # the rows wait for the network, overlap them (concurrent WHOIS calls for the same network are coalesced)
+                thread_count = 10 if self._waits_for_network() else 0
             elif type(t) is bool:
                 thread_count = 10 if t else 0
             else:
                 thread_count = int(t)
 
-            if thread_count:
-                q = Queue(maxsize=thread_count + 2)
-
-                def x():
-                    while True:
-                        m = q.get()
-                        if m is False:  # kill signal received
-                            q.task_done()
-                            return
-                        parser.line_count += 1
-                        self.process_line(parser, m, settings)
-                        q.task_done()
-
-                for index in range(thread_count):
-                    t = Thread(target=x, daemon=True)
-                    # prepend zeroes; 10 threads ~ 01..10, 100 threads ~ 001..100
-                    t.name = "0" * (len(str(thread_count)) - len(str(index + 1))) + str(
-                        index + 1
+            # The threads or processes compute the added columns ahead.
+            # The rows are filtered and written by this thread in the input order, as without them.
+            if process_count := parser.env.process.processes:
+                # CPU-bound fields, the batches of rows are shipped to the processes
+                pool = _Worker.start(process_count, settings, asks_whois)
+                ordered = _Worker.folding(
+                    self._compute_ahead(
+                        reader,
+                        settings,
+                        partial(self._submit_forked, pool),
+                        process_count * 4 * _Worker.batch_size,
+                        _Worker.batch_size,
                     )
-                    t.start()
-                    threads.append(t)
+                )
+                executor = _Worker.executor
+            elif thread_count:
+                # I/O-bound fields, overlapping the slow DNS/WHOIS/web calls
+                executor = ThreadPoolExecutor(thread_count, thread_name_prefix="row")
+                ordered = self._compute_ahead(
+                    reader,
+                    settings,
+                    lambda rows: executor.submit(self._compute_rows, rows, settings),
+                    thread_count * 4,
+                )
+            else:
+                ordered = ((row, None) for row in reader)
 
             inf.start()
+            memo.take_stats()  # count from now on, not the previews
 
-            for row in reader:
+            for row, computed in ordered:
                 try:
                     if not row:  # skip blank
                         continue
-                    if thread_count:
-                        q.put(row)
-                    else:
-                        parser.line_count += 1
-                        self.process_line(parser, row, settings)
+                    parser.line_count += 1
+                    self.process_line(parser, row, settings, computed=computed)
                 except BdbQuit:
                     print("Interrupted.")
                     raise
@@ -204,44 +373,22 @@ class Processor:
                         )
                         Config.get_debugger().set_trace()
                     elif o == "s":
-                        continue  # skip to the next line XXmaybe this is not true for threads
+                        continue  # skip to the next line
                     elif o == "e":  # end processing now
-                        if thread_count:
-                            try:
-                                while q.get_nowait():  # empty remaining queue
-                                    pass
-                            except Empty:
-                                pass
-                            [q.put(False) for _ in threads]  # send kill signal
-                            [
-                                t.join() for t in threads
-                            ]  # wait the threads to write descriptors
-                        return
+                        return  # the rows computed ahead are cancelled
                     elif o == "q":
                         self._close_descriptors()
                         exit()
                     else:  # continue from last row
                         parser.line_count -= 1  # let's pretend we didn't just do this row before and give it a second chance
-                        if thread_count:
-                            # XX when in threads, task_done was not called to queue so no need to requeuing,
-                            #  Instead, the line is put to invalid rows. At least when I was digging a number of DNS queries
-                            #  that received.
-                            # subprocess.CalledProcessError: Command '['dig', '+short', '-t',
-                            #           'A', '...', '+timeout=1']' died with <Signals.SIGINT: 2>.
-                            # This behaviour was not observed without threads, instead, a KeyboardInterrupt was produced.
-                            continue
+                        # XX when in threads, the interrupt might have hit a computation running ahead,
+                        #  ex: subprocess.CalledProcessError: Command '['dig', '+short', '-t',
+                        #           'A', '...', '+timeout=1']' died with <Signals.SIGINT: 2>.
+                        #  Computing the row again here, without threads.
                         self.process_line(parser, row, settings)
 
-            # join threads
-            while True:
-                try:
-                    [q.put(False) for _ in threads]  # send kill signal
-                    [t.join() for t in threads]  # wait the threads to write descriptors
-                    break
-                except KeyboardInterrupt:
-                    print(
-                        "Cannot keyboard interrupt now, all events were sent to threads."
-                    )
+            if report := memo.report(memo.take_stats()):
+                logger.info(report)
 
             # after processing changes
             if settings[
@@ -269,6 +416,8 @@ class Processor:
                     w.writerow(header)
                     [w.writerow(r) for r in rows]
         finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
             inf.stop()
             if not stdin:
                 source_stream.close()
@@ -324,10 +473,336 @@ class Processor:
                 ]
         inf.write_statistics()
 
+    def _get_reader(self, stream):
+        parser = self.parser
+        reader = csvreader(
+            stream, skipinitialspace=parser.is_pandoc, dialect=parser.dialect
+        )
+        if parser.has_header:  # skip header
+            next(reader, None)
+            if parser.is_pandoc:  # second line is just first line underlining
+                next(reader, None)
+        return reader
+
+    def _waits_for_network(self) -> bool:
+        """Whether a field is computed by a conversion waiting for the network (WHOIS, DNS, nmap, web)."""
+        for f in self.parser.get_computed_fields():
+            path = graph.dijkstra(f.type, start=f.source_type) or []
+            for edge in zip(path, path[1:]):
+                if (
+                    memoized.get(edge)
+                    or methods.get(edge) in whois_lookups
+                    or Types.web in edge
+                ):
+                    return True
+        return False
+
+    @staticmethod
+    def _asks_whois(settings) -> bool:
+        """Whether a field may ask WHOIS."""
+        return any(
+            l in whois_lookups
+            for _, _, lambdas in settings["addByMethod"]
+            for l in lambdas
+        )
+
+    @staticmethod
+    def _get_ip_methods(settings):
+        """The lambdas computing the IP that enters Whois or the bulk whois,
+        ex: [(20, [url_hostname, hostname_ip], False), (20, [], True), ...]
+        """
+        lookups = (Whois, *(bulk_lookups if BulkWhois.server() else ()))
+        ip_methods = []
+        for _, col_i, lambdas in settings["addByMethod"]:
+            for i, l in enumerate(lambdas):
+                if l in lookups:
+                    ip_methods.append((col_i, lambdas[:i], l is not Whois))
+                    break
+        return ip_methods
+
+    def _prefetch_whois(self, reader, settings, batch):
+        """Resolve the WHOIS of the distinct IPs of the whole file before the rows are processed.
+
+        The IPs are resolved in batches in their numerical order. A batch starts by dropping the IPs
+        whose prefix the previous batches have already found, so that the IPs of the same block cost a single query.
+        The IPs for the bulk whois (see `whois.bulk`) are sent to it all at once.
+        """
+        if not (ip_methods := self._get_ip_methods(settings)):
+            return
+        ips, bulk_ips = self._compute_ips(reader, ip_methods)
+        ips = sorted(ips, key=_ip_order)
+        if bulk_ips:
+            BulkWhois.resolve(sorted(bulk_ips, key=_ip_order))
+        if not ips:
+            return
+        if Config.verbosity <= logging.INFO:
+            print(f"Prefetching WHOIS of {len(ips)} distinct IPs...")
+        resolver = WhoisResolver(self.parser.env.whois.concurrency)
+        try:
+            for i in range(0, len(ips), batch):
+                resolver.resolve(ips[i : i + batch])
+        except KeyboardInterrupt:
+            logger.warning(
+                "WHOIS prefetch interrupted, the rows will be resolved one by one."
+            )
+
+    def _resolve_whois_in_batches(self, reader, settings, batch):
+        """Yield the rows back, once the WHOIS of the whole batch of rows has been resolved concurrently."""
+        ip_methods = self._get_ip_methods(settings)
+        if not ip_methods:
+            yield from reader
+            return
+        resolver = WhoisResolver(self.parser.env.whois.concurrency)
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) >= batch:
+                self._resolve_rows(resolver, rows, ip_methods)
+                yield from rows
+                rows.clear()
+        self._resolve_rows(resolver, rows, ip_methods)
+        yield from rows
+
+    def _resolve_bulk_in_batches(self, reader, settings, batch):
+        """Yield the rows back, once the bulk whois has been asked about the IPs of the whole batch of rows."""
+        ip_methods = [m for m in self._get_ip_methods(settings) if m[2]]
+        if not ip_methods:
+            yield from reader
+            return
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) >= batch:
+                BulkWhois.resolve(self._compute_ips(rows, ip_methods)[1])
+                yield from rows
+                rows.clear()
+        BulkWhois.resolve(self._compute_ips(rows, ip_methods)[1])
+        yield from rows
+
+    def _resolve_rows(self, resolver, rows, ip_methods):
+        ips, bulk_ips = self._compute_ips(rows, ip_methods)
+        BulkWhois.resolve(bulk_ips)
+        try:
+            resolver.resolve(ips)
+        except KeyboardInterrupt:
+            logger.warning(
+                "Concurrent WHOIS interrupted, the rows will be resolved one by one."
+            )
+
+    @classmethod
+    def _compute_ips(cls, rows, ip_methods):
+        """The distinct IPs the rows will ask Whois about and the ones they will ask the bulk whois about."""
+        ips, bulk_ips = {}, {}  # dicts keep the order
+        for row in rows:
+            for col_i, lambdas, bulk in ip_methods:
+                try:
+                    val = cls._apply(row[col_i], lambdas)
+                except Exception:
+                    continue  # invalid row, will be handled by the row processing
+                for ip in val if isinstance(val, list) else [val]:
+                    if ip:
+                        (bulk_ips if bulk else ips)[str(ip)] = None
+        return list(ips), list(bulk_ips)
+
+    @classmethod
+    def _compute_rows(
+        cls, rows: list, settings: Settings
+    ) -> list[tuple[Optional[list], Optional[Exception]]]:
+        """(added fields, None) or (None, the exception raised) for every row"""
+        outcomes = []
+        for row in rows:
+            try:
+                outcomes.append((cls._compute(row, settings), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+
+    @classmethod
+    def _compute(cls, line: List, settings: Settings) -> list:
+        """Values of the added fields of the line. Does not touch the processor state, safe in threads."""
+        fields = list(line)
+        for _, col_i, lambdas in settings[
+            "addByMethod"
+        ]:  # [("netname", 20, [lambda x, lambda x...]), ...]
+            fields.append(cls._apply(fields[col_i], lambdas))
+        return fields[len(line) :]
+
+    @staticmethod
+    def _apply(val, lambdas):
+        for l in lambdas:
+            if isinstance(val, list):
+                # resolve all items, while flattening any list encountered
+                val = [
+                    y
+                    for x in (l(v) for v in val)
+                    for y in (x if type(x) is list else [x])
+                ]
+            else:
+                val = l(val)
+        return val
+
+    def _precompute(self, reader, settings: Settings, threads: int):
+        """Phase one of the two-phase processing: compute every distinct source value of the added fields once.
+
+        The distinct values of the source columns are collected from the whole file (the pre-filtered rows skipped)
+        and computed in threads. A field computed from another added field gets the distinct results of that one.
+        The lambdas of the fields are then replaced by the lookups of the results,
+        the rows are processed with dictionary lookups only.
+        The distinct values and their results are held in memory.
+        """
+        width = len(self.parser.first_line_fields)
+        add = settings["addByMethod"]
+        distinct = {col_i: {} for _, col_i, _ in add if col_i < width}
+        for row in reader:
+            if len(row) != width or any(
+                (ne if include else eq)(val, row[col_i])
+                for include, col_i, val in settings["f_pre"]
+            ):
+                continue
+            for col_i, values in distinct.items():
+                values[row[col_i]] = None
+
+        tables: dict[int, dict] = {}
+        "column => {source value: (result, None) or (None, exception raised)}"
+        with ThreadPoolExecutor(threads, thread_name_prefix="precompute") as executor:
+            for i, (name, col_i, lambdas) in enumerate(add):
+                if col_i < width:
+                    values = list(distinct[col_i])
+                elif (
+                    col_i not in tables
+                    or (values := self._distinct_results(tables[col_i])) is None
+                ):
+                    continue  # computed row by row
+                if Config.verbosity <= logging.INFO:
+                    print(f"Precomputing {len(values)} distinct values of {name}...")
+                table = tables[width + i] = {}
+                for j in range(0, len(values), self.precompute_batch):
+                    batch = values[j : j + self.precompute_batch]
+                    table.update(
+                        zip(batch, executor.map(partial(self._outcome, lambdas), batch))
+                    )
+                add[i] = name, col_i, (partial(self._look_up, table, lambdas),)
+
+    @staticmethod
+    def _distinct_results(table: dict) -> Optional[list]:
+        """The distinct results of a precomputed field (the list items flattened), None if they are not hashable."""
+        values = {}
+        try:
+            for result, e in table.values():
+                if not e:
+                    for v in result if isinstance(result, list) else (result,):
+                        values[v] = None
+        except TypeError:
+            return None
+        return list(values)
+
+    @classmethod
+    def _outcome(cls, lambdas, val):
+        try:
+            return cls._apply(val, lambdas), None
+        except Exception as e:
+            return None, e
+
+    @classmethod
+    def _look_up(cls, table: dict, lambdas, val):
+        """The precomputed result of the value. The exception raised when computing it is raised again."""
+        try:
+            result, e = table[val]
+        except (KeyError, TypeError):  # the value was not met in phase one
+            return cls._apply(val, lambdas)
+        if e:
+            raise e.with_traceback(None)
+        return result.copy() if isinstance(result, list) else result
+
+    def _compute_ahead(
+        self,
+        reader,
+        settings: Settings,
+        submit: Callable[[list], Future],
+        window: int,
+        batch_size=1,
+    ):
+        """Yield (row, Future of its added fields) in the input order while the following rows are being computed.
+        At most `window` rows are computed ahead; a slow row holds back the rows behind it till it is written.
+        The rows going to be pre-filtered out or skipped as duplicates of a unique column are not computed.
+
+        :param submit: Start computing the rows, return the Future of their `_compute_rows` outcomes.
+        :param batch_size: Rows submitted at once. Must be lower than the window.
+        """
+        pending: deque[tuple[list, Optional[Future]]] = deque()
+        batch: list[tuple[list, Future]] = []
+        unique = defaultdict(set)
+        "the values of the unique columns met, as `process_line` will have them"
+        for row in reader:
+            if (
+                not row
+                or len(row) != len(self.parser.first_line_fields)
+                or any(
+                    (ne if include else eq)(val, row[col_i])
+                    for include, col_i, val in settings["f_pre"]
+                )
+                or any(row[u] in unique[u] for u in settings["u_pre"])
+            ):
+                pending.append((row, None))
+            else:
+                for u in settings["u_pre"]:
+                    unique[u].add(row[u])
+                pending.append((row, Future()))
+                batch.append(pending[-1])
+                if len(batch) >= batch_size:
+                    self._submit_batch(submit, batch)
+                    batch = []
+            if len(pending) >= window:
+                yield pending.popleft()
+        if batch:
+            self._submit_batch(submit, batch)
+        while pending:
+            yield pending.popleft()
+
+    @staticmethod
+    def _submit_batch(submit: Callable[[list], Future], batch: list[tuple[list, Future]]):
+        """Resolve the Future of every row of the batch when the batch is computed."""
+
+        def done(future: Future):
+            try:
+                outcomes = future.result()
+            except Exception as e:  # ex: the worker process died
+                outcomes = [(None, e)] * len(batch)
+            for (_, computed), (values, exception) in zip(batch, outcomes):
+                if exception:
+                    computed.set_exception(exception)
+                else:
+                    computed.set_result(values)
+
+        submit([row for row, _ in batch]).add_done_callback(done)
+
+    def _submit_forked(self, executor: ProcessPoolExecutor, rows: list) -> Future:
+        """Compute the rows in a worker process, pass its WHOIS findings to be folded when done
+        (see `_Worker.folding`)."""
+        computed = Future()
+
+        def done(future: Future):
+            try:
+                outcomes, findings = future.result()
+            except Exception as e:
+                computed.set_exception(e)
+                return
+            _Worker.received.append(findings)  # before the rows are written
+            computed.set_result(outcomes)
+
+        executor.submit(_Worker.compute, rows).add_done_callback(done)
+        return computed
+
+    @property
+    def descriptors_count(self):
+        return len(self.files) if self.files is not None else 0
+
     def _close_descriptors(self):
         """Descriptors have to be closed (flushed)"""
         for f in self.descriptors.values():
             f[0].close()
+        if self.files is not None:
+            self.files.close()
 
     def process_line(
         self,
@@ -335,9 +810,11 @@ class Processor:
         line: List,
         settings: Settings,
         fields: Union[Tuple, List] = None,
+        computed: Future[list] = None,
     ):
         """
         Parses line – compute fields while adding, perform filters, pick or delete cols, split and write to a file.
+        :param computed: The added fields being computed ahead by a thread.
         """
         try:
             add = False
@@ -366,24 +843,9 @@ class Processor:
 
             # add fields
             if add:
-                list_lengths = []
-                for _, col_i, lambdas in settings[
-                    "addByMethod"
-                ]:  # [("netname", 20, [lambda x, lambda x...]), ...]
-                    val = fields[col_i]
-                    for l in lambdas:
-                        if isinstance(val, list):
-                            # resolve all items, while flattening any list encountered
-                            val = [
-                                y
-                                for x in (l(v) for v in val)
-                                for y in (x if type(x) is list else [x])
-                            ]
-                        else:
-                            val = l(val)
-                    fields.append(val)
-                    if isinstance(val, list):
-                        list_lengths.append(len(val) or 1)
+                values = computed.result() if computed else self._compute(line, settings)
+                fields.extend(values)
+                list_lengths = [len(val) or 1 for val in values if isinstance(val, list)]
                 if (
                     list_lengths
                 ):  # duplicate rows because we received lists amongst scalars
@@ -524,34 +986,25 @@ class Processor:
             # print("File created", location, parser.delimiter.join(chosen_fields))
             parser.files_created.add(location)
 
-        # choose the right file descriptor for saving
-        # (we do not close descriptors immediately, if needed we close the one the least used)
-        if location not in self.descriptorsStatsOpen:
-            if (
-                self.descriptors_count >= self.descriptors_max
-            ):  # too many descriptors open, we have to close the least used
-                key = min(self.descriptorsStatsOpen, key=self.descriptorsStatsOpen.get)
-                self.descriptors[key][0].close()
-                del self.descriptorsStatsOpen[key]
-                self.descriptors_count -= 1
-
-            if (
-                location == 2
-            ):  # this is a sign that we store raw data to stdout (not through a CSVWriter)
-                t = w = (
-                    parser.external_stdout
-                )  # custom object simulate CSVWriter - it adopts .writerow and .close methods
-            else:
-                if location == 1:  # this is a sign we output csv data to stdout
+        if location in (1, 2):
+            # the data are output to stdout
+            if location not in self.descriptors:
+                if location == 2:  # this is a sign that we store raw data to stdout (not through a CSVWriter)
+                    t = w = (
+                        parser.external_stdout
+                    )  # custom object simulate CSVWriter - it adopts .writerow and .close methods
+                else:  # this is a sign we output csv data to stdout
                     t = io.StringIO()
-                else:
-                    t = open(Path(Config.get_cache_dir(), location), method)
-                w = csvwriter(t, dialect=settings["dialect"])
-            self.descriptors[location] = t, w
-            self.descriptors_count += 1
-        self.descriptorsStatsAll[location] += 1
-        self.descriptorsStatsOpen[location] = self.descriptorsStatsAll[location]
-        f = self.descriptors[location]
+                    w = csvwriter(t, dialect=settings["dialect"])
+                self.descriptors[location] = t, w
+            t, w = self.descriptors[location]
+            write, writerow = t.write, w.writerow
+        else:
+            if method == "w":
+                self.files.truncate(location)
+            # the file is written through a buffer, see FilePool
+            write = partial(self.files.write, location)
+            writerow = partial(self.files.writerow, location)
         with self._lock:
             if method == "w" and settings["header"]:
                 # write original header (stored unchanged in parser.first_line_fields) if line to be reprocessed or modified header
@@ -560,7 +1013,7 @@ class Processor:
                     Config.UNKNOWN_NAME,
                     Config.QUEUED_NAME,
                 ):
-                    f[1].writerow(parser.first_line_fields)
+                    writerow(parser.first_line_fields)
                 else:
-                    f[0].write(parser.header)
-            f[1].writerow(chosen_fields)
+                    write(parser.header)
+            writerow(chosen_fields)
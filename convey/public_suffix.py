@@ -0,0 +1,28 @@
+from functools import lru_cache
+
+from tldextract import TLDExtract
+
+_extract = TLDExtract(cache_dir=None, suffix_list_urls=())
+""" Public Suffix List trie built from the snapshot bundled with tldextract.
+The list is neither fetched from the network nor cached on the disk,
+so that the extraction does not depend on the connectivity. """
+
+
+@lru_cache(maxsize=100_000)
+def split(hostname: str) -> tuple[str, str, str]:
+    """(subdomain, domain, public suffix), ex: 'www.example.co.uk' -> ('www', 'example', 'co.uk')
+    The hostnames in feeds repeat a lot, the results are memoized.
+    """
+    result = _extract(hostname)
+    return result.subdomain, result.domain, result.suffix
+
+
+def registered_domain(hostname: str) -> str:
+    """ex: website.xyz.com.br -> xyz.com.br, com.br -> ''"""
+    _, domain, suffix = split(hostname)
+    return f"{domain}.{suffix}" if domain and suffix else ""
+
+
+def public_suffix(hostname: str) -> str:
+    """ex: website.xyz.com.br -> com.br"""
+    return split(hostname)[2]
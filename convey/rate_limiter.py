@@ -0,0 +1,137 @@
+from threading import Lock
+from time import monotonic, sleep
+
+# registry server => the name used in the `whois.concurrency` and `whois.rate_limits` options
+registries = {
+    "whois.ripe.net": "ripe",
+    "whois.arin.net": "arin",
+    "whois.lacnic.net": "lacnic",
+    "whois.apnic.net": "apnic",
+    "whois.afrinic.net": "afrinic",
+}
+
+
+def registry_name(server: str) -> str:
+    """ "whois.ripe.net -B" => "ripe", unknown servers => "other" """
+    return registries.get(server.split(" ", 1)[0].split(":", 1)[0], "other")
+
+
+class TokenBucket:
+    """Let through at most `rate` requests per second, with a burst of `burst` requests.
+
+    Implemented as the equivalent virtual scheduling algorithm: instead of counting the tokens,
+    we keep the time the next request is due. Every caller reserves its slot under the lock
+    and then sleeps outside of it, so that the waiting threads are served in order.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self._due = 0.0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Block till a request may be sent."""
+        with self._lock:
+            now = monotonic()
+            due = max(self._due, now)
+            self._due = due + self.interval
+        if (wait := due - self.tolerance - now) > 0:
+            sleep(wait)
+
+    def pause(self, seconds: float):
+        """Let no request through for the given time, ex: when the server complains about the rate."""
+        with self._lock:
+            self._due = max(self._due, monotonic() + seconds + self.tolerance)
+
+
+class RateLimiter:
+    """Pace the queries to the WHOIS servers to stay under the registries' limits.
+    Every known registry has its own bucket, every other server has its own bucket with the "other" limit.
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        """
+        :param limits: registry name => queries per minute, 0 ~ unlimited, ex: {"lacnic": 8, "other": 120}
+        """
+        self.limits = limits
+        self.buckets: dict[str, TokenBucket] = {}
+        self._lock = Lock()
+
+    def paces(self, registry: str) -> bool:
+        return self.limits.get(registry, 0) > 0
+
+    def wait(self, server: str):
+        """Block till a query to the server may be sent."""
+        if bucket := self._get_bucket(server):
+            bucket.acquire()
+
+    def pause(self, server: str, seconds: float):
+        if bucket := self._get_bucket(server):
+            bucket.pause(seconds)
+
+    def _get_bucket(self, server):
+        name = registry_name(server)
+        key = name if name != "other" else server.split(" ", 1)[0]
+        with self._lock:
+            if key not in self.buckets:
+                rate = self.limits.get(name, 0)
+                # burst of one second worth of queries
+                self.buckets[key] = (
+                    TokenBucket(rate / 60, int(rate // 60)) if rate > 0 else None
+                )
+            return self.buckets[key]
+
+
+class ServerUnavailable(OSError):
+    pass
+
+
+class CircuitBreaker:
+    """Stop asking a server that keeps failing.
+
+    After `threshold` consecutive failures (the server is unreachable, refuses or times out), the circuit opens:
+    the queries to the server fail immediately instead of waiting for the timeout.
+    After a cooldown, a single query is let through; if it fails again, the cooldown doubles (up to `max_cooldown`),
+    if it succeeds, the circuit closes.
+    """
+
+    threshold = 3
+    "consecutive failures opening the circuit"
+    cooldown = 30
+    "seconds the circuit stays open for the first time"
+    max_cooldown = 3600
+
+    def __init__(self):
+        self._failures: dict[str, tuple[int, float]] = {}
+        "server => (consecutive failures, time the next query is let through)"
+        self._lock = Lock()
+
+    def check(self, server: str):
+        """:raises ServerUnavailable: The circuit of the server is open."""
+        with self._lock:
+            failures, retry_at = self._failures.get(server, (0, 0))
+            if failures < self.threshold:
+                return
+            now = monotonic()
+            if now >= retry_at:
+                # the trial query; the others wait for its result till the next cooldown
+                self._failures[server] = failures, now + self.cooldown
+                return
+        raise ServerUnavailable(
+            f"{server} skipped after {failures} failures, retrying in {retry_at - now:.0f} s"
+        )
+
+    def failed(self, server: str):
+        with self._lock:
+            failures = self._failures.get(server, (0, 0))[0] + 1
+            cooldown = 0
+            if failures >= self.threshold:
+                cooldown = min(
+                    self.cooldown * 2 ** (failures - self.threshold), self.max_cooldown
+                )
+            self._failures[server] = failures, monotonic() + cooldown
+
+    def succeeded(self, server: str):
+        with self._lock:
+            self._failures.pop(server, None)
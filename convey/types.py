@@ -12,9 +12,11 @@ from enum import IntEnum
 from pathlib import Path
 from quopri import decodestring, encodestring
 from sys import exit
+from time import time
 from typing import TYPE_CHECKING, Callable, List, Union
 from urllib.parse import unquote, quote
 
+from netaddr import AddrFormatError, IPNetwork, IPRange
 from validate_email import validate_email
 
 
@@ -38,8 +40,10 @@ from .checker import Checker
 from .decorators import PickBase, PickMethod, PickInput
 from .graph import Graph
 from .infodicts import phone_country, address_country, country_codes
+from .offline_index import Offline
 from .web import Web
 from .whois import Whois
+from .whois_bulk import BulkWhois
 
 if TYPE_CHECKING:
     from .args_controller import Env
@@ -47,10 +51,67 @@ logger = logging.getLogger(__name__)
 
 types: List["Type"] = []  # all field types
 methods: dict[tuple["Type", "Type"], Callable] = {}
+memoized: dict[tuple["Type", "Type"], bool] = {}
+"(start type, target type) => its results depend on the network (see `memo.memoize`)"
 graph: Graph["Type"] = Graph()
 methods_deleted = {}
 
 
+# The fields of an IP answered locally or by the bulk whois, WHOIS asked only when they have no answer.
+def ip_country(x):
+    return Offline.country(x) or BulkWhois.country(x) or Whois(x).get[5]
+
+
+def ip_asn(x):
+    return Offline.asn(x) or BulkWhois.asn(x) or Whois(x).get[3]
+
+
+def ip_prefix(x):
+    return prefix_range(BulkWhois.prefix(x) or Whois(x).get[0])
+
+
+def prefix_range(prefix) -> str:
+    """The prefix in a single format `first-last`, be it a range or a CIDR (as the bulk whois and some registries give)."""
+    if not prefix:
+        return ""
+    if isinstance(prefix, str):
+        try:
+            prefix = IPNetwork(prefix)
+        except (AddrFormatError, ValueError):
+            return prefix
+    return str(IPRange(prefix[0], prefix[-1]))
+
+
+def ip_as_org(x):
+    return Offline.as_org(x) or BulkWhois.as_org(x) or ""
+
+
+def ip_incident_contact(x):
+    if not (contact := Offline.incident_contact(x)):
+        return Whois(x).get[2]
+    # counted in the statistics as if WHOIS answered
+    country = contact.partition(Config.ABROAD_MARK)[0]
+    Whois.count(x, (None, "abroad", contact, "", "", country, "", int(time())))
+    return contact
+
+
+def hostname_whoisdomain(x):
+    return Whois(ip=None, hostname=x)
+
+
+bulk_lookups = (ip_country, ip_asn, ip_prefix, ip_as_org)
+"conversions from an IP whose IPs are worth sending to the bulk whois beforehand"
+whois_lookups = (
+    Whois,
+    hostname_whoisdomain,
+    ip_country,
+    ip_asn,
+    ip_prefix,
+    ip_incident_contact,
+)
+"conversions that may ask WHOIS"
+
+
 class TypeGroup(IntEnum):
     general = 1
     custom = 2
@@ -273,6 +334,8 @@ class Types:
 
         methods.clear()
         methods.update(Types._get_methods(config))
+        memoized.clear()
+        memoized.update(Types._get_memoized())
         graph.clear()
         [
             graph.add_edge(to, from_)
@@ -382,6 +445,11 @@ class Types:
         "reg_m", TypeGroup.custom, from_message="match from a regular expression"
     )
     netname = Type("netname", TypeGroup.whois)
+    as_org = Type(
+        "as_org",
+        TypeGroup.whois,
+        "Autonomous system organization, from the MMDB databases or the bulk whois. See whois.mmdb, whois.bulk",
+    )
     country = Type("country", TypeGroup.whois)
     registrar_abusemail = Type(
         "registrar_abusemail", TypeGroup.whois, "Abuse e-mail contact from whois"
@@ -719,14 +787,33 @@ class Types:
             ),
             # (t.url, t.ip): Whois.url2ip,
             (t.ip, t.whois): Whois,
-            (t.hostname, t.whoisdomain): lambda x: Whois(ip=None, hostname=x),
+            (t.hostname, t.whoisdomain): hostname_whoisdomain,
             # (t.asn, t.whois): Whois, # XX can be easily allowed, however Whois object will huff there is no IP prefix range
             (t.cidr, t.ip): (
                 Checker.cidr_ips
                 if config.comp.multiple_cidr_ip
                 else lambda x: str(ipaddress.ip_interface(x).ip)
             ),
-            (t.whois, t.prefix): lambda x: str(x.get[0]),
+            **(
+                {  # answered locally or in bulk, WHOIS only when the IP is missing there
+                    (t.ip, t.country): ip_country,
+                    (t.ip, t.asn): ip_asn,
+                }
+                if config.whois.offline or config.whois.mmdb or config.whois.bulk
+                else {}
+            ),
+            **(
+                {(t.ip, t.incident_contact): ip_incident_contact}
+                if config.whois.offline or config.whois.mmdb
+                else {}
+            ),
+            **({(t.ip, t.prefix): ip_prefix} if config.whois.bulk else {}),
+            **(
+                {(t.ip, t.as_org): ip_as_org}
+                if config.whois.mmdb or config.whois.bulk
+                else {}
+            ),
+            (t.whois, t.prefix): lambda x: prefix_range(x.get[0]),
             (t.whois, t.asn): lambda x: x.get[3],
             (t.whois, t.abusemail): lambda x: x.get[6],
             (t.whoisdomain, t.registrar_abusemail): lambda x: x.get[6],
@@ -800,6 +887,45 @@ class Types:
             (t.plaintext, t.unit): Checker.unit_expand,
         }
 
+    @staticmethod
+    def _get_memoized():
+        """The edges whose results are remembered (see `memo.EdgeMemo`) => whether they depend on the network.
+        They are slow (DNS, nmap, parsing) while their values repeat among the rows.
+        The results of DNS and nmap may change, they expire (see `--memo-ttl`), the parsing ones do not.
+        WHOIS and web have their own caches and count their statistics for every row, they are not memoized.
+        Neither are the edges picking a method or an input (PickBase), their results depend on the option chosen.
+        """
+        t = Types
+        parsing = (
+            (t.any_ip, t.ip),
+            (t.port_ip, t.ip),
+            (t.port_ip, t.port),
+            (t.url, t.hostname),
+            (t.url, t.port),
+            (t.cidr, t.ip),
+            (t.wrong_url, t.url),
+            (t.country_name, t.country),
+            (t.phone, t.country),
+            (t.prefix, t.cidr),
+            (t.timestamp, t.isotimestamp),
+            (t.timestamp, t.date),
+            (t.timestamp, t.time),
+        )
+        network = (
+            (t.hostname, t.ip),
+            (t.ip, t.hostname),
+            (t.hostname, t.ports),
+            (t.ip, t.ports),
+            (t.hostname, t.spf),
+            (t.hostname, t.txt),
+            (t.hostname, t.a),
+            (t.hostname, t.aaaa),
+            (t.hostname, t.ns),
+            (t.hostname, t.mx),
+            (t.hostname, t.dmarc),
+        )
+        return {**dict.fromkeys(parsing, False), **dict.fromkeys(network, True)}
+
 
 def get_module_from_path(path):
     if not Path(path).is_file():
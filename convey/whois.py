@@ -2,15 +2,19 @@ import logging
 import re
 from datetime import datetime, timedelta
 from subprocess import PIPE, Popen
-from time import time, sleep
+from threading import Event, Lock
+from time import monotonic, time, sleep
 from typing import Literal
 
-from netaddr import IPRange, IPNetwork
-from tldextract import tldextract
+from netaddr import AddrFormatError, IPAddress, IPRange, IPNetwork
 
 from .contacts import Contacts
 from .config import Config, subprocess_env
 from .infodicts import address_country_lowered
+from .public_suffix import registered_domain
+from .rate_limiter import CircuitBreaker, RateLimiter, ServerUnavailable
+from .whois_client import REFERRAL_MARK, WhoisClient
+from .whois_parser import ParsedResponse, email_regex, reAbuse
 
 logger = logging.getLogger(__name__)
 
@@ -65,7 +69,16 @@ class Whois:
     unknown_mode: bool
     quota: Quota
     queued_ips: set
+    limiter: RateLimiter
+    breaker: CircuitBreaker
+    program_servers: dict
     see: int
+    inflight: dict
+    inflight_lock = Lock()
+    failures: dict
+    failure_backoff = 10
+    "seconds the network of a failed query is not asked, doubles with every failure in a row"
+    failure_backoff_max = 3600
 
     @classmethod
     def init(
@@ -80,8 +93,21 @@ class Whois:
         cls.unknown_mode = unknown_mode  # if True, we use b flag in abusemails
         cls.slow_mode = slow_mode  # due to LACNIC quota
         cls.queued_ips = set()
+        cls.inflight = {}  # network => Event set when the WHOIS query ends
+        cls.failures = {}  # network => (failures in a row, time it may be asked again)
+        cls.domains = {}  # registered domain => AnalysisResult
         cls.ttl = Config.get_env().whois.ttl
+        cls.domain_ttl = Config.get_env().whois.domain_ttl
+        cls.archive = Config.get_env().whois.archive
         cls.see = Config.verbosity <= logging.INFO
+        cls.limiter = RateLimiter(Config.get_env().whois.rate_limits)
+        cls.breaker = CircuitBreaker()  # skips the servers that keep failing
+        cls.program_servers = {}  # IANA block or TLD => the registry the `whois` program asked first
+        cls.client = (
+            WhoisClient(cls.limiter, cls.breaker)
+            if Config.get_env().whois.native
+            else None
+        )
         if mirr := Config.get_env().whois.mirror:  # try a fast local whois-mirror first
             cls.servers["mirror"] = mirr
         cls.servers["general"] = None
@@ -90,11 +116,17 @@ class Whois:
         #                      ["whois.ripe.net -r", "whois.arin.net", "whois.lacnic.net", "whois.apnic.net", "whois.afrinic.net"]):
         #     Whois.servers[name] = val
 
-    def __init__(self, ip, hostname=None):
-        """Access self.get for AnalyzisResult."""
+    def __init__(self, ip, hostname=None, replay: list = None):
+        """Access self.get for AnalyzisResult.
+        :param replay: Archived exchanges (see `self.exchanges`) to analyze again instead of querying the servers.
+        """
         self.ip = ip
         self.hostname = hostname
         self.whois_response = []
+        self.parsed = ParsedResponse([])
+        self.exchanges = list(replay or ())
+        "[(server, server_url, response)] the result is analyzed from"
+        self.replay = list(self.exchanges) if replay is not None else None
 
         if self.hostname:
             if len(self.hostname.split(".")) > 2:
@@ -102,27 +134,41 @@ class Whois:
             else:
                 self.hostname_registerable = self.hostname
 
-        if self.ip:
-            prefix = self.cache_load()  # try load prefix from earlier WHOIS responses
-            if prefix:
-                if (self.ttl != -1 and self.get[7] + self.ttl < time()) or (
-                    Whois.unknown_mode and not self.get[6]
-                ):
-                    # the TTL is too old, we cannot guarantee IP stayed in the same prefix, let's get rid of the old results
-                    # OR we are in unknown_mode which means we want abusemail. If not here, maybe another IP claimed
-                    # a range superset without abuse e-mail. Delete this possible superset
-                    # We do not have to call now `self.get = None; del self.ip_seen[ip]` if there is no need to be thread safe,
-                    #   these lines will be called at the function end.
-                    del self.ranges[prefix]
-                else:
-                    self.count_stats()
+        cached = self.replay is None and (self.ip or self.hostname)
+        if cached:
+            if self._load_cached():
+                return
+            # Single-flight: if another thread is resolving an IP from the same network (or the same domain),
+            # wait for its result instead of issuing our own query; the result may cover our IP too.
+            key = self._inflight_key()
+            while True:
+                with Whois.inflight_lock:
+                    pending = Whois.inflight.get(key)
+                    if not pending:
+                        Whois.inflight[key] = Event()
+                        break
+                pending.wait()
+                if self._load_cached():
                     return
 
+        try:
+            self._resolve()
+        finally:
+            if cached:
+                with Whois.inflight_lock:
+                    Whois.inflight.pop(key).set()
+
+    def _resolve(self):
         if self.see:
             print(
                 f"Whois {self.ip or self.hostname_registerable}... ", end="", flush=True
             )
-        if Whois.slow_mode:
+        if (
+            Whois.slow_mode
+            and self.replay is None
+            and not (self.client and self.limiter.paces("lacnic"))
+        ):
+            # (the native client paces the LACNIC queries itself)
             if self.see:
                 print("waiting 7 seconds... ", end="", flush=True)
             sleep(7)
@@ -131,13 +177,74 @@ class Whois:
             print(get[2] or "no incident contact.")
         prefix = get[0]
         if not prefix and self.ip:
-            logger.info(f"No prefix found for IP {ip}")
+            logger.info(f"No prefix found for IP {self.ip}")
         elif prefix:
-            self.ip_seen[ip] = prefix
+            self.ip_seen[self.ip] = prefix
             self.ranges[prefix] = get
+            if Whois.archive and self.exchanges and self.ip:
+                self.ranges.archive(prefix, self.ip, self.exchanges)
+        if not self.ip and self.replay is None:
+            domain = self.hostname_registerable
+            Whois.domains[domain] = get
+            if (store := self.ranges.store) is not None:
+                store.put_domain(domain, get)
 
         self.count_stats()
 
+    def _load_cached(self):
+        """Try to load the prefix from earlier WHOIS responses.
+        :return: True if the cached result is valid.
+        """
+        if not self.ip:
+            return self._load_cached_domain()
+        prefix = self.cache_load()
+        if prefix:
+            if (self.ttl != -1 and self.get[7] + self.ttl < time()) or (
+                Whois.unknown_mode and not self.get[6]
+            ):
+                # the TTL is too old, we cannot guarantee IP stayed in the same prefix, let's get rid of the old results
+                # OR we are in unknown_mode which means we want abusemail. If not here, maybe another IP claimed
+                # a range superset without abuse e-mail. Delete this possible superset
+                # We do not have to call now `self.get = None; del self.ip_seen[ip]`,
+                #   these lines will be called at the end of the resolving.
+                try:
+                    del self.ranges[prefix]
+                except KeyError:  # another thread has just deleted it
+                    pass
+            else:
+                self.count_stats()
+                return True
+        return False
+
+    def _load_cached_domain(self):
+        """Try to load the registered domain from earlier WHOIS responses.
+        Many hostnames share the same registered domain, it is asked just once per `domain_ttl`.
+        :return: True if the cached result is valid.
+        """
+        domain = self.hostname_registerable
+        get = Whois.domains.get(domain)
+        if get is None and (store := self.ranges.store) is not None:
+            get = store.find_domain(domain)
+        if get is None:
+            return False
+        if self.domain_ttl != -1 and get[7] + self.domain_ttl < time():
+            return False  # expired, will be asked again and overwritten
+        Whois.domains[domain] = self.get = get
+        return True
+
+    def _inflight_key(self):
+        """Network the IP belongs to (/24 for IPv4, /48 for IPv6), standing for its prefix which is not known yet.
+        These are the most specific blocks routed globally, WHOIS prefixes are rarely more specific. If they are,
+        the waiting IP does not fall in the resolved prefix and queries in its turn.
+        """
+        if not self.ip:
+            return "domain", self.hostname_registerable
+        try:
+            ip = IPAddress(self.ip)
+        except (AddrFormatError, ValueError):
+            return self.ip
+        return ip.version, int(ip) >> (8 if ip.version == 4 else 80)
+
     def cache_load(self):
         if self.ip in self.ip_seen:  # ip has been seen in the past
             prefix = self.ip_seen[self.ip]
@@ -147,47 +254,48 @@ class Whois:
             return prefix
         elif self.ip in self.queued_ips:
             raise self.quota.QuotaExceeded
-        for prefix in self.ranges:
-            # search for prefix the slow way. I dont know how to make this shorter because IP can be in shortened form so that
-            # in every case I had to put it in full form and then slowly compare strings with prefixes.
-            if prefix and self.ip in prefix:
-                self.get = self.ranges[prefix]
-                self.ip_seen[self.ip] = prefix
-                return prefix
+        prefix = self.ranges.find(self.ip)  # binary search in the sorted prefix bounds
+        if prefix is not None:
+            self.get = self.ranges[prefix]
+            self.ip_seen[self.ip] = prefix
+            return prefix
 
     def count_stats(self):
-        self.csvstats["ip_unique"].add(self.ip)
-        mail = self.get[6]
-        contact = self.get[2]
-        reg = self.get[1]
+        self.count(self.ip, self.get)
+        if not self.get[6] and Config.get_env().whois.reprocessable_unknown:
+            raise UnknownValue
+
+    @classmethod
+    def count(cls, ip, get: AnalysisResult):
+        """Count the IP in the statistics. The prefix of a result not coming from WHOIS may be unknown (None)."""
+        cls.csvstats["ip_unique"].add(ip)
+        mail = get[6]
+        reg = get[1]
         known = "known" if mail else "unknown"
-        self.csvstats[f"ip_{reg}_{known}"].add(self.ip)
-        self.csvstats[f"prefix_{reg}_{known}"].add(self.get[0])
+        cls.csvstats[f"ip_{reg}_{known}"].add(ip)
+        if get[0]:
+            cls.csvstats[f"prefix_{reg}_{known}"].add(get[0])
 
         if mail:
-            self.csvstats[f"abusemail_{reg}"].add(mail)
+            cls.csvstats[f"abusemail_{reg}"].add(mail)
 
         if reg == "abroad":
-            country = self.get[5]
+            country = get[5]
             if country in Contacts.country2mail:
                 known = "known"
             elif mail:
                 known = "unofficial"
-                self.csvstats[f"abusemail_{known}"].add(
-                    mail
-                )  # subset of abusemail_abroad
-                self.csvstats[f"prefix_csirtmail_{known}"].add(
-                    self.get[0]
-                )  # subset of prefix_abroad_un/known
+                cls.csvstats[f"abusemail_{known}"].add(mail)  # subset of abusemail_abroad
+                if get[0]:
+                    cls.csvstats[f"prefix_csirtmail_{known}"].add(
+                        get[0]
+                    )  # subset of prefix_abroad_un/known
             else:  # we do not track the amount of unknown IP addresses that should be delivered to countries
                 known = None
 
             if known:
-                self.csvstats[f"ip_csirtmail_{known}"].add(self.ip)
-                self.csvstats[f"csirtmail_{known}"].add(country)
-
-        if not mail and Config.get_env().whois.reprocessable_unknown:
-            raise UnknownValue
+                cls.csvstats[f"ip_csirtmail_{known}"].add(ip)
+                cls.csvstats[f"csirtmail_{known}"].add(country)
 
     def resolve_unknown_mail(self):
         """Forces to load abusemail for an IP.
@@ -242,43 +350,23 @@ class Whois:
         # :param group: returned group - default: last group is returned (ex: the one in parentheses)
         if type(patterns) is str:
             patterns = [patterns]
-
-        for chunk in self.whois_response:
-            for pattern in patterns:
-                # it = re.finditer(pattern, self.whoisResponse) if type(pattern) is str else pattern(self.whoisResponse)
-                match = re.search(pattern, chunk)
-                # for i, match in enumerate(re.finditer(pattern, chunk)):
-                #     if not take_nth or i + 1 == take_nth:
-                #         break
-
-                if match:
-                    if last_word:  # returns only last word
-                        return re.search(r"[^\s]*$", match[0]).group(0)
-                    else:
-                        return match[len(match.groups())]
-        return ""  # no pattern result found
-
-        # for line in self.whoisResponse.split("\n"):
-        #     result = re.search(grep, line)
-        #     if result:
-        #         if lastWord:  # returns only last word
-        #             return re.search('[^\s]*$', line).group(0)  # \w*
-        #         else:  # returns whole line
-        #             return line
-        # return ""  # no grep result found
+        # (the fields are read from self.parsed, this serves for the rarely needed phrases)
+        return self.parsed.search([re.compile(p) for p in patterns], last_word)
 
     def analyze(self) -> AnalysisResult:
-        prefix = country = ""
+        prefix = country = ab = failure = ""
 
-        for server in list(self.servers):
+        backing_off = self.replay is None and self._backing_off()
+        for server in [] if backing_off else list(self.servers):
             self._exec(server=server)
+            failure = ""
             while True:
                 # 154.48.234.95
                 #   Found a referral to rwhois.cogentco.com:4321.
                 #   network:IP-Network:154.48.224.0/19
                 #   network:Country:DE
                 # 82.175.175.231 'country: NL # BE GB DE LU' -> 'NL'
-                country = self._match_response(r"country(-code)?:\s*([a-z]{2})")
+                country = self.parsed.country
                 if country == "eu":
                     # "EU # Worldwide" (2a0d:f407:1003::/48)
                     # 'EU # Country is really world wide' (64.9.241.202)
@@ -324,7 +412,11 @@ class Whois:
                                 f"Whois server {self.last_server} query rate limit exceeded for: {self.ip}."
                                 f" Sleeping for 300 s till {self.quota.time()}... (you may howevec Ctrl-C to skip)"
                             )
-                            sleep(300)
+                            if self.client and self.last_server:
+                                # hold back every query to the server, the next one waits in its bucket
+                                self.limiter.pause(self.last_server, 300)
+                            else:
+                                sleep(300)
                             self._exec(server=server)
                             continue
                     if self.last_server == "rwhois.gin.ntt.net":  # 204.2.250.0
@@ -344,20 +436,7 @@ class Whois:
                         continue
 
                 # loads prefix
-                match = self._match_response(
-                    [
-                        "% abuse contact for '([^']*)'",
-                        "% information related to '([^']*)'",
-                        # ip 151.80.121.243 needed this , % information related to
-                        # \'151.80.121.224 - 151.80.121.255\'\n\n% no abuse contact registered
-                        # for 151.80.121.224 - 151.80.121.255
-                        r"inetnum:\s*(.*)",  # inetnum:        151.80.121.224 - 151.80.121.255
-                        r"netrange:\s*(.*)",  # NetRange:       216.245.0.0 - 216.245.63.255
-                        r"cidr:\s*(.*)",  # CIDR:           216.245.0.0/18
-                        r"network:ip-network:\s*(.*)",
-                        # whois 154.48.250.2 "network:IP-Network:154.48.224.0/19"
-                    ]
-                )
+                match = self.parsed.prefix
                 if match:
                     prefix = self._str2prefix(match)
                     if prefix and prefix == whole_space:
@@ -386,24 +465,10 @@ class Whois:
                     country = self._load_country_from_addresses()
                 break
             if not country:
-                # fail = None
-                if self._match_response("network is unreachable"):
-                    logger.warning(
-                        f"Whois {server}: network is unreachable, waiting 1 sec..."
-                    )
-                    sleep(1)
-                    continue
-                if self._match_response("name or service not known"):
-                    # fail = f"Whois server {self.servers[server]} is unreachable. Disabling for this session."
-                    logger.warning(
-                        f"Whois {server}: name or service not known, waiting 1 sec..."
-                    )
-                    sleep(1)
-                    continue
-                if self._match_response("access denied"):  # RIPE gave me this
-                    # fail = f"Whois server {self.servers[server]} access denied. Disabling for this session."
-                    logger.warning(f"Whois {server}: access denied, waiting 1 sec...")
-                    sleep(1)
+                # "access denied": RIPE gave me this
+                if failure := self.parsed.failure:
+                    # try another server, the network is backed off if none answers
+                    logger.warning(f"Whois {server}: {failure}")
                     continue
                 if self._match_response("invalid search key"):
                     logger.warning(f"Invalid search key for: {self.ip}")
@@ -415,12 +480,15 @@ class Whois:
             else:
                 break
 
-        asn = self._match_response(r"\norigin(.*)\d+", last_word=True)
-        netname = self._match_response(
-            [r"netname:\s*([^\s]*)", r"network:network-name:\s*([^\s]*)"]
-        )
+        if failure and self.replay is None:
+            self._back_off(failure)
+        elif prefix and self.ip:
+            Whois.failures.pop(self._inflight_key(), None)
+
+        asn = self.parsed.asn
+        netname = self.parsed.netname
 
-        if Whois.unknown_mode and not ab:
+        if Whois.unknown_mode and not ab and not backing_off:
             ab = self.resolve_unknown_mail()
 
         local = Config.get_env().whois.local_country
@@ -437,9 +505,25 @@ class Whois:
             get2 = ab
         return prefix, get1, get2, asn, netname, country, ab, int(time())
 
+    def _backing_off(self):
+        """The queries for the network of the IP failed lately, we do not ask again till its backoff passes."""
+        failed = Whois.failures.get(self._inflight_key())
+        return failed and monotonic() < failed[1]
+
+    def _back_off(self, failure):
+        """Do not ask about the network for a while. The delay doubles with every failure in a row."""
+        key = self._inflight_key()
+        count = Whois.failures.get(key, (0, 0))[0] + 1
+        delay = min(self.failure_backoff * 2 ** (count - 1), self.failure_backoff_max)
+        Whois.failures[key] = count, monotonic() + delay
+        logger.warning(
+            f"Whois {self.ip or self.hostname_registerable}: {failure},"
+            f" its network is not asked again for {delay} s"
+        )
+
     def _load_country_from_addresses(self):
         # let's try to find country in the non-standardised address field
-        for address in re.findall(r"address:\s+(.*)", "\n".join(self.whois_response)):
+        for address in self.parsed.addresses:
             c = address_country_lowered(address)
             if c:
                 logger.info(f"Found country in {address}")
@@ -447,23 +531,14 @@ class Whois:
         return ""
 
     # email regex
-    email_regex = r"[a-z0-9._%+-]{1,64}@(?:[a-z0-9-]{1,63}\.){1,125}[a-z]{2,63}"
-    reAbuse = re.compile(email_regex)
+    email_regex = email_regex
+    reAbuse = reAbuse
 
     def get_abusemail(self):
-        """Loads abusemail from last whois response"""
-        match = self.reAbuse.search(
-            self._match_response(
-                [
-                    "% abuse contact for.*",
-                    "orgabuseemail.*",
-                    "abuse-mailbox.*",
-                    "e-mail:.*",  # whois 179.50.80.0/21,
-                    "email:.*",  # ex: 'Registrar Abuse Contact Email: domainabuse@tucows.com',
-                ]
-            )
-        )
-        return match.group(0) if match else ""
+        """Loads abusemail from last whois response
+        (ex: `e-mail:` whois 179.50.80.0/21, 'Registrar Abuse Contact Email: domainabuse@tucows.com')
+        """
+        return self.parsed.abusemail
 
     def get_registrar_abusemail(self):
         """Loads registrar's abusemail from last whois response.
@@ -487,10 +562,10 @@ class Whois:
 
         ex: website.xyz.com.br -> xyz.com.br
 
-        Note: if a nonregisterable url is given (e.g.: com.br) the same is returned
+        Note: if a nonregisterable url is given (e.g.: com.br) an empty string is returned
         """
 
-        return tldextract.extract(url).registered_domain
+        return registered_domain(url)
 
     regRe = re.compile(r"using server (.*)\.")
 
@@ -498,28 +573,16 @@ class Whois:
         """Query whois server"""
         target = self.hostname_registerable if self.hostname else self.ip
 
-        if server == "general":
-            cmd = ["whois", "--verbose", target]
-        else:
-            if not server_url:
-                server_url = Whois.servers[server]
-            cmd = ["whois", "--verbose", "-h", server_url, "--", target]
+        if server != "general" and not server_url:
+            server_url = Whois.servers[server]
         self.last_server = None  # check what registry whois asks - may use a strange LIR that returns non-senses
         try:
-            # in case wrong env is set to whois, we get `147.32.106.205` country NL and not CZ
-            # because we will not find string "found a referral to " in the WHOIS response
-            p = Popen(
-                cmd,
-                shell=False,
-                stdin=PIPE,
-                stdout=PIPE,
-                stderr=PIPE,
-                env=subprocess_env,
-            )
-            response = (
-                p.stdout.read().decode("unicode_escape").strip().lower()
-            )  # .replace("\n", " ")
-            response += p.stderr.read().decode("unicode_escape").strip().lower()
+            if self.replay is not None:
+                response = self._replayed(server, server_url)
+            elif self.client:
+                response = self.client.query(target, server_url)
+            else:
+                response = self._query_program(target, server_url)
         except UnicodeDecodeError:
             # ip address 94.230.155.109 had this string 'Jan Krivsky Hl\xc3\x83\x83\xc3\x82\xc2\xa1dkov' and everything failed
             self.whois_response = []
@@ -537,6 +600,8 @@ class Whois:
                 self.last_server = Whois.regRe.search(response).groups()[0]
             except (IndexError, AttributeError):
                 pass
+            if self.replay is None and "query rate limit exceeded" not in response:
+                self.exchanges.append((server, server_url, response))
 
             # Sometimes, a registry calls another registry for you. This may chain.
             # We prioritize by the most recent to the first.
@@ -552,11 +617,76 @@ class Whois:
             #   Found a referral to rwhois.cogentco.com:4321.
             #   network:IP-Network:154.48.224.0/19
             #   network:Country:DE
-            ref_s = "found a referral to "
+            ref_s = REFERRAL_MARK
             self.whois_response = response.split(ref_s)[::-1]
 
             # i = self.whoisResponse.find(ref_s)
             # if i > -1:
             #     self.whoisResponse = self.whoisResponse[i + len(ref_s):]
         finally:
+            self.parsed = ParsedResponse(self.whois_response)
             Whois.stats[self.last_server or server] += 1
+
+    def _replayed(self, server, server_url):
+        """The archived response of the server. If the analysis asks a server it did not ask before, it gets no answer."""
+        for i, (s, url, response) in enumerate(self.replay):
+            if (s, url) == (server, server_url):
+                del self.replay[i]
+                return response
+        return ""
+
+    def _query_program(self, target, server_url=None):
+        """Launch the `whois` program, unless the server keeps failing.
+        The queries are paced as the native client's (see `RateLimiter`). Without a server given,
+        we pace by the registry the program asked for the IANA block before, or by the "general" bucket.
+        The failures of the servers along the referrals are recorded (see `CircuitBreaker`)."""
+        key = WhoisClient.block_key(target)[1]
+        if server_url:  # we cannot know the server the program will ask otherwise
+            try:
+                self.breaker.check(server_url)
+            except ServerUnavailable as e:
+                return str(e).lower()
+            self.limiter.wait(server_url)
+        else:
+            self.limiter.wait(self.program_servers.get(key, "general"))
+        response = self._exec_program(target, server_url)
+        first, *referred = response.split(REFERRAL_MARK)
+        m = self.regRe.search(first)
+        if m and not server_url:
+            self.program_servers[key] = m[1]
+        servers = [m[1] if m else server_url]
+        servers += [chunk.split(".\n", 1)[0] for chunk in referred]  # "rwhois.example.com:4321.\n..."
+        for server, chunk in zip(servers, [first, *referred]):
+            if not server:
+                continue
+            if ParsedResponse([chunk]).failure:
+                self.breaker.failed(server)
+            else:
+                self.breaker.succeeded(server)
+        for server in servers[1:]:
+            # the program has already asked the referred servers, their next queries are delayed instead
+            self.limiter.wait(server)
+        return response
+
+    @staticmethod
+    def _exec_program(target, server_url=None):
+        """Query whois server by launching the `whois` program"""
+        if server_url:
+            cmd = ["whois", "--verbose", "-h", server_url, "--", target]
+        else:
+            cmd = ["whois", "--verbose", target]
+        # in case wrong env is set to whois, we get `147.32.106.205` country NL and not CZ
+        # because we will not find string "found a referral to " in the WHOIS response
+        p = Popen(
+            cmd,
+            shell=False,
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+            env=subprocess_env,
+        )
+        response = (
+            p.stdout.read().decode("unicode_escape").strip().lower()
+        )  # .replace("\n", " ")
+        response += p.stderr.read().decode("unicode_escape").strip().lower()
+        return response
@@ -0,0 +1,125 @@
+import logging
+import socket
+from time import monotonic
+from typing import Iterable, Optional
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+BulkRecord = tuple[str, str, str, str]
+"asn, country, prefix, as name; ex: ('as15169', 'us', '8.8.8.0/24', 'GOOGLE, US')"
+
+
+def query(server: str, ips: list[str], timeout=60) -> dict[str, BulkRecord]:
+    """Ask about the IPs in a single bulk session, in the style of the Team Cymru netcat interface.
+
+        begin
+        verbose
+        8.8.8.8
+        ...
+        end
+
+    The server replies a table `AS | IP | BGP Prefix | CC | Registry | Allocated | AS Name`, a line per IP.
+
+    :param server: host[:port]
+    :raises OSError: The server is unreachable.
+    """
+    host, _, port = server.partition(":")
+    request = "\n".join(("begin", "verbose", *ips, "end", ""))
+    with socket.create_connection((host, int(port or 43)), timeout=timeout) as sock:
+        sock.sendall(request.encode())
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+    return parse(b"".join(chunks).decode("utf-8", errors="replace").splitlines())
+
+
+def parse(lines: Iterable[str]) -> dict[str, BulkRecord]:
+    """IP => BulkRecord from the bulk reply lines. Values the server does not know (`NA`) are empty."""
+    results = {}
+    for line in lines:
+        fields = [f.strip() for f in line.split("|")]
+        if len(fields) < 3 or fields[0] == "AS":  # banner, error or header line
+            continue
+        asn, ip, prefix, *rest = (("" if f == "NA" else f) for f in fields)
+        country = rest[0].lower() if rest else ""
+        name = rest[3] if len(rest) > 3 else ""
+        results[ip] = (f"as{asn}" if asn else "", country, prefix, name)
+    return results
+
+
+class BulkWhois:
+    """The `asn`, `country`, `prefix` and `as_org` of the IPs from a bulk whois server (see `whois.bulk`).
+
+    The IPs collected beforehand (by `whois.prefetch`, `whois.concurrent_batch` or else by the batches of rows)
+    are sent by thousands in a single session. An IP not collected is not asked alone, WHOIS is asked instead.
+    Every method returns None when the bulk server has no answer; the caller then asks WHOIS.
+    When the server fails, it is not asked for a while.
+    """
+
+    session_size = 5000
+    "IPs sent in a single session"
+    failure_backoff = 60
+    "seconds the server is not asked after a failure, doubles with every failure in a row"
+    failure_backoff_max = 3600
+
+    results: dict[str, BulkRecord] = {}
+    _server: Optional[str] = None
+    _failure = 0, 0
+    "failures in a row, time the server may be asked again"
+
+    @classmethod
+    def server(cls) -> Optional[str]:
+        server = Config.get_env().whois.bulk
+        if server != cls._server:
+            cls.results, cls._server, cls._failure = {}, server, (0, 0)
+        return server
+
+    @classmethod
+    def resolve(cls, ips: Iterable[str]):
+        """Ask the server about the IPs not known yet."""
+        if not (server := cls.server()) or monotonic() < cls._failure[1]:
+            return
+        ips = [ip for ip in dict.fromkeys(ips) if ip not in cls.results]
+        for i in range(0, len(ips), cls.session_size):
+            session = ips[i : i + cls.session_size]
+            try:
+                results = query(server, session)
+            except OSError as e:
+                count = cls._failure[0] + 1
+                delay = min(
+                    cls.failure_backoff * 2 ** (count - 1), cls.failure_backoff_max
+                )
+                cls._failure = count, monotonic() + delay
+                logger.warning(
+                    f"Bulk whois {server} failed: {e}, not asked again for {delay} s."
+                )
+                return
+            cls._failure = 0, 0
+            # the IPs the server did not answer are not asked again
+            cls.results.update(
+                {ip: results.get(ip, ("", "", "", "")) for ip in session}
+            )
+
+    @classmethod
+    def get(cls, ip: str) -> Optional[BulkRecord]:
+        if not cls.server():
+            return None
+        return cls.results.get(ip)
+
+    @classmethod
+    def asn(cls, ip: str) -> Optional[str]:
+        return (record := cls.get(ip)) and record[0]
+
+    @classmethod
+    def country(cls, ip: str) -> Optional[str]:
+        return (record := cls.get(ip)) and record[1]
+
+    @classmethod
+    def prefix(cls, ip: str) -> Optional[str]:
+        return (record := cls.get(ip)) and record[2]
+
+    @classmethod
+    def as_org(cls, ip: str) -> Optional[str]:
+        return (record := cls.get(ip)) and record[3]
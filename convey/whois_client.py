@@ -0,0 +1,196 @@
+import logging
+import re
+import socket
+from threading import Event, Lock
+
+from netaddr import AddrFormatError, IPAddress, IPNetwork, IPRange
+
+from .prefix_index import PrefixIndex
+from .rate_limiter import CircuitBreaker, RateLimiter
+from .whois_parser import ParsedResponse
+
+logger = logging.getLogger(__name__)
+
+ROOT_SERVER = "whois.iana.org"
+REFERRAL_MARK = "found a referral to "
+
+# Some servers need the query string to be formatted.
+# (ARIN: `n +` prefix means network lookup with full details.)
+query_formats = {
+    "whois.arin.net": "n + {}",
+    "whois.verisign-grs.com": "domain {}",
+    "whois.denic.de": "-T dn,ace {}",
+}
+
+reRefer = re.compile(r"^\s*(?:refer|whois):\s*(\S+)", re.MULTILINE)
+reReferral = re.compile(
+    r"^\s*(?:referralserver|registrar whois server):\s*(?:r?whois://)?(\S+?)/?$",
+    re.MULTILINE,
+)
+reInetnum = re.compile(r"^\s*inet6?num:\s*(.*)$", re.MULTILINE)
+
+
+class WhoisClient:
+    """Query WHOIS servers directly through a TCP socket at port 43
+    instead of launching the `whois` program for every query.
+
+    The returned transcript mimics the `whois --verbose` output:
+    it starts with `using server ...` and the chained responses are delimited with `found a referral to ...`
+    so that `Whois` parses it the same way.
+    """
+
+    timeout = 10
+    "socket timeout in seconds"
+    max_referrals = 5
+    root_server = ROOT_SERVER
+    "host[:port] of the server telling us which registry to ask"
+
+    ip_registries = PrefixIndex()
+    "IANA block => registry server, cached from the root server responses"
+    tld_registries = {}
+    "TLD => registry server"
+    root_inflight = {}
+    "IPv4 /8, IPv6 /16 or TLD => Event set when the root server query about it ends"
+    root_lock = Lock()
+
+    def __init__(self, limiter: RateLimiter = None, breaker: CircuitBreaker = None):
+        self.limiter = limiter
+        "paces the queries to every server"
+        self.breaker = breaker or CircuitBreaker()
+        "skips the servers that keep failing"
+
+    def query(self, target: str, server: str = None) -> str:
+        """
+        :param target: IP address or hostname
+        :param server: host[:port] of a WHOIS server, optionally followed by query flags, ex: "whois.ripe.net -B".
+            If None, the registry is determined through the root server and the referrals are followed.
+        :return: Lowercased response transcript.
+        """
+        follow = server is None
+        flags = ""
+        if server is None:
+            try:
+                server = self.get_registry(target)
+            except OSError as e:
+                return str(e).lower()
+        elif " " in server:
+            server, flags = server.split(" ", 1)
+        if not server:
+            return f"no whois server is known for {target}"
+
+        transcript = [f"using server {server}."]
+        asked = set()
+        for _ in range(self.max_referrals + 1):
+            asked.add(server)
+            try:
+                response = self.ask(server, self._format(server, target, flags))
+            except OSError as e:
+                transcript.append(str(e).lower())
+                break
+            transcript.append(response)
+            if not follow:
+                break
+            referral = self._get_referral(response)
+            if not referral or referral in asked:
+                break
+            transcript.append(f"\n\n{REFERRAL_MARK}{referral}.\n\n")
+            server = referral
+        return "\n".join(transcript).strip()
+
+    def ask(self, server: str, query: str) -> str:
+        """Send a single query and return the lowercased response.
+        :raises OSError: The server failed or is skipped due to its failures (ServerUnavailable).
+        """
+        self.breaker.check(server)
+        if self.limiter:
+            self.limiter.wait(server)
+        host, port = self._host_port(server)
+        try:
+            with socket.create_connection((host, port), timeout=self.timeout) as sock:
+                sock.sendall(query.encode("utf-8") + b"\r\n")
+                chunks = []
+                while data := sock.recv(4096):
+                    chunks.append(data)
+        except OSError:
+            self.breaker.failed(server)
+            raise
+        data = b"".join(chunks)
+        try:
+            response = data.decode("utf-8").lower()
+        except UnicodeDecodeError:
+            response = data.decode("latin-1").lower()
+        if ParsedResponse([response]).failure:  # ex: access denied
+            self.breaker.failed(server)
+        else:
+            self.breaker.succeeded(server)
+        return response
+
+    def get_registry(self, target):
+        """Determine the registry server for the target through the root server. Cached.
+        The concurrent lookups from the same IANA block (or TLD) wait for a single root server query.
+        """
+        ip, key = self.block_key(target)
+        tld = key
+
+        while True:
+            if ip is not None:
+                block = self.ip_registries.find(ip)
+                if block is not None:
+                    return self.ip_registries[block]
+            elif tld in self.tld_registries:
+                return self.tld_registries[tld]
+            with self.root_lock:
+                pending = self.root_inflight.get(key)
+                if not pending:
+                    self.root_inflight[key] = Event()
+                    break
+            pending.wait()
+
+        try:
+            return self._ask_root(target, ip, key)
+        finally:
+            with self.root_lock:
+                self.root_inflight.pop(key).set()
+
+    @staticmethod
+    def block_key(target):
+        """Return the IP (or None for a domain) and the key of the IANA block (or the TLD) the target belongs to."""
+        try:
+            ip = IPAddress(target)
+        except (AddrFormatError, ValueError):
+            return None, target.rstrip(".").rsplit(".", 1)[-1].lower()
+        # IANA delegates at least a /8 of IPv4; the IPv6 blocks may be smaller, then a waiting one asks in its turn
+        return ip, (ip.version, int(ip) >> (24 if ip.version == 4 else 112))
+
+    def _ask_root(self, target, ip, tld):
+        """Ask the root server which registry manages the target, cache the answer."""
+        response = self.ask(self.root_server, target)
+        m = reRefer.search(response)
+        server = m[1] if m else None
+        if ip is None:
+            self.tld_registries[tld] = server
+        elif m := reInetnum.search(response):
+            # the root server tells us the whole block the registry manages, ex: `193.0.0.0 - 193.255.255.255`
+            sp = [a.strip() for a in m[1].split(" - ")]
+            try:
+                block = IPRange(*sp) if len(sp) > 1 else IPNetwork(sp[0])
+            except (AddrFormatError, ValueError):
+                logger.debug(f"Root server block {m[1]} cannot be parsed.")
+            else:
+                self.ip_registries[block] = server
+        return server
+
+    @staticmethod
+    def _get_referral(response):
+        if m := reReferral.search(response):
+            return m[1]
+
+    @staticmethod
+    def _format(server, target, flags):
+        query = query_formats.get(server, "{}").format(target)
+        return f"{flags} {query}" if flags else query
+
+    @staticmethod
+    def _host_port(server):
+        host, _, port = server.partition(":")
+        return host, int(port) if port else 43
@@ -0,0 +1,111 @@
+import re
+from functools import cached_property
+
+# email regex
+email_regex = r"[a-z0-9._%+-]{1,64}@(?:[a-z0-9-]{1,63}\.){1,125}[a-z]{2,63}"
+reAbuse = re.compile(email_regex)
+reLastWord = re.compile(r"[^\s]*$")
+
+reCountry = [re.compile(r"country(-code)?:\s*([a-z]{2})")]
+rePrefix = [
+    re.compile(p)
+    for p in (
+        "% abuse contact for '([^']*)'",
+        "% information related to '([^']*)'",
+        # ip 151.80.121.243 needed this , % information related to
+        # \'151.80.121.224 - 151.80.121.255\'\n\n% no abuse contact registered
+        # for 151.80.121.224 - 151.80.121.255
+        r"inetnum:\s*(.*)",  # inetnum:        151.80.121.224 - 151.80.121.255
+        r"netrange:\s*(.*)",  # NetRange:       216.245.0.0 - 216.245.63.255
+        r"cidr:\s*(.*)",  # CIDR:           216.245.0.0/18
+        r"network:ip-network:\s*(.*)",
+        # whois 154.48.250.2 "network:IP-Network:154.48.224.0/19"
+    )
+]
+reOrigin = [re.compile(r"\norigin(.*)\d+")]
+reNetname = [
+    re.compile(r"netname:\s*([^\s]*)"),
+    re.compile(r"network:network-name:\s*([^\s]*)"),
+]
+reAbuseLine = [
+    re.compile(p)
+    for p in (
+        "% abuse contact for.*",
+        "orgabuseemail.*",
+        "abuse-mailbox.*",
+        "e-mail:.*",  # whois 179.50.80.0/21,
+        "email:.*",  # ex: 'Registrar Abuse Contact Email: domainabuse@tucows.com',
+    )
+]
+reAddress = re.compile(r"address:\s+(.*)")
+# a whole line telling the query failed, not that the registry has no record,
+# ex: "connect: connection refused", "[errno -2] name or service not known", "%error:201: access denied"
+reFailure = [
+    re.compile(
+        r"^\s*(?:connect: |getaddrinfo\([^)]*\): |\[errno -?\d+\] |%error:\d+: )?"
+        r"(network is unreachable|name or service not known|access denied"
+        r"|connection refused|timed out|\S+ skipped after \d+ failures, retrying in \d+ s)\.?\s*$",
+        re.MULTILINE,
+    )
+]
+
+
+class ParsedResponse:
+    """Fields of a WHOIS response, each extracted at most once.
+
+    The response is a list of chunks, the last referral first (see `Whois._exec`).
+    A field is searched chunk by chunk in this order, its patterns in their priority order.
+    The patterns are compiled once at import.
+    (A line-by-line tokenizer was measured several times slower than these scans:
+    the regular expression engine skips the uninteresting lines by a literal search.)
+    """
+
+    def __init__(self, chunks: list[str]):
+        self.chunks = chunks
+
+    def search(self, patterns: list[re.Pattern], last_word=False) -> str:
+        """
+        :param last_word: returns only the last word of whole matched expression else last group
+            (ex: the one in parentheses)
+        :return: The first pattern matched in the first chunk it is found in.
+        """
+        for chunk in self.chunks:
+            for pattern in patterns:
+                if match := pattern.search(chunk):
+                    if last_word:
+                        return reLastWord.search(match[0])[0]
+                    return match[len(match.groups())]
+        return ""
+
+    @cached_property
+    def country(self) -> str:
+        """ex: 'country: NL # BE GB DE LU' -> 'nl', `network:Country:DE` -> 'de'"""
+        return self.search(reCountry)
+
+    @cached_property
+    def prefix(self) -> str:
+        """ex: '151.80.121.224 - 151.80.121.255' or '216.245.0.0/18'"""
+        return self.search(rePrefix)
+
+    @cached_property
+    def asn(self) -> str:
+        """The last word of the `origin` line, ex: 'originas: as15169, as36040' -> 'as36040'"""
+        return self.search(reOrigin, last_word=True)
+
+    @cached_property
+    def netname(self) -> str:
+        return self.search(reNetname)
+
+    @cached_property
+    def abusemail(self) -> str:
+        """The first abuse contact line found decides, even if it contains no address."""
+        match = reAbuse.search(self.search(reAbuseLine))
+        return match.group(0) if match else ""
+
+    @cached_property
+    def failure(self) -> str:
+        return self.search(reFailure)
+
+    @cached_property
+    def addresses(self) -> list[str]:
+        return reAddress.findall("\n".join(self.chunks))
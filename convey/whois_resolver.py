@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from .rate_limiter import registry_name
+from .whois import Quota, UnknownValue, Whois
+
+logger = logging.getLogger(__name__)
+
+
+class WhoisResolver:
+    """Resolve many IP addresses concurrently, limiting the number of parallel queries per registry.
+    The results are stored in the Whois cache (`Whois.ranges`, `Whois.ip_seen`)
+    so that the row processing just picks them up.
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        """
+        :param limits: registry name => max parallel queries, ex: {"ripe": 8, "lacnic": 1, "other": 4}
+        """
+        self.limits = limits
+
+    def resolve(self, ips: Iterable[str]):
+        """Resolve the IPs that are not cached yet. Blocks till all the lookups finish."""
+        ips = [
+            ip
+            for ip in dict.fromkeys(ips)  # distinct, keep order
+            if ip not in Whois.ip_seen and Whois.ranges.find(ip) is None
+        ]
+        if ips:
+            asyncio.run(self._resolve(ips))
+
+    async def _resolve(self, ips):
+        loop = asyncio.get_running_loop()
+        workers = max(1, sum(self.limits.values()))
+        default = self.limits.get("other", 1)
+        semaphores = defaultdict(
+            lambda: asyncio.Semaphore(default),
+            {
+                name: asyncio.Semaphore(max(1, limit))
+                for name, limit in self.limits.items()
+            },
+        )
+        with ThreadPoolExecutor(workers, thread_name_prefix="whois") as executor:
+            loop.set_default_executor(executor)
+            await asyncio.gather(*(self._lookup(ip, semaphores) for ip in ips))
+
+    async def _lookup(self, ip, semaphores):
+        registry = await asyncio.to_thread(self._get_registry, ip)
+        async with semaphores[registry]:
+            await asyncio.to_thread(self._whois, ip)
+
+    @staticmethod
+    def _get_registry(ip):
+        if not Whois.client:  # `whois` program decides the registry itself
+            return "other"
+        try:
+            return registry_name(Whois.client.get_registry(ip) or "")
+        except OSError:
+            return "other"
+
+    @staticmethod
+    def _whois(ip):
+        try:
+            Whois(ip)
+        except (Quota.QuotaExceeded, UnknownValue):
+            pass  # the row processing takes care
+        except Exception as e:
+            # the row processing will try again and possibly mark the row invalid
+            logger.debug(f"Concurrent whois {ip} failed: {e}")
@@ -0,0 +1,540 @@
+import json
+import logging
+import sqlite3
+import zlib
+from bisect import insort
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Iterable, Literal
+
+import jsonpickle
+from netaddr import IPAddress, IPRange
+
+from .prefix_table import PrefixTable
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prefixes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    version INTEGER NOT NULL,
+    first BLOB NOT NULL,
+    last BLOB NOT NULL,
+    location TEXT,
+    incident_contact TEXT,
+    asn TEXT,
+    netname TEXT,
+    country TEXT,
+    abusemail TEXT,
+    timestamp INTEGER NOT NULL,
+    bits INTEGER NOT NULL,
+    hit_at INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (version, first, last)
+);
+CREATE INDEX IF NOT EXISTS prefixes_lookup ON prefixes (version, bits, first);
+CREATE INDEX IF NOT EXISTS prefixes_timestamp ON prefixes (timestamp);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS responses (
+    version INTEGER NOT NULL,
+    first BLOB NOT NULL,
+    last BLOB NOT NULL,
+    target TEXT NOT NULL,
+    exchanges BLOB NOT NULL,
+    PRIMARY KEY (version, first, last)
+);
+CREATE TABLE IF NOT EXISTS domains (
+    domain TEXT PRIMARY KEY,
+    location TEXT,
+    incident_contact TEXT,
+    asn TEXT,
+    netname TEXT,
+    country TEXT,
+    abusemail TEXT,
+    timestamp INTEGER NOT NULL
+);
+-- (INSERT OR REPLACE into prefixes does not fire the trigger, the archive is kept)
+CREATE TRIGGER IF NOT EXISTS prefixes_archive AFTER DELETE ON prefixes BEGIN
+    DELETE FROM responses WHERE version = old.version AND first = old.first AND last = old.last;
+END;
+"""
+# distinct sizes by seeking the index instead of scanning it
+SELECT_BITS = """
+WITH RECURSIVE sizes(bits) AS (
+    SELECT MIN(bits) FROM prefixes WHERE version = :version
+    UNION ALL
+    SELECT (SELECT MIN(bits) FROM prefixes WHERE version = :version AND bits > sizes.bits)
+    FROM sizes WHERE sizes.bits IS NOT NULL
+)
+SELECT bits FROM sizes WHERE bits IS NOT NULL
+"""
+COLUMNS = "version, first, last, location, incident_contact, asn, netname, country, abusemail, timestamp, bits"
+
+
+def _bound(val: int) -> bytes:
+    """IP address as a fixed-length big-endian blob; blobs compare bytewise so that the order is kept."""
+    return val.to_bytes(16, "big")
+
+
+class WhoisStore:
+    """Global WHOIS cache stored in an SQLite database.
+
+    Every prefix is a row {version, first, last} => AnalysisResult,
+    the IP bounds are kept as blobs so that IPv6 fits in.
+    The results are queried on demand and inserted when created
+    so that neither opening nor saving the cache depends on its size.
+
+    To find the prefixes containing an IP, we cannot just scan back from the IP
+    as there might be a lot of smaller prefixes on the way. Instead, the prefixes are grouped by their size
+    (`bits` = bit length of last - first) and a prefix of the given size must start
+    less than 2^bits before the IP. That makes a short index range for every size.
+
+    Changes are appended to the write-ahead log (the `-wal` file) when committed, so a crash loses nothing
+    while the database file itself is not rewritten. The log is checkpointed into the database
+    once it passes `journal_pages`.
+
+    The results of the domain WHOIS queries are kept apart in the `domains` table, by the registered domain.
+
+    The raw responses a result was analyzed from are archived zlib-compressed in the `responses` table
+    so that the results can be analyzed again without querying (see `archived`).
+    The archive of a prefix is deleted together with the prefix, unless the prefix is moved (see `move`).
+
+    When compacted, the results are written to a memory-mapped `PrefixTable` too, answering by a single binary search.
+    Then, we only check the SQLite for the rows inserted since (their id is higher than the table's)
+    and whether the result from the table has not been removed meanwhile.
+    """
+
+    compact_threshold = 1000
+    "Write the table when this many (or 10 % of the table) results changed."
+    journal_pages = 1000
+    "Checkpoint the write-ahead log into the database when it has this many pages (4 KiB each)."
+    busy_timeout = 30
+    "Seconds to wait for another process writing to the database."
+    hits_buffer = 1000
+    "Write the hit counts when this many prefixes were hit."
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.table_path = self.get_table_path(path)
+        self._conn = sqlite3.connect(
+            path, timeout=self.busy_timeout, check_same_thread=False
+        )
+        self._lock = Lock()
+        self._table = self._table_stat = None
+        self.lookups = self.hits = 0
+        "lookups and hits in this session"
+        self.written = 0
+        "prefixes inserted, replaced or deleted in this session"
+        self._hits = {}
+        "(version, first, last) => hits not written yet"
+        self._flushed = 0, 0
+        "lookups and hits already written"
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            # in the WAL mode, a commit survives an application crash without waiting for the disk
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute(f"PRAGMA wal_autocheckpoint = {self.journal_pages}")
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            self._data_version = None
+            self._sync()
+
+    @staticmethod
+    def get_table_path(path: Path):
+        return path.with_suffix(".table")
+
+    @classmethod
+    def delete_files(cls, path: Path):
+        for p in cls._get_files(path):
+            p.unlink(missing_ok=True)
+
+    @classmethod
+    def _get_files(cls, path: Path):
+        return (
+            path,
+            Path(f"{path}-wal"),
+            Path(f"{path}-shm"),
+            cls.get_table_path(path),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM prefixes").fetchone()[0]
+
+    def find(self, ip: IPAddress):
+        """Return the AnalysisResult of the most specific prefix the IP belongs to or None."""
+        with self._lock:
+            self._sync()
+            result = self._lookup(ip)
+            self.lookups += 1
+            if result:
+                self.hits += 1
+                prefix = result[0]
+                key = prefix.version, _bound(prefix.first), _bound(prefix.last)
+                self._hits[key] = self._hits.get(key, 0) + 1
+                if len(self._hits) >= self.hits_buffer:
+                    with self._conn:
+                        self._flush_hits()
+            return result
+
+    def _lookup(self, ip: IPAddress):
+        if not self._table:
+            return self._find(ip)
+        if hit := self._table.find(ip):
+            prefix = hit[1][0]
+            if not self._conn.execute(
+                "SELECT 1 FROM prefixes WHERE version = ? AND first = ? AND last = ?",
+                (prefix.version, _bound(prefix.first), _bound(prefix.last)),
+            ).fetchone():
+                # removed since the table was written, another prefix may apply
+                return self._find(ip)
+        newer = self._find_newer(ip, self._table.seq)
+        if newer and (not hit or _specificity(newer[0]) <= _specificity(prefix)):
+            return newer
+        return hit[1] if hit else None
+
+    def _find(self, ip: IPAddress):
+        val = int(ip)
+        # The smaller the prefix, the more specific. Within the same size, the highest start is the most specific.
+        for bits in self._bits[ip.version]:
+            row = self._conn.execute(
+                f"SELECT {COLUMNS} FROM prefixes INDEXED BY prefixes_lookup"
+                " WHERE version = ? AND bits = ? AND first BETWEEN ? AND ? AND last >= ?"
+                " ORDER BY first DESC, last ASC LIMIT 1",
+                (
+                    ip.version,
+                    bits,
+                    _bound(max(0, val - (1 << bits) + 1)),
+                    _bound(val),
+                    _bound(val),
+                ),
+            ).fetchone()
+            if row:
+                return self._to_result(row)
+        return None
+
+    def _find_newer(self, ip: IPAddress, seq: int):
+        """Search the rows inserted after the given id only."""
+        val = _bound(int(ip))
+        row = self._conn.execute(
+            f"SELECT {COLUMNS} FROM prefixes NOT INDEXED"  # scan just the id range
+            " WHERE id > ? AND version = ? AND first <= ? AND last >= ?"
+            " ORDER BY bits ASC, first DESC, last ASC LIMIT 1",
+            (seq, ip.version, val, val),
+        ).fetchone()
+        return self._to_result(row) if row else None
+
+    def put(self, result):
+        self.update((result,))
+
+    def update(self, results: Iterable):
+        """Insert or replace the AnalysisResults."""
+        rows = [self._to_row(result) for result in results]
+        with self._lock, self._conn:
+            self._insert(rows)
+
+    def _insert(self, rows):
+        now = int(time())
+        self._conn.executemany(
+            f"INSERT OR REPLACE INTO prefixes ({COLUMNS}, hit_at) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+            (row + (now,) for row in rows),
+        )
+        self.written += len(rows)
+        for version, *_, bits in rows:
+            if bits not in self._bits[version]:
+                insort(self._bits[version], bits)
+
+    def delete(self, prefix):
+        with self._lock, self._conn:
+            self._delete(prefix)
+
+    def _delete(self, prefix):
+        cursor = self._conn.execute(
+            "DELETE FROM prefixes WHERE version = ? AND first = ? AND last = ?",
+            (prefix.version, _bound(prefix.first), _bound(prefix.last)),
+        )
+        self.written += cursor.rowcount
+        self._increment("removed", cursor.rowcount)
+
+    def move(self, prefix, result):
+        """Replace the prefix with the prefix of the AnalysisResult, its archived responses are kept.
+        Ex: the responses analyzed again (see `wrapper.whois_reparse`) resolve to another prefix.
+        """
+        row = self._to_row(result)
+        with self._lock, self._conn:
+            # re-key the archive first, the trigger would delete it together with the former prefix
+            self._conn.execute(
+                "UPDATE OR REPLACE responses SET version = ?, first = ?, last = ?"
+                " WHERE version = ? AND first = ? AND last = ?",
+                (*row[:3], prefix.version, _bound(prefix.first), _bound(prefix.last)),
+            )
+            self._delete(prefix)
+            self._insert((row,))
+
+    def find_domain(self, domain: str):
+        """Return the AnalysisResult of the registered domain or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT location, incident_contact, asn, netname, country, abusemail, timestamp"
+                " FROM domains WHERE domain = ?",
+                (domain,),
+            ).fetchone()
+        return ("", *row) if row else None
+
+    def put_domain(self, domain: str, result):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO domains VALUES (?,?,?,?,?,?,?,?)",
+                (domain, *result[1:]),
+            )
+
+    def archive(self, prefix, target: str, exchanges: list):
+        """Keep the raw responses the result of the prefix was analyzed from.
+        :param target: The queried IP.
+        :param exchanges: [(server, server_url, response)] in the order they were queried.
+        """
+        blob = zlib.compress(json.dumps(exchanges).encode())
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?)",
+                (
+                    prefix.version,
+                    _bound(prefix.first),
+                    _bound(prefix.last),
+                    target,
+                    blob,
+                ),
+            )
+
+    def archived(self) -> list[tuple]:
+        """:return: [(AnalysisResult, target, exchanges)] of the prefixes having their responses archived."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {COLUMNS}, target, exchanges FROM prefixes JOIN responses USING (version, first, last)"
+            ).fetchall()
+        return [
+            (
+                self._to_result(row),
+                target,
+                [tuple(e) for e in json.loads(zlib.decompress(blob))],
+            )
+            for *row, target, blob in rows
+        ]
+
+    def purge(self, ttl: int, unknown=False, domain_ttl=-1):
+        """Delete the results older than TTL seconds (-1 ~ never expire).
+        :param unknown: Delete the unknown prefix too.
+        :param domain_ttl: TTL of the domain results.
+        """
+        with self._lock, self._conn:
+            if domain_ttl != -1:
+                self._conn.execute(
+                    "DELETE FROM domains WHERE timestamp < ?", (time() - domain_ttl,)
+                )
+            if ttl != -1:
+                cursor = self._conn.execute(
+                    "DELETE FROM prefixes WHERE timestamp < ?", (time() - ttl,)
+                )
+                self._increment("removed", cursor.rowcount)
+                self.written += cursor.rowcount
+            if unknown:
+                zero = _bound(0)
+                cursor = self._conn.execute(
+                    "DELETE FROM prefixes WHERE version = 4 AND first = ? AND last = ?",
+                    (zero, zero),
+                )
+                self._increment("removed", cursor.rowcount)
+                self.written += cursor.rowcount
+
+    def evict(self, limit: int, policy: Literal["lru", "lfu"] = "lru"):
+        """Delete the least recently or least frequently hit results exceeding the limit.
+        We evict down to 90 % of the limit so that the eviction does not take place at every save.
+        :param limit: Number of prefixes, 0 ~ unlimited.
+        :return: Number of results evicted.
+        """
+        with self._lock, self._conn:
+            self._flush_hits()
+            if not limit:
+                return 0
+            count = self._conn.execute("SELECT COUNT(*) FROM prefixes").fetchone()[0]
+            if count <= limit:
+                return 0
+            order = "hit_at, hits" if policy == "lru" else "hits, hit_at"
+            cursor = self._conn.execute(
+                "DELETE FROM prefixes WHERE id IN"
+                f" (SELECT id FROM prefixes ORDER BY {order} LIMIT ?)",
+                (count - int(limit * 0.9),),
+            )
+            self._increment("removed", cursor.rowcount)
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        """Number of entries, lookups and hits of all the processes sharing the store, size of the files."""
+        with self._lock, self._conn:
+            self._flush_hits()
+            return {
+                "entries": self._conn.execute(
+                    "SELECT COUNT(*) FROM prefixes"
+                ).fetchone()[0],
+                "lookups": self._get_meta("lookups"),
+                "hits": self._get_meta("hits"),
+                "bytes": sum(
+                    p.stat().st_size for p in self._get_files(self.path) if p.exists()
+                ),
+            }
+
+    def compact(self, force=False):
+        """Write the results to the table if enough of them changed since the table was written.
+        :return: True if written.
+        """
+        with self._lock:
+            seq, removed = self._get_seq(), self._get_meta("removed")
+            if self._table:
+                changed = (
+                    self._conn.execute(
+                        "SELECT COUNT(*) FROM prefixes WHERE id > ?", (self._table.seq,)
+                    ).fetchone()[0]
+                    + removed
+                    - self._table.removed
+                )
+                threshold = max(self.compact_threshold, self._table.entries // 10)
+            else:
+                changed, threshold = seq, self.compact_threshold
+            if not changed or (changed < threshold and not force):
+                return False
+            rows = self._conn.execute(f"SELECT id, {COLUMNS} FROM prefixes")
+            PrefixTable.write(
+                self.table_path,
+                ((id_, self._to_result(row)) for id_, *row in rows),
+                seq,
+                removed,
+            )
+            if self._table:
+                self._table.close()
+            self._table = self._open_table()
+            return True
+
+    def migrate(self, path: Path):
+        """Import the results from the former jsonpickled cache file and remove the file.
+        The file is kept unless all of its results have been committed.
+        """
+        try:
+            _, ranges = jsonpickle.decode(path.read_text(), keys=True)
+            rows = [
+                self._to_row((IPRange(first, last), *v[1:]))
+                for (first, last), v in ranges.items()
+            ]
+        except Exception as e:
+            logger.warning(f"Cannot migrate the former WHOIS cache {path}: {e}")
+            return
+        with self._lock, self._conn:  # a single transaction, rolled back on an error
+            self._insert(rows)
+        logger.info(f"Former WHOIS cache {path} migrated to {self.path}")
+        path.unlink()
+
+    def close(self):
+        with self._lock:
+            with self._conn:
+                self._flush_hits()
+            if self._table:
+                self._table.close()
+            self._conn.close()
+
+    def _sync(self):
+        """Catch up with the changes committed by the other processes sharing the database."""
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        # version => prefix sizes present in the store, ascending
+        self._bits = {
+            version: [
+                b for (b,) in self._conn.execute(SELECT_BITS, {"version": version})
+            ]
+            for version in (4, 6)
+        }
+        if self._get_table_stat() != self._table_stat:  # another process compacted
+            if self._table:
+                self._table.close()
+            self._table = self._open_table()
+
+    def _get_table_stat(self):
+        try:
+            stat = self.table_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _open_table(self):
+        self._table_stat = self._get_table_stat()
+        try:
+            table = PrefixTable(self.table_path)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(e)
+            return None
+        if table.seq > self._get_seq():  # the table does not belong to this database
+            table.close()
+            return None
+        return table
+
+    def _get_seq(self):
+        """The highest id ever inserted."""
+        row = self._conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'prefixes'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _get_meta(self, key):
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _increment(self, key, count):
+        if count > 0:
+            self._conn.execute(
+                "INSERT INTO meta VALUES (?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = value + excluded.value",
+                (key, count),
+            )
+
+    def _flush_hits(self):
+        """Write the buffered hit counts. (We do not write at every lookup.)"""
+        now = int(time())
+        self._conn.executemany(
+            "UPDATE prefixes SET hits = hits + ?, hit_at = ?"
+            " WHERE version = ? AND first = ? AND last = ?",
+            ((count, now, *key) for key, count in self._hits.items()),
+        )
+        self._increment("lookups", self.lookups - self._flushed[0])
+        self._increment("hits", self.hits - self._flushed[1])
+        self._flushed = self.lookups, self.hits
+        self._hits.clear()
+
+    @staticmethod
+    def _to_row(result):
+        prefix = result[0]
+        return (
+            prefix.version,
+            _bound(prefix.first),
+            _bound(prefix.last),
+            *result[1:],
+            (prefix.last - prefix.first).bit_length(),
+        )
+
+    @staticmethod
+    def _to_result(row):
+        version, first, last, *values, _ = row
+        prefix = IPRange(
+            IPAddress(int.from_bytes(first, "big"), version),
+            IPAddress(int.from_bytes(last, "big"), version),
+        )
+        return (prefix, *values)
+
+
+def _specificity(prefix):
+    """The lower, the more specific."""
+    return (prefix.last - prefix.first).bit_length(), -prefix.first, prefix.last
@@ -4,39 +4,48 @@ Source file caching - load, save
 
 import logging
 import re
+import sqlite3
 import sys
 import traceback
 from bdb import BdbQuit
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 from csv import writer
 from os import linesep
 from pathlib import Path
 from sys import exit
-from time import time
 
 import ezodf
+import humanize
 import jsonpickle
 from mininterface import Mininterface
 from mininterface.tag import PathTag
 import openpyxl
 import xlrd
-from netaddr import IPRange
+from tabulate import tabulate
 from xlrd import XLRDError
 
 from .args_controller import Env
 
 from .config import Config, config_dir
+from .contacts import Contacts
 from .dialogue import hit_any_key, is_yes
 from .identifier import Identifier
 from .parser import Parser
+from .prefix_index import PrefixIndex
 from .utils import lazy_print
+from .whois import Quota, UnknownValue, Whois
+from .whois_store import WhoisStore
 
 logger = logging.getLogger(__name__)
 
 __author__ = "Edvard Rejthar"
 __date__ = "$Mar 23, 2015 8:33:24 PM$"
 
-WHOIS_CACHE = ".convey-whois-cache.json"
+WHOIS_CACHE = ".convey-whois-cache.sqlite"
+# former cache format, migrated to WHOIS_CACHE (kept in the same directory)
+WHOIS_CACHE_JSON = ".convey-whois-cache.json"
 
 
 def choose_file(m: Mininterface):
@@ -55,6 +64,62 @@ def read_stdin():
     return sys.stdin.read().rstrip().split("\n")  # rstrip \n at the end of the input
 
 
+def whois_cache_path() -> Path:
+    """The global WHOIS cache, see `whois.cache_file`."""
+    return Config.get_env().whois.cache_file or Path(config_dir, WHOIS_CACHE)
+
+
+def whois_cache_stats() -> str:
+    path = whois_cache_path()
+    if not path.exists():
+        return f"No whois cache at {path}"
+    store = WhoisStore(path)
+    stats = store.stats()
+    store.close()
+    lookups = stats["lookups"]
+    return tabulate(
+        [
+            ("file", path),
+            ("entries", stats["entries"]),
+            ("lookups", lookups),
+            ("hit rate", f"{stats['hits'] / lookups:.1%}" if lookups else "-"),
+            ("size", humanize.naturalsize(stats["bytes"])),
+        ],
+        headers=("whois cache", "value"),
+    )
+
+
+def whois_reparse(path: Path = None) -> str:
+    """Analyze the archived WHOIS responses again, rebuilding the cached results without querying."""
+    path = path or whois_cache_path()
+    if not path.exists():
+        return f"No whois cache at {path}"
+    store = WhoisStore(path)
+    Contacts.init()
+    Whois.init(defaultdict(int), PrefixIndex(store=store), {}, defaultdict(set))
+    Whois.see = False
+    Whois.archive = False  # the store keeps the archive, even if the prefix moves
+    archived = store.archived()
+    changed = 0
+    for result, target, exchanges in archived:
+        try:
+            get = Whois(target, replay=exchanges).get
+        except (UnknownValue, Quota.QuotaExceeded):
+            continue
+        if not get[0]:  # keep the former result, the archive may serve to a better parser
+            continue
+        moved = get[0].key() != result[0].key()
+        if moved or get[1:7] != result[1:7]:
+            changed += 1
+        reparsed = (*get[:7], result[7])  # the data are as old as the responses
+        if moved:
+            store.move(result[0], reparsed)
+        else:
+            store.put(reparsed)
+    store.close()
+    return f"Reparsed {len(archived)} archived prefixes, {changed} changed."
+
+
 class Wrapper:
     def __init__(
         self,
@@ -67,8 +132,9 @@ class Wrapper:
         reprocess=False,
         delete_cache=False,
     ):
-        if delete_cache and Path(config_dir, WHOIS_CACHE).exists():
-            Path(config_dir, WHOIS_CACHE).unlink()
+        if delete_cache:
+            WhoisStore.delete_files(path := whois_cache_path())
+            path.with_name(WHOIS_CACHE_JSON).unlink(missing_ok=True)
 
         self.m = m
         self.env = m.env
@@ -79,7 +145,7 @@ class Wrapper:
         self.stdin = stdin = None
         self.types = types
         self.whois_not_loaded = fresh
-        self.last_hash = None
+        self.whois_store: Future[WhoisStore | None] = None
 
         force_file = force_input = False
         if file_given:
@@ -191,7 +257,7 @@ class Wrapper:
             self.clear()
 
         if not fresh:
-            self.parser.ip_seen, self.parser.ranges = self.load_whois_cache(fix=True)
+            self.parser.ip_seen, self.parser.ranges = self.load_whois_cache()
             self.parser.refresh()
             self.parser.reset_whois(assure_init=True)
 
@@ -204,50 +270,42 @@ class Wrapper:
         Config.set_cache_dir(Path(self.file.parent, self.file.name + "_convey" + hash_))
         self.cache_file = Path(Config.get_cache_dir(), self.file.name + ".cache")
 
-    def load_whois_cache(self, fix=False):
-        """restore whois cache and remove expired results"""
-        p = Path(config_dir, WHOIS_CACHE)
-        if self.whois.cache and p.exists():
-            # XX if it's long, postpone via a thread that would block analysis
-            event = lazy_print("... loading big WHOIS cache ...")
-            ip_seen, ranges = jsonpickle.decode(p.read_text(), keys=True)
-            ranges = {
-                IPRange(k[0], k[1]): v
-                for k, v in ranges.items()
-                if v[7] + self.whois.ttl >= time()
-            }
-            nothing_to_save = True
-            if self.whois.delete_unknown and IPRange(0, 0) in ranges:
-                # all IP addresses within an unknown prefix removed from cache
-                del ranges[IPRange(0, 0)]
-                nothing_to_save = False
-            ip_seen = {k: v for k, v in ip_seen.items() if v in ranges}
-            if (
-                nothing_to_save
-            ):  # count hash now so that we do not re-save whois cache if not changed while processing
-                self._whois_changed(ranges, ip_seen)
-            event.set()
-
-            if fix:
-                # correction of a wrongly pickling: instead of {IPNetwork('...'): (IPNetwork('...'),
-                # we see {IPNetwork('...'): (<jsonpickle.unpickler._IDProxy object at 0x...>,
-                # Note that IPRange is pickled correctly.
-                # NOTE: I don't know whether this still happen.
-                for prefix, o in ranges.items():
-                    ranges[prefix] = (prefix, *o[1:])
-
-            return ip_seen, ranges
-        return {}, {}
-
-    def _whois_changed(self, ranges, ip_seen):
-        """Quick hashing to identify if something changed to spare time.
-        When cache json is 5.7 MB big, jsonpickling takes 3000 ms, hashing dict items 200 ms
-        and hashing values only 100 ms."""
-        logger.debug("Checking whois cache new records...")
-        h = hash(frozenset(ranges.values())) + hash(frozenset(ip_seen.values()))
-        if self.last_hash != h:
-            self.last_hash = h
-            return True
+    def load_whois_cache(self):
+        """open whois cache and remove expired results"""
+        if not self.whois.cache:
+            return {}, PrefixIndex()
+        return {}, PrefixIndex(store=self.open_whois_store())
+
+    def open_whois_store(self) -> Future:
+        """Open the global whois cache in a thread so that the file analysis does not wait.
+        Whoever needs the cache waits for the future (PrefixIndex does so when a WHOIS column is computed).
+        """
+        if not self.whois_store:
+            executor = ThreadPoolExecutor(1, thread_name_prefix="whois-cache")
+            self.whois_store = executor.submit(self._open_whois_store)
+            executor.shutdown(wait=False)
+        return self.whois_store
+
+    def _open_whois_store(self):
+        try:
+            store = WhoisStore(path := whois_cache_path())
+            if (p := path.with_name(WHOIS_CACHE_JSON)).exists():
+                # migrated first so that the former results are purged and evicted as well
+                event = lazy_print("... migrating big WHOIS cache ...")
+                try:
+                    store.migrate(p)
+                finally:
+                    event.set()
+            store.purge(
+                self.whois.ttl,
+                unknown=self.whois.delete_unknown,
+                domain_ttl=self.whois.domain_ttl,
+            )
+            store.evict(self.whois.cache_limit, self.whois.cache_eviction)
+        except sqlite3.Error as e:
+            logger.warning(f"Cannot use the WHOIS cache: {e}")
+            return None
+        return store
 
     ##
     # Store
@@ -317,41 +375,20 @@ class Wrapper:
             self.cache_file.write_text(string)
 
     def save_whois_cache(self):
-        if self.parser.ranges and self.env.whois.cache:
-            # we extract whois info from self.parser and save it apart for every convey instance
-            if (
-                self.whois_not_loaded
-            ):  # if we wanted a fresh result, global whois cache was not used and we have to merge it
-                ip_seen, ranges = self.load_whois_cache()
-                ip_seen = {**ip_seen, **self.parser.ip_seen}
-                ranges = {**ranges, **self.parser.ranges}
-                self.whois_not_loaded = False
-            else:
-                ip_seen, ranges = self.parser.ip_seen, self.parser.ranges
-            if self._whois_changed(ranges, ip_seen):
-                # note that ip_seen MUST be placed before ranges due to https://github.com/jsonpickle/jsonpickle/issues/280
-                # That way, a netaddr object (IPNetwork, IPRange) are defined as value in ip_seen and not as key in range.
-                # Update version 1.3.1: However this was not enough, serializing object as dict keys was still a problem.
-                # So we are manually converting them to int-tuples.
-                event = lazy_print("... saving big WHOIS cache ...")
-                ranges_serializable = {(k.first, k.last): v for k, v in ranges.items()}
-                encoded = jsonpickle.encode([ip_seen, ranges_serializable], keys=True)
-                # noinspection PyBroadException
-                try:
-                    jsonpickle.decode(encoded, keys=True)
-                except Exception:  # again, I met a strangely formed JSON
-                    type_, value, tb = sys.exc_info()
-                    body = (
-                        f"```bash\n{traceback.format_exc()}```\n\n"
-                        f"```json5\n{tb.tb_next.tb_frame.f_locals}\n```\n\n"
-                        f"```json5\n{ip_seen}```\n\n```json5\n{ranges}```"
-                    )
-                    print("The program will recover but without saving WHOIS cache.")
-                    Config.github_issue("Cannot jsonpickle whois", body)
-                else:
-                    Path(config_dir, WHOIS_CACHE).write_text(encoded)
-                finally:
-                    event.set()  # save cache
+        # Results are written to the global whois cache when created.
+        # However, if we wanted a fresh result, global whois cache was not used and we have to merge it.
+        if self.parser.ranges and self.env.whois.cache and self.whois_not_loaded:
+            if store := self.open_whois_store().result():
+                store.update(self.parser.ranges.values())
+        # Do not wait for the store nobody has used (ex: no WHOIS column). Maintain it only if something was written.
+        if (
+            self.whois_store
+            and self.whois_store.done()
+            and (store := self.whois_store.result())
+            and store.written
+        ):
+            store.evict(self.whois.cache_limit, self.whois.cache_eviction)
+            store.compact()
 
     def clear(self):
         self.check_ods() or self.check_xlsx() or self.check_xls() or self.check_log()
@@ -1,10 +1,15 @@
 from dataclasses import dataclass
 from convey.dialogue import Cancelled
 from convey.controller import Controller
+from convey.whois_client import WhoisClient
 from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from io import StringIO
 import shlex
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Thread
+from time import sleep
 from subprocess import PIPE, run
+from tempfile import TemporaryDirectory
 import sys
 import os
 import logging
@@ -52,6 +57,110 @@ CONSUMPTION = p("consumption.csv")
 p("red-permission.gif").chmod(S_IRUSR | S_IRGRP)  # make file unreadable to others
 
 
+class FakeWhoisServer(ThreadingTCPServer):
+    """Local stand-in for a WHOIS server at a random port.
+    Replies the text from `responses` whose key is the query string.
+
+    with FakeWhoisServer({"1.2.3.4": "inetnum: ..."}) as server:
+        server.address  # "127.0.0.1:port"
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, responses: dict[str, str], default="", delay=0):
+        self.responses = responses
+        self.default = default
+        self.delay = delay
+        "seconds before replying"
+        self.queries = []
+        "received query strings"
+
+        class Handler(StreamRequestHandler):
+            def handle(handler):
+                self.reply(handler)
+
+        super().__init__(("127.0.0.1", 0), Handler)
+
+    def reply(self, handler: StreamRequestHandler):
+        query = handler.rfile.readline().decode().strip()
+        self.queries.append(query)
+        sleep(self.delay)
+        handler.wfile.write(self.responses.get(query, self.default).encode())
+
+    @property
+    def address(self):
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+@contextmanager
+def whois_root(address: str):
+    """Let the native WHOIS client start at the given root server, the registries it knows forgotten.
+
+    with FakeWhoisServer({}, "refer: whois.ripe.net\n") as root, whois_root(root.address):
+        WhoisClient().get_registry("10.1.2.3")  # "whois.ripe.net"
+    """
+    root_server, WhoisClient.root_server = WhoisClient.root_server, address
+    WhoisClient.ip_registries.clear()
+    WhoisClient.tld_registries.clear()
+    try:
+        yield
+    finally:
+        WhoisClient.root_server = root_server
+        # the registries found are the local servers that are closing
+        WhoisClient.ip_registries.clear()
+        WhoisClient.tld_registries.clear()
+
+
+@contextmanager
+def fake_whois(response: str, delay=0):
+    """Local registry replying the response to every query, referred to by a local root server the native WHOIS client starts at.
+
+    with fake_whois("inetnum: ...") as (registry, root):
+        registry.queries  # ["10.1.2.3"]
+    """
+    with FakeWhoisServer({}, response, delay) as registry, FakeWhoisServer(
+        {}, f"refer: {registry.address}\n"
+    ) as root, whois_root(root.address):
+        yield registry, root
+
+
+class FakeBulkWhoisServer(FakeWhoisServer):
+    """Local stand-in for a Team Cymru style bulk whois server.
+    Replies the line from `responses` whose key is the IP, for every IP of a `begin ... end` session.
+
+    with FakeBulkWhoisServer({"8.8.8.8": "15169 | 8.8.8.8 | 8.8.8.0/24 | US | arin | 1992-12-01 | GOOGLE, US"}) as server:
+        server.queries  # [["8.8.8.8"]] IPs of the sessions
+    """
+
+    def reply(self, handler: StreamRequestHandler):
+        ips = []
+        for line in handler.rfile:
+            line = line.decode().strip()
+            if line == "end":
+                break
+            if line not in ("begin", "verbose"):
+                ips.append(line)
+        self.queries.append(ips)
+        lines = [
+            "Bulk mode; whois.cymru.com [2026-10-18 10:00:00 +0000]",
+            "AS      | IP               | BGP Prefix          | CC | Registry | Allocated  | AS Name",
+            *(
+                self.responses.get(ip, f"NA      | {ip:16} | NA                  |    | other    |            | NA")
+                for ip in ips
+            ),
+        ]
+        handler.wfile.write(("\n".join(lines) + "\n").encode())
+
+
 class Convey:
     """While we prefer to check the results with .check method
     (quicker, directly connected with the internals of the library),
@@ -203,7 +312,11 @@ class TestAbstract(TestCase):
             "--crash-post-mortem",
             "False",
             "--github-crash-submit",
-            "False"
+            "False",
+            "--whois.cache-file",
+            str(self.get_config_dir() / ".convey-whois-cache.sqlite"),
+            "--whois.offline-index",
+            str(self.get_config_dir() / ".convey-offline-index"),
         ]
         if filename:
             args.extend(("--file", str(filename)))
@@ -240,6 +353,14 @@ class TestAbstract(TestCase):
 
         return _CheckResult(c, stdout, logsout)
 
+    def get_config_dir(self) -> Path:
+        """Temporary directory of the test standing for the config dir, the user's caches stay untouched."""
+        if not hasattr(self, "_config_dir"):
+            temp = TemporaryDirectory()
+            self.addCleanup(temp.cleanup)
+            self._config_dir = Path(temp.name)
+        return self._config_dir
+
     def _check_input(self,pattern, out):
             if pattern is None:  # we do not want to do any checks
                 pass
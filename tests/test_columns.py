@@ -1,3 +1,10 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep
+
+from convey.file_pool import FilePool
+from convey.memo import EdgeMemo
+from convey.types import Types, memoized
 from tests.shared import SHEET_CSV, Convey, TestAbstract
 
 
@@ -21,3 +28,86 @@ class TestColumns(TestAbstract):
         lines = Convey()("--split email", "one@example.com\nsecond@example.com")
         [self.assertIn(s, lines) for s in
          ('* Saved to second@example.com', '"second@example.com"', '* Saved to one@example.com', '"one@example.com"')]
+
+    def test_threads(self):
+        """ Threads finishing the rows in a different order than read keep the output order """
+        with TemporaryDirectory() as temp:
+            file = Path(temp, "rows.csv")
+            file.write_text("".join(f"{i}\n" for i in range(40)))
+            # the row computation time varies
+            cmd = "-f code,1,'import time;time.sleep(ord(x[-1])%7/200);x+=\"A\"' --threads "
+            single = self.check(None, cmd + "0", filename=file).stdout
+            self.assertEqual('"39","39A"', single[-1])
+            self.check(single, cmd + "8", filename=file)
+            self.check(single, cmd + "0 --processes 3", filename=file)
+
+    def test_threads_unique(self):
+        """ The rows skipped by the unique filter are not computed ahead """
+        with TemporaryDirectory() as temp:
+            file, log = Path(temp, "rows.csv"), Path(temp, "computed")
+            file.write_text("a\nb\na\na\nb\nc\n")
+            # every computation leaves a file
+            cmd = (f"-f code,1,'import time;from pathlib import Path;"
+                   f"Path(\"{log}\"+x+str(time.time_ns())).touch();x+=\"A\"' --unique 1 --threads ")
+            for threads in ("4", "0 --processes 2"):
+                self.check(['"a","aA"', '"b","bA"', '"c","cA"'], cmd + threads, filename=file)
+                self.assertEqual(["a", "b", "c"], sorted(p.name[8] for p in Path(temp).glob("computed*")))
+                [p.unlink() for p in Path(temp).glob("computed*")]
+
+    def test_memo(self):
+        """ A value repeated among the rows is converted once """
+        with TemporaryDirectory() as temp:
+            file = Path(temp, "urls.csv")
+            file.write_text("url\nhttp://memo.example.com/a\nhttp://memo.example.com/b\n"
+                            "http://memo.example.com/a\nhttp://memo.example.org/\n")
+            logs = self.check(None, "-f hostname", filename=file).logs
+            self.assertIn("INFO:convey.processor:Memoized conversions: url → hostname 1 hits / 3 misses", logs)
+            logs = self.check(None, "-f hostname --memo-size 0", filename=file).logs
+            self.assertFalse([line for line in logs if "Memoized" in line])
+
+        # the results depending on the network (ex: DNS in a long-running daemon) expire
+        self.assertTrue(memoized[Types.hostname, Types.ip])
+        self.assertFalse(memoized[Types.url, Types.hostname])
+        calls = []
+        memo = EdgeMemo(Types.hostname, Types.ip, lambda x: calls.append(x) or x, 10, ttl=0.1)
+        memo("a"), memo("a")
+        self.assertEqual(["a"], calls)
+        sleep(0.15)
+        memo("a")
+        self.assertEqual(["a", "a"], calls)
+
+    def test_precompute(self):
+        """ A distinct value is computed once, before the rows are processed """
+        with TemporaryDirectory() as temp:
+            file = Path(temp, "rows.csv")
+            file.write_text("a\nb\na\na\nb\n")
+            cmd = "-f code,1,'print(\"computing\");x+=\"A\"' -f code,2,'print(\"again\");x+=\"B\"' --precompute 2"
+            self.check(["computing", "computing", "again", "again",
+                        '"a","aA","aAB"', '"b","bA","bAB"', '"a","aA","aAB"', '"a","aA","aAB"', '"b","bA","bAB"'],
+                       cmd, filename=file)
+
+    def test_file_pool(self):
+        """ Many locations written through a few open files """
+        with TemporaryDirectory() as temp:
+            Path(temp, "l0").write_text("kept\n")
+            Path(temp, "l1").write_text("rewritten\n")
+            pool = FilePool(Path(temp), "excel", limit=3)
+            pool.buffer_size = 20  # a location buffers about two rows
+            pool.truncate("l1")
+            for i in range(100):
+                pool.writerow(f"l{i % 10}", [i])
+                self.assertLessEqual(len(pool), 3)
+            pool.close()
+            self.assertEqual(0, len(pool))
+            self.assertEqual("kept\n" + "".join(f"{i}\n" for i in range(0, 100, 10)), Path(temp, "l0").read_text())
+            self.assertEqual("".join(f"{i}\n" for i in range(1, 100, 10)), Path(temp, "l1").read_text())
+
+    def test_split_many(self):
+        with TemporaryDirectory() as temp:
+            file = Path(temp, "rows.csv")
+            file.write_text("".join(f"{i % 300}@example.com,{i}\n" for i in range(900)))
+            lines = self.check(None, "--split 1", filename=file).stdout
+            self.assertEqual(300 * 6, len(lines))
+            i = lines.index("* Saved to 7@example.com")
+            self.assertEqual(["7@example.com,7", "7@example.com,307", "7@example.com,607"],
+                             lines[i + 2:i + 5])
@@ -1,6 +1,7 @@
 from base64 import b64encode
 from datetime import datetime
 
+from convey.public_suffix import registered_domain
 from tests.shared import HELLO_B64, Convey, TestAbstract
 
 convey = Convey()
@@ -51,6 +52,13 @@ class TestFields(TestAbstract):
     def test_hostname(self):
         self.assertIn("hostname", convey("--single-detect", text="_spf.google.com"))
 
+    def test_public_suffix(self):
+        """The suffix is looked up in the Public Suffix List bundled, not just the last label."""
+        self.check("co.uk", "-f tld[suffix]", "www.example.co.uk")
+        self.check("uk", "-f tld[ccTLD]", "www.example.co.uk")
+        self.assertEqual("xyz.com.br", registered_domain("website.xyz.com.br"))
+        self.assertEqual("", registered_domain("com.br"))
+
     def test_timestamp(self):
         self.assertIn("timestamp", convey("--single-detect", text="26. 03. 1999"))
         time = datetime.now()
@@ -0,0 +1,1110 @@
+import json
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Timer
+from time import monotonic, sleep, time
+from unittest import TestCase
+
+import jsonpickle
+from netaddr import IPAddress, IPNetwork, IPRange
+
+from convey.config import Config
+from convey.mmdb import MmdbReader
+from convey.offline_index import OfflineIndex
+from convey.prefix_index import PrefixIndex
+from convey.prefix_table import PrefixTable
+from convey.processor import _JournalDict, _JournalIndex, _Worker
+from convey.rate_limiter import (
+    CircuitBreaker,
+    RateLimiter,
+    ServerUnavailable,
+    TokenBucket,
+)
+from convey.types import Types, methods
+from convey.whois import Whois
+from convey.whois_bulk import BulkWhois, parse as parse_bulk
+from convey.whois_client import REFERRAL_MARK, WhoisClient
+from convey.whois_parser import ParsedResponse
+from convey.whois_store import WhoisStore
+from convey.wrapper import Wrapper, whois_reparse
+from tests.shared import (
+    FakeBulkWhoisServer,
+    FakeWhoisServer,
+    TestAbstract,
+    fake_whois,
+    whois_root,
+)
+
+CORPUS = Path(__file__).parent / "test_data" / "whois"
+
+RIPE_RESPONSE = """% Abuse contact for '10.1.0.0 - 10.1.255.255' is 'abuse@example.com'
+
+inetnum:        10.1.0.0 - 10.1.255.255
+netname:        EXAMPLE-NET
+country:        CZ
+
+route:          10.1.0.0/16
+origin:         AS1234
+"""
+
+
+class TestPrefixIndex(TestCase):
+    def test_find(self):
+        ranges = PrefixIndex()
+        broad = IPRange("10.0.0.0", "10.255.255.255")
+        narrow = IPNetwork("10.1.0.0/16")
+        sibling = IPRange("10.2.0.0", "10.2.0.255")
+        ipv6 = IPNetwork("2001:db8::/32")
+        for prefix in (sibling, broad, ipv6, narrow):
+            ranges[prefix] = (prefix, "local")
+
+        self.assertEqual(narrow, ranges.find("10.1.2.3"))  # the most specific prefix wins
+        self.assertEqual(broad, ranges.find("10.3.0.1"))  # skip the sibling prefixes that do not contain the IP
+        self.assertEqual(sibling, ranges.find("10.2.0.0"))
+        self.assertEqual(ipv6, ranges.find("2001:db8::1"))
+        self.assertIsNone(ranges.find("11.0.0.0"))
+        self.assertIsNone(ranges.find("invalid"))
+
+        # index stays consistent when a prefix expires
+        del ranges[narrow]
+        self.assertEqual(broad, ranges.find("10.1.2.3"))
+        del ranges[broad]
+        self.assertIsNone(ranges.find("10.1.2.3"))
+        self.assertEqual(2, len(ranges))
+        self.assertIn(IPRange("10.2.0.0", "10.2.0.255"), ranges)
+
+    def test_miss_among_many_prefixes(self):
+        ranges = PrefixIndex()
+        for i in range(20_000):
+            prefix = IPRange(i * 256, i * 256 + 127)
+            ranges[prefix] = (prefix, "local")
+
+        start = monotonic()
+        for i in range(1000):
+            self.assertIsNone(ranges.find(IPAddress(19_999 * 256 + 128 + i % 128)))
+        # a miss does not walk back over the preceding prefixes (that took seconds)
+        self.assertLess(monotonic() - start, 0.5)
+
+    def test_nested_in_any_order(self):
+        prefixes = [
+            IPNetwork(p)
+            for p in ("10.0.0.0/8", "10.0.0.0/16", "10.0.1.0/24", "10.0.2.0/24", "10.1.0.0/16", "10.0.0.0/24")
+        ] + [IPRange("10.0.1.128", "10.0.2.127")]  # overlaps two prefixes
+        ips = ["10.0.0.1", "10.0.1.1", "10.0.1.200", "10.0.2.1", "10.0.2.200", "10.0.3.1", "10.1.0.1", "11.0.0.1"]
+        for rotation in range(len(prefixes)):
+            ranges = PrefixIndex()
+            for prefix in prefixes[rotation:] + prefixes[:rotation]:
+                ranges[prefix] = (prefix, "local")
+            for removed in prefixes[rotation::2]:
+                del ranges[removed]
+            for ip in ips:
+                # the containing prefix with the nearest lower first IP (and the narrowest of them)
+                expected = max(
+                    (p for p in ranges if IPAddress(ip) in p), key=lambda p: (p.first, -p.last), default=None
+                )
+                self.assertEqual(expected, ranges.find(ip), (rotation, ip))
+
+    def test_store_opened_in_background(self):
+        with TemporaryDirectory() as temp:
+            future = Future()
+            ranges = PrefixIndex(store=future)
+            self.assertEqual(0, len(ranges))  # does not wait for the store
+            timer = Timer(0.1, lambda: future.set_result(WhoisStore(Path(temp, "db"))))
+            timer.start()
+            self.assertIsNone(ranges.find("10.1.2.3"))  # waits
+            prefix = IPNetwork("10.0.0.0/8")
+            ranges[prefix] = (prefix, "local", None, "", "", "cz", "", int(time()))
+            self.assertEqual(prefix, ranges.store.find(IPAddress("10.1.2.3"))[0])
+            timer.join()
+
+
+class TestWhoisStore(TestCase):
+    def test_store(self):
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "cache.sqlite")
+            store = WhoisStore(path)
+            now = int(time())
+            broad = IPRange("10.0.0.0", "10.255.255.255")
+            narrow = IPNetwork("10.1.0.0/16")
+            siblings = [IPNetwork(f"10.2.{i}.0/24") for i in range(256)]
+            ipv6 = IPNetwork("2001:db8::/32")
+            store.update(
+                (prefix, "local", "", "", "", "cz", "", now)
+                for prefix in (broad, narrow, ipv6, *siblings)
+            )
+            store.put((IPNetwork("11.0.0.0/8"), "abroad", "", "", "", "de", "", 0))
+            store.close()
+
+            # results survive reopening
+            store = WhoisStore(path)
+            self.assertEqual(narrow, store.find(IPAddress("10.1.2.3"))[0])
+            self.assertEqual(
+                broad, store.find(IPAddress("10.3.0.1"))[0]
+            )  # not confused by the siblings on the way
+            self.assertEqual(siblings[-1], store.find(IPAddress("10.2.255.1"))[0])
+            self.assertEqual(ipv6, store.find(IPAddress("2001:db8::1"))[0])
+            self.assertEqual("cz", store.find(IPAddress("10.1.2.3"))[5])
+            self.assertIsNone(store.find(IPAddress("12.0.0.1")))
+
+            store.delete(narrow)
+            self.assertEqual(broad, store.find(IPAddress("10.1.2.3"))[0])
+
+            # expired results deleted
+            self.assertEqual("de", store.find(IPAddress("11.0.0.1"))[5])
+            store.purge(3600)
+            self.assertIsNone(store.find(IPAddress("11.0.0.1")))
+            self.assertEqual(258, len(store))
+
+    def test_journal(self):
+        """Results are readable by another connection right after inserted, without closing the store."""
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "cache.sqlite")
+            store = WhoisStore(path)
+            store.put((IPNetwork("10.0.0.0/8"), "local", None, "", "", "cz", "", 1))
+            self.assertTrue(Path(temp, "cache.sqlite-wal").stat().st_size)
+            with closing(sqlite3.connect(path)) as conn:
+                self.assertEqual(
+                    [("cz",)], conn.execute("SELECT country FROM prefixes").fetchall()
+                )
+            store.close()
+            self.assertFalse(Path(temp, "cache.sqlite-wal").exists())  # checkpointed
+
+    def test_shared(self):
+        """Processes sharing the store see each other's results."""
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "cache.sqlite")
+            first, second = WhoisStore(path), WhoisStore(path)
+            self.assertIsNone(second.find(IPAddress("10.1.2.3")))
+            prefix = IPNetwork("10.1.2.0/24")
+            first.put((prefix, "local", None, "", "", "cz", "", int(time())))
+            self.assertEqual(prefix, second.find(IPAddress("10.1.2.3"))[0])
+
+            # the table written by another process is used
+            first.compact(force=True)
+            first.put((IPNetwork("10.0.0.0/8"), "local", None, "", "", "cz", "", 1))
+            self.assertEqual(prefix, second.find(IPAddress("10.1.2.3"))[0])
+            self.assertEqual(1, second._table.entries)
+            first.delete(prefix)
+            self.assertEqual(
+                IPNetwork("10.0.0.0/8"), second.find(IPAddress("10.1.2.3"))[0]
+            )
+
+    def test_table(self):
+        with TemporaryDirectory() as temp:
+            store = WhoisStore(Path(temp, "cache.sqlite"))
+            now = int(time())
+            broad = IPRange("10.0.0.0", "10.255.255.255")
+            narrow = IPNetwork("10.1.0.0/16")
+            store.update(
+                (prefix, "local", None, "", "", "cz", "", now)
+                for prefix in (broad, narrow, IPNetwork("2001:db8::/32"))
+            )
+            self.assertFalse(store.compact())  # not enough changes
+            self.assertTrue(store.compact(force=True))
+            self.assertEqual(
+                (narrow, "local", None, "", "", "cz", "", now),
+                store.find(IPAddress("10.1.2.3")),
+            )
+            self.assertEqual(broad, store.find(IPAddress("10.2.0.0"))[0])
+            self.assertIsNone(store.find(IPAddress("11.0.0.0")))
+
+            # the rows changed since the table was written are taken into account
+            narrower = IPNetwork("10.1.2.0/24")
+            store.put((narrower, "local", None, "", "", "de", "", now))
+            self.assertEqual(narrower, store.find(IPAddress("10.1.2.3"))[0])
+            store.put((narrow, "local", None, "", "", "sk", "", now))
+            self.assertEqual("sk", store.find(IPAddress("10.1.3.0"))[5])
+            store.delete(narrow)
+            self.assertEqual(broad, store.find(IPAddress("10.1.3.0"))[0])
+            store.close()
+
+            # the table is reused when reopened
+            store = WhoisStore(Path(temp, "cache.sqlite"))
+            self.assertEqual(3, store._table.entries)
+            self.assertEqual(narrower, store.find(IPAddress("10.1.2.3"))[0])
+            self.assertEqual(broad, store.find(IPAddress("10.1.3.0"))[0])
+
+    def test_evict(self):
+        with TemporaryDirectory() as temp:
+            store = WhoisStore(Path(temp, "cache.sqlite"))
+            prefixes = [IPNetwork(f"10.{i}.0.0/16") for i in range(10)]
+            store.update((p, "local", None, "", "", "cz", "", 1) for p in prefixes)
+            for i in (0, 1, 2, 2):
+                store.find(IPAddress(f"10.{i}.0.1"))
+            store.find(IPAddress("11.0.0.1"))
+
+            self.assertEqual(
+                {"entries": 10, "lookups": 5, "hits": 4},
+                {k: v for k, v in store.stats().items() if k != "bytes"},
+            )
+            self.assertGreater(store.stats()["bytes"], 0)
+
+            self.assertEqual(0, store.evict(10))
+            self.assertEqual(6, store.evict(5, "lfu"))  # down to 90 % of the limit
+            self.assertEqual(4, len(store))
+            self.assertIsNotNone(store.find(IPAddress("10.2.0.1")))  # the most hit kept
+            self.assertEqual(
+                2, store.evict(3, "lru")
+            )  # the ones hit at the same second are ordered by hits
+            self.assertIsNotNone(store.find(IPAddress("10.2.0.1")))
+            self.assertIsNone(store.find(IPAddress("10.5.0.1")))
+
+    def test_archive(self):
+        with TemporaryDirectory() as temp:
+            store = WhoisStore(Path(temp, "cache.sqlite"))
+            prefix = IPNetwork("10.0.0.0/8")
+            result = (prefix, "local", "", "", "", "cz", "", 1)
+            store.put(result)
+            store.archive(prefix, "10.1.2.3", [("general", None, "country: cz")])
+            store.put(result)  # replacing the result keeps the archive
+            self.assertEqual(
+                [(result, "10.1.2.3", [("general", None, "country: cz")])],
+                store.archived(),
+            )
+            store.delete(prefix)
+            self.assertEqual([], store.archived())
+            store.close()
+
+    def test_domains(self):
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "cache.sqlite")
+            store = WhoisStore(path)
+            now = int(time())
+            store.put_domain(
+                "example.com", ("", "local", "", "", "", "", "a@b.cz", now)
+            )
+            store.put_domain("old.com", ("", "local", "", "", "", "", "a@b.cz", 1))
+            store.close()
+
+            store = WhoisStore(path)
+            self.assertEqual(
+                ("", "local", "", "", "", "", "a@b.cz", now),
+                store.find_domain("example.com"),
+            )
+            store.purge(-1, domain_ttl=3600)
+            self.assertIsNone(store.find_domain("old.com"))
+            self.assertIsNotNone(store.find_domain("example.com"))
+            store.close()
+
+    def test_migrate(self):
+        with TemporaryDirectory() as temp:
+            legacy = Path(temp, "cache.json")
+            prefix = IPRange("10.1.0.0", "10.1.255.255")
+            result = (prefix, "local", "abuse@example.com", "as1234", "", "cz", "", 1)
+            legacy.write_text(
+                jsonpickle.encode(
+                    [{"10.1.2.3": prefix}, {(prefix.first, prefix.last): result}],
+                    keys=True,
+                )
+            )
+            store = WhoisStore(Path(temp, "cache.sqlite"))
+            store.migrate(legacy)
+            self.assertEqual(result, store.find(IPAddress("10.1.2.3")))
+            self.assertFalse(legacy.exists())
+
+            # a result the store cannot take rolls the whole migration back and the file is kept
+            broken = IPRange("10.2.0.0", "10.2.255.255")
+            fine = IPRange("10.3.0.0", "10.3.255.255")
+            legacy.write_text(
+                jsonpickle.encode(
+                    [
+                        {},
+                        {
+                            (fine.first, fine.last): (fine, *result[1:]),
+                            (broken.first, broken.last): (broken, *result[1:], "extra"),
+                        },
+                    ],
+                    keys=True,
+                )
+            )
+            with self.assertRaises(sqlite3.Error):
+                store.migrate(legacy)
+            self.assertTrue(legacy.exists())
+            self.assertIsNone(store.find(IPAddress("10.3.2.3")))
+
+
+class TestPrefixTable(TestCase):
+    def test_find(self):
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "table")
+            prefixes = [
+                IPRange("10.0.0.0", "10.255.255.255"),
+                IPNetwork("10.1.0.0/16"),
+                IPRange("10.1.2.0", "10.1.2.10"),
+                IPNetwork("10.1.2.8/30"),  # overlaps the previous range
+                IPNetwork("2001:db8::/32"),
+            ]
+            PrefixTable.write(
+                path,
+                (
+                    (i, (prefix, "local", None, f"as{i}", "", "cz", "", i))
+                    for i, prefix in enumerate(prefixes)
+                ),
+                seq=4,
+                removed=0,
+            )
+            table = PrefixTable(path)
+            self.assertEqual((4, 0, 5), (table.seq, table.removed, table.entries))
+
+            def find(ip):
+                if hit := table.find(IPAddress(ip)):
+                    return prefixes.index(hit[1][0])
+
+            self.assertEqual(0, find("10.0.0.0"))
+            self.assertEqual(1, find("10.1.0.0"))
+            self.assertEqual(2, find("10.1.2.0"))
+            self.assertEqual(3, find("10.1.2.9"))
+            self.assertEqual(3, find("10.1.2.11"))
+            self.assertEqual(1, find("10.1.2.12"))
+            self.assertEqual(0, find("10.255.255.255"))
+            self.assertEqual(4, find("2001:db8::1"))
+            self.assertIsNone(find("9.255.255.255"))
+            self.assertIsNone(find("11.0.0.0"))
+            self.assertIsNone(find("::1"))
+            self.assertEqual(
+                (3, (prefixes[3], "local", None, "as3", "", "cz", "", 3)),
+                table.find(IPAddress("10.1.2.9")),
+            )
+            table.close()
+
+            path.write_bytes(b"invalid")
+            self.assertRaises(ValueError, PrefixTable, path)
+
+
+class TestRateLimiter(TestCase):
+    def test_bucket(self):
+        bucket = TokenBucket(20, burst=3)
+        start = monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertLess(monotonic() - start, 0.05)  # the burst passes immediately
+        for _ in range(2):
+            bucket.acquire()
+        self.assertGreaterEqual(monotonic() - start, 0.1)  # then paced by 1/20 s
+
+        bucket.pause(0.2)
+        start = monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(monotonic() - start, 0.2)
+
+    def test_limiter(self):
+        limiter = RateLimiter({"lacnic": 8, "other": 0})
+        self.assertTrue(limiter.paces("lacnic"))
+        self.assertFalse(limiter.paces("ripe"))
+        limiter.wait("whois.ripe.net -B")  # unlimited
+        limiter.wait("rwhois.example.com:4321")
+        self.assertEqual(
+            limiter._get_bucket("whois.lacnic.net"),
+            limiter._get_bucket("whois.lacnic.net:43"),
+        )
+
+    def test_breaker(self):
+        breaker = CircuitBreaker()
+        breaker.cooldown = 0.1
+        for _ in range(CircuitBreaker.threshold - 1):
+            breaker.failed("rwhois.example.com:4321")
+        breaker.check("rwhois.example.com:4321")  # not open yet
+        breaker.failed("rwhois.example.com:4321")
+        with self.assertRaises(ServerUnavailable):
+            breaker.check("rwhois.example.com:4321")
+        breaker.check("whois.ripe.net")  # other servers are not affected
+
+        sleep(0.1)
+        breaker.check("rwhois.example.com:4321")  # a trial query passes
+        with self.assertRaises(ServerUnavailable):  # the others wait for its result
+            breaker.check("rwhois.example.com:4321")
+        breaker.succeeded("rwhois.example.com:4321")
+        breaker.check("rwhois.example.com:4321")
+
+
+class TestWhoisClient(TestAbstract):
+    def test_referrals(self):
+        with FakeWhoisServer({}, RIPE_RESPONSE) as rwhois, FakeWhoisServer(
+            {}, f"CIDR: 10.0.0.0/8\nReferralServer: rwhois://{rwhois.address}/\n"
+        ) as registry, FakeWhoisServer(
+            {}, f"refer: {registry.address}\ninetnum: 10.0.0.0 - 10.255.255.255\n"
+        ) as root, whois_root(root.address):
+            client = WhoisClient()
+            response = client.query("10.1.2.3")
+            self.assertTrue(response.startswith(f"using server {registry.address}."))
+            self.assertIn(f"found a referral to {rwhois.address}.", response)
+            self.assertIn("netname:        example-net", response)
+
+            # the root server is asked only once for the whole block
+            client.query("10.200.0.1")
+            self.assertEqual(["10.1.2.3"], root.queries)
+            self.assertEqual(["10.1.2.3", "10.200.0.1"], registry.queries)
+
+            # querying a given server does not follow the referrals
+            response = client.query("10.1.2.3", f"{registry.address} -B")
+            self.assertEqual("-B 10.1.2.3", registry.queries[-1])
+            self.assertNotIn("found a referral", response)
+
+    def test_analyze(self):
+        """Native client response is parsed as the `whois` program output"""
+        with fake_whois(RIPE_RESPONSE) as (registry, root):
+            flags = "--whois.cache False --whois.native True"
+            self.check("as1234", f"-f asn {flags}", "10.1.2.3")
+            self.check("cz", f"-f country {flags}", "10.1.2.3")
+            self.check("abuse@example.com", f"-f abusemail {flags}", "10.1.2.3")
+
+    def test_reparse(self):
+        """Cached results are rebuilt from the archived responses without a query."""
+        # set up the environment; the archive is kept even if the new responses are not archived
+        self.check(None, "--version --whois.archive False")
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "cache.sqlite")
+            store = WhoisStore(path)
+            stale = IPNetwork("10.0.0.0/8")
+            store.put((stale, "local", "", "", "old-net", "cz", "", 1))
+            response = f"using server whois.ripe.net.\n{RIPE_RESPONSE.lower()}"
+            store.archive(stale, "10.1.2.3", [("general", None, response)])
+            store.close()
+
+            self.assertEqual(
+                "Reparsed 1 archived prefixes, 1 changed.", whois_reparse(path)
+            )
+            store = WhoisStore(path)
+            self.assertIsNone(store.find(IPAddress("10.200.0.1")))
+            self.assertEqual(
+                (
+                    IPRange("10.1.0.0", "10.1.255.255"),
+                    "local",
+                    "abuse@example.com",
+                    "as1234",
+                    "example-net",
+                    "cz",
+                    "abuse@example.com",
+                    1,
+                ),
+                store.find(IPAddress("10.1.2.3")),
+            )
+            # the archive moved to the new prefix
+            self.assertEqual(
+                IPRange("10.1.0.0", "10.1.255.255"), store.archived()[0][0][0]
+            )
+            store.close()
+
+            # reparsed again, the responses stay archived
+            self.assertEqual(
+                "Reparsed 1 archived prefixes, 0 changed.", whois_reparse(path)
+            )
+            store = WhoisStore(path)
+            [(result, target, exchanges)] = store.archived()
+            self.assertEqual(IPRange("10.1.0.0", "10.1.255.255"), result[0])
+            self.assertEqual("10.1.2.3", target)
+            self.assertEqual([("general", None, response)], exchanges)
+            store.close()
+
+    def test_save_unused_cache(self):
+        """At exit, the WHOIS cache nobody has used is not waited for, the unchanged one is not maintained."""
+        wrapper = self.check("Zm9v", "-f base64", "foo").controller.wrapper
+        wrapper.whois_store = Future()  # still opening
+        wrapper.save_whois_cache()
+
+        with TemporaryDirectory() as temp:
+            path = Path(temp, "cache.sqlite")
+            store = WhoisStore(path)
+            for prefix in (IPNetwork("10.0.0.0/8"), IPNetwork("11.0.0.0/8")):
+                store.put((prefix, "local", "", "", "", "cz", "", int(time())))
+            store.close()
+            wrapper.whois.cache_limit = 1
+            wrapper.whois_store = Future()
+            wrapper.whois_store.set_result(store := WhoisStore(path))
+            wrapper.save_whois_cache()
+            self.assertEqual(2, len(store))  # not evicted
+
+            store.put((IPNetwork("12.0.0.0/8"), "local", "", "", "", "cz", "", int(time())))
+            wrapper.save_whois_cache()
+            self.assertEqual(0, len(store))  # evicted down to 90 % of the limit
+            store.close()
+
+    def test_unreachable(self):
+        with FakeWhoisServer({}) as root:
+            pass  # the server is down now
+        with whois_root(root.address):
+            self.assertIn("refused", WhoisClient().query("10.1.2.3"))
+
+    def test_concurrent_batch(self):
+        with fake_whois(RIPE_RESPONSE) as (registry, root), TemporaryDirectory() as temp:
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n10.1.2.3\n10.1.2.4\n10.1.2.3\n")
+            self.check(
+                [
+                    '"ip","country"',
+                    '"10.1.2.3","cz"',
+                    '"10.1.2.4","cz"',
+                    '"10.1.2.3","cz"',
+                ],
+                "-f country --whois.cache False --whois.native True --whois.concurrent-batch 10",
+                filename=source,
+            )
+            # single-flight: the IPs from the same network are resolved by a single query
+            self.assertEqual(1, len(registry.queries))
+
+    def test_single_flight(self):
+        """Concurrent lookups of the IPs from the same network wait for a single query."""
+        self.check(None, "--version --whois.cache False --whois.native True")  # set up the environment
+        Whois.init(defaultdict(int), PrefixIndex(), {}, defaultdict(set))
+        with fake_whois(RIPE_RESPONSE, delay=0.3) as (registry, root), ThreadPoolExecutor(10) as executor:
+            ips = [f"10.1.2.{i}" for i in range(1, 21)]
+            results = list(executor.map(lambda ip: Whois(ip).get, ips))
+        self.assertEqual({IPRange("10.1.0.0", "10.1.255.255")}, {get[0] for get in results})
+        self.assertEqual(1, len(root.queries))
+        self.assertEqual(1, len(registry.queries))
+
+    def test_domain(self):
+        """The hostnames of the same registered domain are asked just once."""
+        with fake_whois(
+            "domain: example.cz\nabuse-mailbox: abuse@registrar.example\n"
+        ) as (registry, root), TemporaryDirectory() as temp:
+            source = Path(temp, "hostnames.csv")
+            source.write_text("hostname\nwww.example.cz\nmail.example.cz\nexample.cz\n")
+            self.check(
+                [
+                    '"hostname","registrar_abusemail"',
+                    '"www.example.cz","abuse@registrar.example"',
+                    '"mail.example.cz","abuse@registrar.example"',
+                    '"example.cz","abuse@registrar.example"',
+                ],
+                "-f registrar_abusemail --whois.cache False --whois.native True",
+                filename=source,
+            )
+            self.assertEqual(["example.cz"], registry.queries)
+
+    def test_back_off(self):
+        """The network of a failed query is not asked again for a while."""
+        with FakeWhoisServer({}) as registry:
+            pass  # the registry is down
+        with FakeWhoisServer(
+            {}, f"refer: {registry.address}\n"
+        ) as root, whois_root(root.address), TemporaryDirectory() as temp:
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n10.1.2.3\n10.1.2.4\n10.2.0.1\n")
+            logs = self.check(
+                ['"ip","country"', '"10.1.2.3",""', '"10.1.2.4",""', '"10.2.0.1",""'],
+                "-f country --whois.cache False --whois.native True",
+                filename=source,
+            ).logs
+            # the networks are asked concurrently (`--threads auto`)
+            self.assertCountEqual(
+                [
+                    "WARNING:convey.whois:Whois general: connection refused",
+                    "WARNING:convey.whois:Whois general: connection refused",
+                    "WARNING:convey.whois:Whois 10.1.2.3: connection refused,"
+                    " its network is not asked again for 10 s",
+                    "WARNING:convey.whois:Whois 10.2.0.1: connection refused,"
+                    " its network is not asked again for 10 s",
+                ],
+                [line for line in logs if line.startswith("WARNING")],
+            )
+            self.assertCountEqual(["10.1.2.3", "10.2.0.1"], root.queries)
+
+    def test_root_single_flight(self):
+        """Concurrent lookups from the same IANA block ask the root server once."""
+        with FakeWhoisServer(
+            {}, "refer: whois.ripe.net\ninetnum: 10.0.0.0 - 10.255.255.255\n", delay=0.3
+        ) as root, whois_root(root.address), ThreadPoolExecutor(10) as executor:
+            client = WhoisClient()
+            ips = [f"10.{i}.0.1" for i in range(10)]
+            self.assertEqual(
+                ["whois.ripe.net"] * 10, list(executor.map(client.get_registry, ips))
+            )
+            self.assertEqual(1, len(root.queries))
+
+            # IPv6 blocks are cached too
+            root.default = "refer: whois.ripe.net\ninet6num: 2a00:0:0:0:0:0:0:0/12\n"
+            client.get_registry("2a00::1")
+            client.get_registry("2a01::1")
+            self.assertEqual(2, len(root.queries))
+
+    def test_failure_response(self):
+        """A server answering that the query failed counts as a failing one."""
+        with FakeWhoisServer({}, "%error:201: access denied\n") as registry:
+            client = WhoisClient()
+            client.query("10.1.2.3", registry.address)
+            self.assertEqual(1, client.breaker._failures[registry.address][0])
+
+    def test_program_breaker(self):
+        """The `whois` program path skips the servers that failed along the referrals."""
+        self.check(None, "--version --whois.native False")  # set up the environment
+        Whois.init(defaultdict(int), PrefixIndex(), {}, defaultdict(set))
+        calls = []
+
+        def exec_program(target, server_url=None):
+            calls.append(server_url)
+            return (
+                "using server whois.arin.net.\n% see the referral\n"
+                f"\n\n{REFERRAL_MARK}rwhois.example.com:4321.\n\nconnect: connection refused"
+            )
+
+        original, Whois._exec_program = Whois._exec_program, staticmethod(exec_program)
+        try:
+            with self.assertLogs("convey.whois", "WARNING"):
+                whois = [Whois(f"10.{i}.0.1") for i in range(CircuitBreaker.threshold)]
+            with self.assertRaises(ServerUnavailable):
+                Whois.breaker.check("rwhois.example.com:4321")
+            Whois.breaker.check("whois.arin.net")  # answered
+
+            response = whois[0]._query_program("10.9.0.1", "rwhois.example.com:4321")
+            self.assertIn("skipped after 3 failures", response)
+            self.assertEqual([None] * CircuitBreaker.threshold, calls)
+        finally:
+            Whois._exec_program = original
+
+    def test_program_rate_limit(self):
+        """The `whois` program path is paced by the registry it asked for the IANA block before."""
+        self.check(None, "--version --whois.native False")  # set up the environment
+        Whois.init(defaultdict(int), PrefixIndex(), {}, defaultdict(set))
+        waits = []
+        Whois.limiter.wait = waits.append
+
+        def exec_program(target, server_url=None):
+            return (
+                "using server whois.lacnic.net.\n% see the referral\n"
+                f"\n\n{REFERRAL_MARK}rwhois.example.com:4321.\n\nnetname: example-net"
+            )
+
+        original, Whois._exec_program = Whois._exec_program, staticmethod(exec_program)
+        try:
+            Whois("200.1.0.1")
+            Whois("200.2.0.1")
+            Whois("201.1.0.1")
+        finally:
+            Whois._exec_program = original
+        self.assertEqual(
+            [
+                "general",  # the registry of the block is not known yet
+                "rwhois.example.com:4321",  # the referred server was asked by the program
+                "whois.lacnic.net",
+                "rwhois.example.com:4321",
+                "general",  # another IANA block
+                "rwhois.example.com:4321",
+            ],
+            waits,
+        )
+
+    def test_prefetch(self):
+        with fake_whois(RIPE_RESPONSE) as (registry, root), TemporaryDirectory() as temp:
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n10.1.200.4\n10.1.2.3\n10.1.200.4\n")
+            self.check(
+                [
+                    '"ip","country"',
+                    '"10.1.200.4","cz"',
+                    '"10.1.2.3","cz"',
+                    '"10.1.200.4","cz"',
+                ],
+                "-f country --whois.cache False --whois.native True --whois.prefetch 1",
+                filename=source,
+            )
+            # the lowest IP found the prefix, the others were answered by the cache
+            self.assertEqual(["10.1.2.3"], registry.queries)
+
+    def test_processes(self):
+        with fake_whois(RIPE_RESPONSE) as (registry, root), TemporaryDirectory() as temp:
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n10.1.200.4\n10.1.2.3\n")
+            parser = self.check(
+                [
+                    '"ip","country"',
+                    '"10.1.200.4","cz"',
+                    '"10.1.2.3","cz"',
+                ],
+                "-f country --whois.cache False --whois.native True --processes 2",
+                filename=source,
+            ).controller.parser
+            # the findings of the worker processes were folded into the parser
+            self.assertEqual(1, sum(parser.whois_stats.values()))
+            self.assertEqual({"10.1.200.4", "10.1.2.3"}, parser.stats["ip_unique"])
+            self.assertEqual(2, len(parser.ip_seen))
+            self.assertEqual(1, len(parser.ranges))
+
+    def test_processes_without_whois(self):
+        """With no WHOIS column, the processes are not held back by the WHOIS cache being opened."""
+        opened, original = Event(), Wrapper._open_whois_store
+        Wrapper._open_whois_store = lambda self: opened.wait(30) and None
+        try:
+            with TemporaryDirectory() as temp:
+                source = Path(temp, "rows.csv")
+                source.write_text("".join(f"{i}\n" for i in range(3)))
+                self.check(
+                    ['"0","0A"', '"1","1A"', '"2","2A"'],
+                    "-f code,1,'x+=\"A\"' --whois.cache True --processes 2",
+                    filename=source,
+                )
+                self.assertFalse(opened.is_set())
+        finally:
+            opened.set()
+            Wrapper._open_whois_store = original
+
+    def test_fold_changes(self):
+        """The changes a worker made, including the deleted entries, are folded into the parent."""
+        self.check(None, "--version")  # set up the environment
+        stale, fresh = IPNetwork("10.0.0.0/8"), IPNetwork("10.1.0.0/16")
+        Whois.init(
+            defaultdict(int),
+            PrefixIndex({stale: (stale, "local")}),
+            {"10.1.2.3": stale, "10.2.0.1": stale},
+            defaultdict(set),
+        )
+        # in the worker
+        ranges, ip_seen = _JournalIndex(Whois.ranges), _JournalDict(Whois.ip_seen)
+        ranges.take()
+        del ranges[stale]  # expired
+        ranges[fresh] = (fresh, "local")
+        ip_seen["10.1.2.3"] = fresh
+        del ip_seen["10.2.0.1"]
+
+        _Worker.fold(({}, {}, {}, ip_seen.take(), ranges.take(), {"10.3.0.1"}))
+        self.assertEqual([fresh], list(Whois.ranges))
+        self.assertEqual(fresh, Whois.ranges.find("10.1.2.3"))
+        self.assertIsNone(Whois.ranges.find("10.2.0.1"))
+        self.assertEqual({"10.1.2.3": fresh}, Whois.ip_seen)
+        self.assertEqual({"10.3.0.1"}, Whois.queued_ips)
+
+
+BULK_RESPONSES = {
+    "8.8.8.8": "15169   | 8.8.8.8          | 8.8.8.0/24          | US | arin     | 1992-12-01 | GOOGLE, US",
+    "1.1.1.1": "13335   | 1.1.1.1          | 1.1.1.0/24          | AU | apnic    | 2011-08-11 | CLOUDFLARENET, US",
+    "9.9.9.9": "19281   | 9.9.9.9          | 9.9.9.0/24          | US | arin     | 2016-03-03 | QUAD9-AS-1, US",
+    "208.67.222.222": "36692   | 208.67.222.222   | 208.67.222.0/24     | US | arin     | 2006-07-21 | OPENDNS, US",
+}
+
+
+class TestBulkWhois(TestAbstract):
+    def test_parse(self):
+        self.assertEqual(
+            {
+                "8.8.8.8": ("as15169", "us", "8.8.8.0/24", "GOOGLE, US"),
+                "10.0.0.1": ("", "", "", ""),
+            },
+            parse_bulk(
+                [
+                    "Bulk mode; whois.cymru.com [2026-10-18 10:00:00 +0000]",
+                    "AS      | IP               | BGP Prefix          | CC | Registry | Allocated  | AS Name",
+                    BULK_RESPONSES["8.8.8.8"],
+                    "NA      | 10.0.0.1         | NA                  |    | other    |            | NA",
+                    "Error: no ASN or IP match on line 4.",
+                ]
+            ),
+        )
+
+    def test_bulk(self):
+        with FakeBulkWhoisServer(
+            BULK_RESPONSES
+        ) as server, TemporaryDirectory() as temp:
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n8.8.8.8\n1.1.1.1\n8.8.8.8\n")
+            self.check(
+                [
+                    '"ip","asn","country","prefix","as_org"',
+                    '"8.8.8.8","as15169","us","8.8.8.0-8.8.8.255","GOOGLE, US"',
+                    '"1.1.1.1","as13335","au","1.1.1.0-1.1.1.255","CLOUDFLARENET, US"',
+                    '"8.8.8.8","as15169","us","8.8.8.0-8.8.8.255","GOOGLE, US"',
+                ],
+                f"-f asn -f country -f prefix -f as_org --whois.bulk {server.address}"
+                " --whois.prefetch 100 --whois.cache False",
+                filename=source,
+            )
+            # the distinct IPs sent in a single session
+            self.assertEqual([["1.1.1.1", "8.8.8.8"]], server.queries)
+
+            # without a pre-pass, the IPs of a batch of rows are sent together
+            source.write_text("ip\n9.9.9.9\n208.67.222.222\n8.8.8.8\n")
+            self.check(
+                [
+                    '"ip","asn"',
+                    '"9.9.9.9","as19281"',
+                    '"208.67.222.222","as36692"',
+                    '"8.8.8.8","as15169"',
+                ],
+                f"-f asn --whois.bulk {server.address} --whois.cache False",
+                filename=source,
+            )
+            self.assertEqual(["9.9.9.9", "208.67.222.222"], server.queries[-1])
+            # the bulk whois has no incident contact, WHOIS answers it directly
+            self.assertNotIn((Types.ip, Types.incident_contact), methods)
+
+    def test_failure_backoff(self):
+        with FakeBulkWhoisServer({}) as server:
+            pass
+        # server is down now
+        self.check(None, f"--version --whois.bulk {server.address}")  # set up the environment
+        with self.assertLogs("convey.whois_bulk", "WARNING") as logs:
+            BulkWhois.resolve(["8.8.8.8"])
+        self.assertIn("not asked again for 60 s", logs.output[0])
+        self.assertIsNone(BulkWhois.get("8.8.8.8"))  # WHOIS is asked instead
+        with self.assertNoLogs("convey.whois_bulk", "WARNING"):
+            BulkWhois.resolve(["8.8.8.8"])  # not asked meanwhile
+        self.assertEqual(server.address, Config.get_env().whois.bulk)  # the server stays configured
+
+        BulkWhois._failure = BulkWhois._failure[0], 0  # the backoff passed
+        with self.assertLogs("convey.whois_bulk", "WARNING") as logs:
+            BulkWhois.resolve(["8.8.8.8"])
+        self.assertIn("not asked again for 120 s", logs.output[0])
+
+
+DELEGATED = """2|ripencc|1700000000|4|19830705|20231114|+0100
+ripencc|*|ipv4|*|3|summary
+ripencc|CZ|ipv4|10.1.0.0|65536|20000101|allocated|abc
+ripencc|SK|ipv4|10.2.0.0|256|20000101|assigned|def
+ripencc||ipv4|10.3.0.0|256||available
+ripencc|CZ|ipv6|2001:db8::|32|20000101|allocated|abc
+ripencc|CZ|asn|1234|1|20000101|allocated|abc
+"""
+IP2ASN = "10.1.0.0\t10.1.127.255\t1234\tCZ\tEXAMPLE\n10.1.128.0\t10.1.255.255\t0\tNone\tNot routed\n"
+PFX2AS = "10.2.0.0\t16\t5678\n10.2.0.0\t24\t1234_5678\n2001:db8:1::\t48\t1234\n"
+
+
+class TestOfflineIndex(TestAbstract):
+    def test_index(self):
+        with TemporaryDirectory() as temp:
+            sources = [Path(temp, f) for f in ("delegated", "ip2asn.tsv", "pfx2as")]
+            for source, text in zip(sources, (DELEGATED, IP2ASN, PFX2AS)):
+                source.write_text(text)
+            path = Path(temp, "index")
+            index = OfflineIndex(sources, path)
+            self.assertEqual("cz", index.country("10.1.2.3"))
+            self.assertEqual("sk", index.country("10.2.0.1"))
+            self.assertIsNone(index.country("10.2.1.1"))
+            self.assertIsNone(index.country("10.3.0.1"))  # available
+            self.assertEqual("cz", index.country("2001:db8:ffff::1"))
+            self.assertIsNone(index.country("invalid"))
+
+            self.assertEqual("as1234", index.asn("10.1.2.3"))
+            self.assertIsNone(index.asn("10.1.200.1"))  # not routed
+            self.assertEqual("as1234", index.asn("10.2.0.1"))  # the most specific
+            self.assertEqual("as5678", index.asn("10.2.1.1"))
+            self.assertEqual("as1234", index.asn("2001:db8:1:2::1"))
+            self.assertIsNone(index.asn("2001:db8:2::1"))
+
+            # the index is rebuilt only when a source changes
+            mtime = path.stat().st_mtime_ns
+            OfflineIndex(sources, path)
+            self.assertEqual(mtime, path.stat().st_mtime_ns)
+            self.assertIsNone(OfflineIndex(sources[:1], path).asn("10.1.2.3"))
+
+    def test_threads(self):
+        """The row threads build the index once."""
+        with TemporaryDirectory() as temp, ThreadPoolExecutor(10) as executor:
+            delegated = Path(temp, "delegated")
+            delegated.write_text(DELEGATED)
+            self.check(
+                None,
+                f"--version --whois.offline {delegated} --whois.offline-index {temp}/index",
+            )  # set up the environment
+            indexes = list(executor.map(lambda _: OfflineIndex.get(), range(10)))
+            self.assertEqual(1, len(set(map(id, indexes))))
+            self.assertEqual("sk", indexes[0].country("10.2.0.1"))
+
+    def test_fallback(self):
+        """Country is answered offline, WHOIS is asked only for the IP not in the files."""
+        with fake_whois(RIPE_RESPONSE) as (registry, root), TemporaryDirectory() as temp:
+            delegated = Path(temp, "delegated")
+            delegated.write_text(DELEGATED)
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n10.2.0.1\n10.5.0.1\n")
+            self.check(
+                ['"ip","country"', '"10.2.0.1","sk"', '"10.5.0.1","cz"'],
+                f"-f country --whois.cache False --whois.native True --whois.offline {delegated}"
+                f" --whois.offline-index {temp}/index",
+                filename=source,
+            )
+            self.assertEqual(["10.5.0.1"], registry.queries)
+            self.assertTrue(Path(temp, "index").exists())
+
+
+def _mmdb_data(value) -> bytes:
+    """Encode a value in the MaxMind DB data section format (no pointers)."""
+    if isinstance(value, dict):
+        head, body = 7, b"".join(
+            _mmdb_data(k) + _mmdb_data(v) for k, v in value.items()
+        )
+        size = len(value)
+    elif isinstance(value, str):
+        head, body = 2, value.encode()
+        size = len(body)
+    else:  # uint32
+        head, body = 6, value.to_bytes(4, "big")
+        size = 4
+    if size < 29:
+        return bytes([head << 5 | size]) + body
+    return bytes([head << 5 | 29, size - 29]) + body
+
+
+def write_mmdb(path: Path, networks: dict[str, dict], record_size=28):
+    """Write an IPv6 MaxMind DB, the IPv4 networks placed in the ::/96 subtree."""
+    # node => [left, right], a record is a node index or ("data", offset)
+    tree = [[None, None]]
+    data = b""
+    for network, record in networks.items():
+        net = IPNetwork(network)
+        value, bits = int(net.ip), net.prefixlen
+        if net.version == 4:
+            bits += 96
+        node = 0
+        for i in range(bits):
+            bit = value >> (127 - i) & 1
+            if i == bits - 1:
+                tree[node][bit] = ("data", len(data))
+            else:
+                if tree[node][bit] is None or isinstance(tree[node][bit], tuple):
+                    # a broader network inserted before passes its record down
+                    tree.append([tree[node][bit]] * 2)
+                    tree[node][bit] = len(tree) - 1
+                node = tree[node][bit]
+        data += _mmdb_data(record)
+    count = len(tree)
+    nodes = bytearray()
+    for left, right in tree:
+        left, right = (
+            count if r is None else count + 16 + r[1] if isinstance(r, tuple) else r
+            for r in (left, right)
+        )
+        if record_size == 28:
+            nodes += (left & 0xFFFFFF).to_bytes(3, "big")
+            nodes.append((left >> 24) << 4 | right >> 24)
+            nodes += (right & 0xFFFFFF).to_bytes(3, "big")
+        else:
+            nodes += left.to_bytes(record_size // 8, "big")
+            nodes += right.to_bytes(record_size // 8, "big")
+    metadata = {
+        "node_count": count,
+        "record_size": record_size,
+        "ip_version": 6,
+        "database_type": "test",
+    }
+    path.write_bytes(
+        bytes(nodes)
+        + bytes(16)
+        + data
+        + b"\xab\xcd\xefMaxMind.com"
+        + _mmdb_data(metadata)
+    )
+
+
+class TestMmdb(TestAbstract):
+    def test_reader(self):
+        networks = {
+            "10.1.0.0/16": {
+                "country": {"iso_code": "CZ"},
+                "autonomous_system_number": 1234,
+                "autonomous_system_organization": "Example Org",
+            },
+            "10.1.2.0/24": {"country": {"iso_code": "SK"}},
+            "2001:db8::/32": {"country_code": "DE", "asn": "AS5678"},
+        }
+        with TemporaryDirectory() as temp:
+            for record_size in (24, 28, 32):
+                path = Path(temp, f"{record_size}.mmdb")
+                write_mmdb(path, networks, record_size)
+                reader = MmdbReader(path)
+                self.assertEqual(
+                    1234, reader.get("10.1.3.4")["autonomous_system_number"]
+                )
+                self.assertEqual({"iso_code": "SK"}, reader.get("10.1.2.3")["country"])
+                self.assertEqual("DE", reader.get("2001:db8::1")["country_code"])
+                self.assertIsNone(reader.get("10.2.0.1"))
+                self.assertIsNone(reader.get("invalid"))
+                reader.close()
+
+    def test_fields(self):
+        """Country and CSIRT contact are answered from the database, WHOIS is asked only for the local IP."""
+        with fake_whois(RIPE_RESPONSE) as (registry, root), TemporaryDirectory() as temp:
+            mmdb = Path(temp, "test.mmdb")
+            write_mmdb(
+                mmdb,
+                {
+                    "10.1.0.0/16": {
+                        "country": {"iso_code": "CZ"},
+                        "autonomous_system_organization": "Example Org",
+                    },
+                    "10.2.0.0/16": {"country": {"iso_code": "SK"}},
+                },
+            )
+            contacts = Path(temp, "contacts.csv")
+            contacts.write_text("country,email\nsk,csirt@example.sk\n")
+            source = Path(temp, "ips.csv")
+            source.write_text("ip\n10.2.0.1\n10.1.0.1\n")
+            flags = f"--whois.cache False --whois.native True --whois.mmdb {mmdb} --whois.local-country cz --contacts-abroad {contacts}"
+            self.check(
+                [
+                    '"ip","as_org","country"',
+                    '"10.2.0.1","","sk"',
+                    '"10.1.0.1","Example Org","cz"',
+                ],
+                f"-f as_org -f country {flags}",
+                filename=source,
+            )
+            self.assertEqual([], registry.queries)
+            parser = self.check(
+                [
+                    '"ip","incident_contact"',
+                    '"10.2.0.1","sk@@csirt@example.sk"',
+                    '"10.1.0.1","abuse@example.com"',
+                ],
+                f"-f incident_contact {flags}",
+                filename=source,
+            ).controller.parser
+            self.assertEqual(["10.1.0.1"], registry.queries)
+            # the IP answered locally is counted as if WHOIS answered it
+            self.assertEqual({"10.2.0.1", "10.1.0.1"}, parser.stats["ip_unique"])
+            self.assertEqual({"10.2.0.1"}, parser.stats["ip_abroad_unknown"])
+            self.assertEqual({"10.2.0.1"}, parser.stats["ip_csirtmail_known"])
+            self.assertEqual({"sk"}, parser.stats["csirtmail_known"])
+
+
+class TestParsedResponse(TestAbstract):
+    def test_corpus(self):
+        """The recorded responses are parsed as they always were (see test_data/whois/expected.json)."""
+        expected = json.loads((CORPUS / "expected.json").read_text())
+        self.assertEqual(sorted(expected), sorted(f.name for f in CORPUS.glob("*.txt")))
+        for name, fields in expected.items():
+            chunks = (CORPUS / name).read_text().strip().split(REFERRAL_MARK)[::-1]
+            parsed = ParsedResponse(chunks)
+            for field, value in fields.items():
+                with self.subTest(file=name, field=field):
+                    self.assertEqual(value, getattr(parsed, field))
+
+    def test_failure(self):
+        """Only a whole line tells the query failed, not a registry text mentioning the phrase."""
+        for line in (
+            "connect: connection refused",
+            "[errno -2] name or service not known",
+            "%error:201: access denied",
+            "timed out",
+            "whois.example.com skipped after 3 failures, retrying in 30 s",
+        ):
+            with self.subTest(line=line):
+                self.assertTrue(ParsedResponse([f"using server x.\n{line}\n"]).failure)
+        for line in (
+            "remarks: access denied to the bulk queries",
+            "% the queries timed out are not counted",
+        ):
+            with self.subTest(line=line):
+                self.assertEqual("", ParsedResponse([f"{line}\n"]).failure)
+        for path in CORPUS.glob("*.txt"):
+            self.assertEqual("", ParsedResponse([path.read_text()]).failure)
+
+    def test_analyze(self):
+        """The fields are extracted from the most recent referral first."""
+        response = (CORPUS / "arin_rwhois.txt").read_text().split("\n", 1)[1]
+        # do not let the client follow the referral itself
+        response = response.replace("referralserver:", "x-referralserver:")
+        with fake_whois(response) as (registry, root):
+            for field, value in (
+                ("country", "de"),
+                ("prefix", "154.48.224.0-154.48.255.255"),
+                ("netname", "net-154-48-224-0-19"),
+                ("abusemail", "abuse@cogentco.com"),
+            ):
+                self.check(
+                    value,
+                    f"-f {field} --whois.cache False --whois.native True",
+                    "154.48.224.1",
+                )